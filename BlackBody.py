@@ -0,0 +1,173 @@
+"""
+Black-body continuum components.
+Planck functions are evaluated analytically on the target grid, rows are memoized by grid and temperature.
+Composite continuum is base spectrum (e.g. CMFGEN model) times scale plus black bodies times dilution factors,
+all coefficients are found by non-negative linear least squares against observed spectrum.
+Temperature scan solves the two-coefficient problem for every temperature of the grid in closed form at once.
+"""
+
+import numpy as np
+from scipy.optimize import nnls
+
+import Rebin
+
+PLANCK = 6.62607015e-27
+LIGHT_SPEED = 2.99792458e10
+BOLTZMANN = 1.380649e-16
+
+SCAN_DTYPE = [('temperature', np.float64), ('base_scale', np.float64), ('dilution', np.float64),
+              ('rms', np.float64), ('best', bool)]
+
+_planck_cache = {}
+_MAX_CACHED = 256
+
+
+def _planck(wave, temperature):
+    """
+    :return: B_lambda(T), erg s^-1 cm^-2 A^-1 sr^-1
+    """
+    wave_cm = wave * 1e-8
+    with np.errstate(over='ignore'):
+        return 2.0 * PLANCK * LIGHT_SPEED ** 2 / wave_cm ** 5 / \
+            np.expm1(PLANCK * LIGHT_SPEED / (wave_cm * BOLTZMANN * temperature)) * 1e-8
+
+
+def planck(wave, temperatures):
+    """
+    Planck function on grid, memoized by grid and temperature
+    :param wave: wavelength array, Angstrom
+    :param temperatures: K, number or array
+    :return: B_lambda, erg s^-1 cm^-2 A^-1 sr^-1, np.array (temperatures.size, wave.size) for array temperatures
+    """
+    wave = np.asarray(wave, dtype=np.float64)
+    single = np.ndim(temperatures) == 0
+    temperatures = np.atleast_1d(np.asarray(temperatures, dtype=np.float64))
+    grid = Rebin.grid_key(wave)
+    result = np.empty((temperatures.size, wave.size))
+    missing = []
+    for index, temperature in enumerate(temperatures):
+        row = _planck_cache.get((grid, temperature))
+        if row is None:
+            missing.append(index)
+        else:
+            result[index] = row
+    if missing:
+        result[missing] = _planck(wave[np.newaxis, :], temperatures[missing][:, np.newaxis])
+        if len(_planck_cache) + len(missing) > _MAX_CACHED:
+            _planck_cache.clear()
+        for index in missing[:_MAX_CACHED]:
+            row = result[index].copy()
+            row.setflags(write=False)
+            _planck_cache[(grid, temperatures[index])] = row
+    return result[0] if single else result
+
+
+def composite(wave, temperatures, factors, base=None, base_scale=1.0):
+    """
+    :param base: base spectrum on wave or None
+    :return: base_scale * base + sum of factors * planck(wave, temperatures)
+    """
+    temperatures = np.atleast_1d(np.asarray(temperatures, dtype=np.float64))
+    continuum = np.zeros(np.size(wave))
+    if temperatures.size:
+        continuum = np.dot(np.atleast_1d(factors), planck(wave, temperatures))
+    if base is not None:
+        continuum = continuum + base_scale * np.asarray(base, dtype=np.float64)
+    return continuum
+
+
+def _good(flux, base):
+    good = np.isfinite(flux)
+    if base is not None:
+        good &= np.isfinite(base)
+    return good
+
+
+def fit_dilution(wave, flux, temperatures, base=None):
+    """
+    Non-negative least squares fit of observed flux by composite continuum
+    :param wave: wavelength array, Angstrom
+    :param flux: observed flux
+    :param temperatures: black-body temperatures, K
+    :param base: base spectrum on wave, its scale is fitted too, or None
+    :return: (base_scale, dilution factors, rms of residual), base_scale is 0 without base
+    """
+    flux = np.asarray(flux, dtype=np.float64)
+    temperatures = np.atleast_1d(np.asarray(temperatures, dtype=np.float64))
+    good = _good(flux, base)
+    columns = [row[good] for row in planck(wave, temperatures).reshape(temperatures.size, -1)]
+    if base is not None:
+        columns.insert(0, np.asarray(base, dtype=np.float64)[good])
+    matrix = np.column_stack(columns)
+    # unit columns keep nnls well conditioned for fluxes of any scale
+    norms = np.sqrt(np.sum(matrix ** 2, axis=0))
+    norms[norms == 0] = 1.0
+    coefficients, residual = nnls(matrix / norms, flux[good])
+    coefficients /= norms
+    rms = residual / np.sqrt(max(np.sum(good), 1))
+    if base is None:
+        return 0.0, coefficients, rms
+    return coefficients[0], coefficients[1:], rms
+
+
+def scan_temperatures(wave, flux, temperatures, base=None):
+    """
+    Fit observed flux by one black body (plus scaled base) for every temperature of grid
+    :param wave: wavelength array, Angstrom
+    :param flux: observed flux
+    :param temperatures: scanned temperatures, K
+    :param base: base spectrum on wave or None
+    :return: structured array SCAN_DTYPE in order of temperatures, the lowest rms marked best
+    """
+    flux = np.asarray(flux, dtype=np.float64)
+    temperatures = np.atleast_1d(np.asarray(temperatures, dtype=np.float64))
+    good = _good(flux, base)
+    y = flux[good]
+    bodies = np.atleast_2d(planck(wave, temperatures))[:, good]
+    body_norm = np.sqrt(np.sum(bodies ** 2, axis=1))
+    body_norm[body_norm == 0] = 1.0
+    bodies = bodies / body_norm[:, np.newaxis]
+    body_y = np.dot(bodies, y)
+
+    if base is None:
+        base_scale = np.zeros(temperatures.size)
+        dilution = np.maximum(body_y, 0.0)
+        residual = y - dilution[:, np.newaxis] * bodies
+    else:
+        b = np.asarray(base, dtype=np.float64)[good]
+        base_norm = np.sqrt(np.dot(b, b)) or 1.0
+        b = b / base_norm
+        base_y = np.dot(b, y)
+        base_body = np.dot(bodies, b)
+        # unconstrained 2x2 solution with unit columns, then constrained alternatives
+        det = 1.0 - base_body ** 2
+        safe_det = np.where(det > 1e-12, det, 1.0)
+        base_scale = np.where(det > 1e-12, (base_y - base_body * body_y) / safe_det, -1.0)
+        dilution = np.where(det > 1e-12, (body_y - base_body * base_y) / safe_det, -1.0)
+        both = (base_scale >= 0) & (dilution >= 0)
+        only_body = ~both & (body_y >= max(base_y, 0.0))
+        only_base = ~both & ~only_body
+        base_scale = np.where(both, base_scale, np.where(only_base, max(base_y, 0.0), 0.0))
+        dilution = np.where(both, dilution, np.where(only_body, np.maximum(body_y, 0.0), 0.0))
+        residual = y - base_scale[:, np.newaxis] * b - dilution[:, np.newaxis] * bodies
+        base_scale = base_scale / base_norm
+
+    table = np.zeros(temperatures.size, dtype=SCAN_DTYPE)
+    table['temperature'] = temperatures
+    table['base_scale'] = base_scale
+    table['dilution'] = dilution / body_norm
+    table['rms'] = np.sqrt(np.mean(residual ** 2, axis=1)) if y.size else np.inf
+    table['best'][np.argmin(table['rms'])] = True
+    return table
+
+
+def format_table(table):
+    """
+    :param table: scan_temperatures result
+    :return: text table
+    """
+    lines = ['# temperature base_scale dilution rms best']
+    for row in table:
+        lines.append('%0.1f %0.6e %0.6e %0.6e %d' % (row['temperature'], row['base_scale'], row['dilution'],
+                                                     row['rms'], row['best']))
+    return '\n'.join(lines)
@@ -0,0 +1,283 @@
+"""
+Gaussian instrumental and rotational broadening by FFT convolution.
+For constant resolving power and for rotation spectra are resampled to uniform log-lambda grid,
+where the kernel has the same width in pixels everywhere, for constant FWHM to uniform lambda grid.
+Kernels and their FFTs are cached, 2D stacks of spectra on one grid are broadened in one call,
+one spectrum is broadened with many vsini values in one call.
+"""
+
+import numpy as np
+
+import Rebin
+
+FWHM_TO_SIGMA = 2.0 * np.sqrt(2.0 * np.log(2.0))
+SPEED_OF_LIGHT = 299792.458
+DEFAULT_MAXSIG = 5.0
+
+_kernel_cache = {}
+_kernel_fft_cache = {}
+_rotational_fft_cache = {}
+_MAX_CACHED = 64
+
+
+def fft_size(size):
+    """
+    :return: smallest 2**a * 3**b * 5**c not less than size
+    """
+    best = 1
+    while best < size:
+        best *= 2
+    power5 = 1
+    while power5 < best:
+        power3 = power5
+        while power3 < best:
+            candidate = power3
+            while candidate < size:
+                candidate *= 2
+            best = min(best, candidate)
+            power3 *= 3
+        power5 *= 5
+    return best
+
+
+def gaussian_kernel(sigma):
+    """
+    Normalized gaussian kernel, cached by width
+    :param sigma: standard deviation in pixels
+    :return: np.array of odd length, 2 * ceil(DEFAULT_MAXSIG * sigma) + 1
+    """
+    key = round(sigma, 12)
+    kernel = _kernel_cache.get(key)
+    if kernel is None:
+        half = max(int(np.ceil(DEFAULT_MAXSIG * sigma)), 1)
+        x = np.arange(-half, half + 1)
+        kernel = np.exp(-x ** 2 / (2.0 * sigma ** 2))
+        kernel /= np.sum(kernel)
+        if len(_kernel_cache) >= _MAX_CACHED:
+            _kernel_cache.clear()
+        _kernel_cache[key] = kernel
+    return kernel
+
+
+def kernel_fft(sigma, size):
+    """
+    rfft of gaussian kernel centered at zero lag, cached by width and FFT size
+    :param sigma: standard deviation in pixels
+    :param size: FFT size
+    """
+    key = (round(sigma, 12), size)
+    spectrum = _kernel_fft_cache.get(key)
+    if spectrum is None:
+        kernel = gaussian_kernel(sigma)
+        half = kernel.size // 2
+        wrapped = np.zeros(size)
+        wrapped[:half + 1] = kernel[half:]
+        wrapped[size - half:] = kernel[:half]
+        spectrum = np.fft.rfft(wrapped)
+        if len(_kernel_fft_cache) >= _MAX_CACHED:
+            _kernel_fft_cache.clear()
+        _kernel_fft_cache[key] = spectrum
+    return spectrum
+
+
+def convolve(fluxes, sigma, edge_handling='firstlast'):
+    """
+    FFT convolution of every row with gaussian, 'same' size output
+    :param fluxes: np.array (spectra, points)
+    :param sigma: standard deviation in pixels
+    :param edge_handling: 'firstlast' extends rows by first and last values, None pads with zeros
+    :return: np.array (spectra, points)
+    """
+    half = gaussian_kernel(sigma).size // 2
+    points = fluxes.shape[1]
+    padded = _pad(fluxes, half, edge_handling)
+
+    # circular convolution wraps only zero-padded tail
+    size = fft_size(padded.shape[1] + half)
+    result = np.fft.irfft(np.fft.rfft(padded, size, axis=1) * kernel_fft(sigma, size), size, axis=1)
+    return result[:, half:half + points]
+
+
+def _pad(fluxes, half, edge_handling):
+    """
+    Extend rows by half points on each side
+    """
+    if edge_handling == 'firstlast':
+        return np.concatenate((np.repeat(fluxes[:, :1], half, axis=1), fluxes,
+                               np.repeat(fluxes[:, -1:], half, axis=1)), axis=1)
+    elif edge_handling is None:
+        return np.concatenate((np.zeros((fluxes.shape[0], half)), fluxes,
+                               np.zeros((fluxes.shape[0], half))), axis=1)
+    raise ValueError("edge_handling must be 'firstlast' or None")
+
+
+def _resample(x, fluxes, new_x):
+    """
+    Linear interpolation of stack on common grid, weights are computed once for all rows
+    """
+    right = np.clip(np.searchsorted(x, new_x, 'right'), 1, x.size - 1)
+    left = right - 1
+    step = x[right] - x[left]
+    weight = np.clip((new_x - x[left]) / np.where(step > 0, step, 1.0), 0.0, 1.0)
+    return fluxes[:, left] * (1.0 - weight) + fluxes[:, right] * weight
+
+
+def _median_step(x):
+    """
+    Median of positive steps of ascending grid, repeated points (e.g. merged orders) are skipped
+    """
+    steps = np.diff(x)
+    if np.any(steps < 0):
+        raise ValueError("Wavelengths must be ascending")
+    positive = steps[steps > 0]
+    if positive.size == 0:
+        raise ValueError("Wavelengths must not be all equal")
+    return np.median(positive)
+
+
+def _on_uniform_grid(x, fluxes, step, function):
+    """
+    Apply function(fluxes, step) -> (rows, points) on uniform grid,
+    resampling from ascending grid x and back if x is not uniform
+    :param step: uniform grid step, median positive step of x if None
+    """
+    median_step = _median_step(x)
+    steps = np.diff(x)
+    if step is None:
+        step = median_step
+    uniform = abs(np.max(steps) - np.min(steps)) <= 1e-6 * abs(np.mean(steps)) and abs(steps[0] - step) <= 1e-6 * step
+
+    if uniform:
+        return function(fluxes, step)
+    grid = x[0] + step * np.arange(int(np.floor((x[-1] - x[0]) / step)) + 2)
+    return _resample(grid, function(_resample(x, fluxes, grid), step), x)
+
+
+def _broaden(x, fluxes, sigma, step, edge_handling):
+    """
+    Convolve stack given on grid x with gaussian of sigma (units of x),
+    resampling to uniform grid with step if x is not uniform, unsorted x is sorted and result put back
+    """
+    x, fluxes, order = Rebin.ascending(x, fluxes)
+    single = fluxes.ndim == 1
+    fluxes = np.atleast_2d(fluxes)
+    if x.size < 2:
+        return fluxes[0].copy() if single else fluxes.copy()
+
+    result = _on_uniform_grid(x, fluxes, step,
+                              lambda uniform_fluxes, uniform_step: convolve(uniform_fluxes, sigma / uniform_step,
+                                                                            edge_handling))
+    result = Rebin.restore_order(result, order)
+    return result[0] if single else result
+
+
+def broaden(wave, fluxes, resolution, step=None, edge_handling='firstlast'):
+    """
+    Gaussian instrumental broadening with constant resolving power, FWHM = wave / resolution
+    :param wave: wavelength array, any order and spacing
+    :param fluxes: flux array or np.array (spectra, wave.size)
+    :param resolution: resolving power
+    :param step: log-lambda grid step, median positive step of input by default
+    :param edge_handling: 'firstlast' or None, see convolve
+    :return: broadened flux, same shape as fluxes
+    """
+    return _broaden(np.log(np.asarray(wave, dtype=np.float64)), fluxes,
+                    1.0 / (resolution * FWHM_TO_SIGMA), step, edge_handling)
+
+
+def broaden_fwhm(wave, fluxes, fwhm, step=None, edge_handling='firstlast'):
+    """
+    Gaussian broadening with constant FWHM in Angstrom
+    :param wave: wavelength array, any order and spacing
+    :param fluxes: flux array or np.array (spectra, wave.size)
+    :param fwhm: kernel FWHM, Angstrom
+    :param step: lambda grid step, median positive step of input by default
+    :param edge_handling: 'firstlast' or None, see convolve
+    :return: broadened flux, same shape as fluxes
+    """
+    return _broaden(np.asarray(wave, dtype=np.float64), fluxes, fwhm / FWHM_TO_SIGMA, step, edge_handling)
+
+
+def rotational_kernel(vsini, epsilon, velocity_step, half, oversample=9):
+    """
+    Rotational broadening profile (Gray) averaged over pixels
+    :param vsini: projected rotational velocity, km/s
+    :param epsilon: linear limb-darkening coefficient
+    :param velocity_step: grid step, km/s
+    :param half: kernel has 2 * half + 1 points
+    :param oversample: profile samples per pixel
+    :return: normalized kernel
+    """
+    kernel = np.zeros(2 * half + 1)
+    if vsini < 0.5 * velocity_step:
+        kernel[half] = 1.0
+        return kernel
+    offsets = (np.arange(oversample) + 0.5) / oversample - 0.5
+    x = ((np.arange(-half, half + 1)[:, np.newaxis] + offsets[np.newaxis, :]) * velocity_step / vsini)
+    inside = np.abs(x) < 1.0
+    one_minus_x2 = np.where(inside, 1.0 - x ** 2, 0.0)
+    profile = 2.0 * (1.0 - epsilon) * np.sqrt(one_minus_x2) + 0.5 * np.pi * epsilon * one_minus_x2
+    kernel = np.mean(profile, axis=1)
+    return kernel / np.sum(kernel)
+
+
+def rotational_kernel_fft(vsini, epsilon, velocity_step, half, size):
+    """
+    rfft of rotational kernel centered at zero lag, cached by parameters, grid step and FFT size
+    """
+    key = (round(vsini, 9), round(epsilon, 9), round(velocity_step, 12), half, size)
+    spectrum = _rotational_fft_cache.get(key)
+    if spectrum is None:
+        kernel = rotational_kernel(vsini, epsilon, velocity_step, half)
+        wrapped = np.zeros(size)
+        wrapped[:half + 1] = kernel[half:]
+        wrapped[size - half:] = kernel[:half]
+        spectrum = np.fft.rfft(wrapped)
+        if len(_rotational_fft_cache) >= 4 * _MAX_CACHED:
+            _rotational_fft_cache.clear()
+        _rotational_fft_cache[key] = spectrum
+    return spectrum
+
+
+def broaden_rotation(wave, flux, vsini, epsilon=0.0, step=None, edge_handling='firstlast'):
+    """
+    Rotational broadening of one spectrum for one or many vsini values.
+    Spectrum is transformed once, every vsini costs one product and inverse FFT.
+    :param wave: wavelength array, any order and spacing
+    :param flux: flux array
+    :param vsini: projected rotational velocity, km/s, number or array
+    :param epsilon: linear limb-darkening coefficient, number or array of vsini shape
+    :param step: log-lambda grid step, half of the median input step by default,
+        narrow rotation kernels are sensitive to resampling
+    :param edge_handling: 'firstlast' or None, see convolve
+    :return: broadened flux, np.array (vsini.size, wave.size) for array vsini,
+        rows of zero vsini are copies of flux
+    """
+    wave, flux, order = Rebin.ascending(wave, flux)
+    single = np.ndim(vsini) == 0
+    vsini = np.atleast_1d(np.asarray(vsini, dtype=np.float64))
+    epsilon = np.broadcast_to(np.asarray(epsilon, dtype=np.float64), vsini.shape)
+    if wave.size < 2:
+        result = np.repeat(flux[np.newaxis, :], vsini.size, axis=0)
+        return result[0] if single else result
+
+    def convolve_rotation(fluxes, log_step):
+        velocity_step = SPEED_OF_LIGHT * log_step
+        half = max(int(np.ceil(np.max(vsini) / velocity_step)), 1)
+        points = fluxes.shape[1]
+        padded = _pad(fluxes, half, edge_handling)
+        size = fft_size(padded.shape[1] + half)
+        flux_fft = np.fft.rfft(padded[0], size)
+        result = np.empty((vsini.size, points))
+        for row, (row_vsini, row_epsilon) in enumerate(zip(vsini, epsilon)):
+            kernel_fft = rotational_kernel_fft(row_vsini, row_epsilon, velocity_step, half, size)
+            result[row] = np.fft.irfft(flux_fft * kernel_fft, size)[half:half + points]
+        return result
+
+    log_wave = np.log(wave)
+    if step is None:
+        step = 0.5 * _median_step(log_wave)
+    result = _on_uniform_grid(log_wave, flux[np.newaxis, :], step, convolve_rotation)
+    result[vsini == 0] = flux
+    result = Rebin.restore_order(result, order)
+    return result[0] if single else result
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Headless processing of CMFGEN model grids.
+Every model found in the directory tree goes through the same chain as 'Open from CMFGEN':
+window, flux-conserving rebinning to log-lambda grid, instrumental and rotational broadening, normalization by *cont file.
+Results are saved as two-column tables mirroring the model tree.
+
+Example:
+    python CmfgenBatch.py models/ processed/ --resolution 15000 --vsini 110 --window 4400 4950
+"""
+
+import os
+import sys
+import argparse
+import multiprocessing
+import numpy as np
+from PyAstronomy import pyasl
+
+import Broadening
+import CmfgenParse
+import Rebin
+
+
+def cont_file_name(model_file):
+    """
+    :param model_file: CMFGEN model filename, e.g. obs_fin
+    :return: matching continuum filename, e.g. obs_cont
+    """
+    return model_file[0:-3] + 'cont'
+
+
+def process_model(model_file, wave_min, wave_max, resolution, vsini=0.0, epsilon=0.0, normalize=True, cached=True):
+    """
+    Process CMFGEN model like cmfgen_plot
+    :param model_file: CMFGEN model filename
+    :param wave_min: left window limit, Angstrom
+    :param wave_max: right window limit, Angstrom
+    :param resolution: instrumental resolution
+    :param vsini: rotational velocity, km/s, 0 for no rotational broadening
+    :param epsilon: limb-darkening coefficient
+    :param normalize: divide by interpolated *cont file
+    :param cached: read models through the on-disk cache of the GUI, False parses them directly
+    :return: np.array(wave, flux)
+    """
+    load = CmfgenParse.load_model if cached else CmfgenParse.spectr_input
+    model = load(model_file, wave_min, wave_max)
+
+    wave, flux = Rebin.rebin_spectrum(model[:, 0], model[:, 1])
+    flux = Broadening.broaden(wave, flux, resolution)
+    if vsini > 0:
+        flux = Broadening.broaden_rotation(wave, flux, vsini, epsilon)
+
+    if normalize:
+        cont = load(cont_file_name(model_file), wave_min, wave_max)
+        flux = flux / pyasl.intep(cont[:, 0], cont[:, 1], wave)
+
+    return np.column_stack((wave, flux))
+
+
+def find_models(models_dir, model_name='obs_fin'):
+    """
+    :param models_dir: root of model grid
+    :param model_name: model filename to look for
+    :return: sorted list of model paths
+    """
+    models = []
+    for directory, subdirectories, files in os.walk(models_dir):
+        if model_name in files:
+            models.append(os.path.join(directory, model_name))
+    models.sort()
+    return models
+
+
+def output_file_name(model_file, models_dir, output_dir):
+    """
+    :return: output table path, model tree is mirrored inside output_dir
+    """
+    relative_path = os.path.relpath(model_file, models_dir)
+    return os.path.join(output_dir, relative_path + '.data')
+
+
+def parameters_header(parameters):
+    return ' '.join('%s=%r' % (key, parameters[key]) for key in sorted(parameters))
+
+
+def is_up_to_date(model_file, output_file, parameters):
+    """
+    Output is up to date if it is newer than model (and *cont file)
+    and was made with the same parameters
+    """
+    if not os.path.exists(output_file):
+        return False
+
+    sources = [model_file]
+    if parameters['normalize']:
+        sources.append(cont_file_name(model_file))
+    output_time = os.path.getmtime(output_file)
+    if any(os.path.getmtime(source) > output_time for source in sources if os.path.exists(source)):
+        return False
+
+    with open(output_file) as output:
+        return output.readline().strip() == '# ' + parameters_header(parameters)
+
+
+def process_task(task):
+    """
+    Pool worker: process one model and save result.
+    Models are parsed without the GUI cache, grid would evict it from many processes at once.
+    :param task: (model_file, output_file, parameters)
+    :return: (model_file, error message or None)
+    """
+    model_file, output_file, parameters = task
+    try:
+        data = process_model(model_file, cached=False, **parameters)
+        output_directory = os.path.dirname(output_file)
+        if output_directory and not os.path.isdir(output_directory):
+            try:
+                os.makedirs(output_directory)
+            except OSError:
+                # made by another worker
+                pass
+        tmp_file = '%s.%d.tmp' % (output_file, os.getpid())
+        np.savetxt(tmp_file, data, header=parameters_header(parameters))
+        os.rename(tmp_file, output_file)
+    except Exception as exception:
+        # one broken model must not stop the grid
+        return model_file, '%s: %s' % (type(exception).__name__, exception)
+    return model_file, None
+
+
+def process_grid(models_dir, output_dir, parameters, model_name='obs_fin', processes=None, force=False):
+    """
+    Process all models in tree on process pool, skipping up to date outputs
+    :param models_dir: root of model grid
+    :param output_dir: root for processed tables
+    :param parameters: dict of process_model keyword arguments
+    :param model_name: model filename to look for
+    :param processes: pool size, all cores by default
+    :param force: process even up to date models
+    :return: list of (model_file, error message) for failed models
+    """
+    tasks = []
+    skipped = 0
+    for model_file in find_models(models_dir, model_name):
+        output_file = output_file_name(model_file, models_dir, output_dir)
+        if not force and is_up_to_date(model_file, output_file, parameters):
+            skipped += 1
+        else:
+            tasks.append((model_file, output_file, parameters))
+    print("%d models to process, %d up to date" % (len(tasks), skipped))
+
+    failed = []
+    if not tasks:
+        return failed
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for done, (model_file, error) in enumerate(pool.imap_unordered(process_task, tasks), 1):
+            if error is None:
+                print("[%d/%d] %s" % (done, len(tasks), model_file))
+            else:
+                print("[%d/%d] %s failed: %s" % (done, len(tasks), model_file, error))
+                failed.append((model_file, error))
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Process CMFGEN model grid without GUI.')
+    parser.add_argument('models_dir', help='root directory of model grid')
+    parser.add_argument('output_dir', help='directory for processed spectra')
+    parser.add_argument('--model-name', default='obs_fin', help='model filename (default: obs_fin)')
+    parser.add_argument('--window', nargs=2, type=float, default=[4400.0, 4950.0],
+                        metavar=('WAVE_MIN', 'WAVE_MAX'), help='wavelength window, Angstrom')
+    parser.add_argument('--resolution', type=float, default=15000.0, help='instrumental resolution')
+    parser.add_argument('--vsini', type=float, default=0.0, help='rotational velocity, km/s')
+    parser.add_argument('--epsilon', type=float, default=0.0, help='limb-darkening coefficient')
+    parser.add_argument('--no-normalize', action='store_true', help='do not divide by *cont file')
+    parser.add_argument('--processes', type=int, default=None, help='pool size (default: all cores)')
+    parser.add_argument('--force', action='store_true', help='reprocess up to date models')
+    args = parser.parse_args(argv)
+
+    parameters = {'wave_min': args.window[0],
+                  'wave_max': args.window[1],
+                  'resolution': args.resolution,
+                  'vsini': args.vsini,
+                  'epsilon': args.epsilon,
+                  'normalize': not args.no_normalize}
+    failed = process_grid(args.models_dir, args.output_dir, parameters,
+                          args.model_name, args.processes, args.force)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,61 +1,280 @@
 import numpy as np
 
+from SpectrumCache import SpectrumCache
 
-def spectr_input(file_name):
+
+_SPACE = ord(' ')
+_NEWLINE = ord('\n')
+_DOT = ord('.')
+_PLUS = ord('+')
+_MINUS = ord('-')
+_EXPONENT = ord('E')
+_FORTRAN_EXPONENT = ord('D')
+_LOWER_CASE = 0x20
+
+_IS_MANTISSA_END = np.zeros(256, dtype=bool)
+_IS_MANTISSA_END[[ord(c) for c in '0123456789.']] = True
+
+_CHUNK_SIZE = 1 << 24
+_FREQ_TO_WAVE = 2.99702547e3
+
+model_cache = SpectrumCache()
+
+
+def load_model(file_name, wave_min=None, wave_max=None):
     """
-    Parse multicolumn fortran data file from CMFGEN
+    Parse CMFGEN model or *cont file through the on-disk cache.
+    Reopening unchanged file returns memory-mapped array without parsing.
+    If the whole model is cached, the window is sliced from it,
+    else only the window is parsed and cached.
     :param file_name: CMFGEN model filename
-    :return: np.array(wave, f   lux)
+    :param wave_min: left window limit, Angstrom
+    :param wave_max: right window limit, Angstrom
+    :return: np.array(wave, flux), read-only
     """
-    input_file = open(file_name,'r')
-    freq_flux_list = []
-    all_lines = input_file.readlines()
+    if wave_min is None and wave_max is None:
+        return model_cache.load(file_name, spectr_input, 'spectr_input')
 
-    try:
-        [parse_line(line, freq_flux_list) for line in all_lines]
-        xfreq = np.array(freq_flux_list[0:len(freq_flux_list) / 2], dtype=np.float64)
-        yint = np.array(freq_flux_list[len(freq_flux_list) / 2:], dtype=np.float64)
+    cached_model = model_cache.get(file_name, 'spectr_input')
+    if cached_model is not None:
+        return window(cached_model, wave_min, wave_max)
 
-    except ValueError as exception:
-        print("Value Error: " + exception.message)
-        freq_flux_list = []
+    return model_cache.load(file_name, lambda name: spectr_input(name, wave_min, wave_max),
+                            'spectr_input %r %r' % (wave_min, wave_max))
 
-        [parse_line_eval(line,freq_flux_list) for line in all_lines]
-        xfreq = np.array(freq_flux_list[0:len(freq_flux_list) / 2], dtype=np.float64)
-        yint = np.array(freq_flux_list[len(freq_flux_list) / 2:], dtype=np.float64)
 
+def spectr_input(file_name, wave_min=None, wave_max=None):
+    """
+    Parse multicolumn fortran data file from CMFGEN.
+    With window limits only the frequency and flux segments covering
+    [wave_min, wave_max] are converted, plus one point on each side for interpolation.
+    :param file_name: CMFGEN model filename
+    :param wave_min: left window limit, Angstrom
+    :param wave_max: right window limit, Angstrom
+    :return: np.array(wave, flux)
+    """
+    if wave_min is None and wave_max is None:
+        buf = np.fromfile(file_name, dtype=np.uint8)
+        blank_header_lines(buf)
+        values = parse_values(buf)
+        if values.size % 2:
+            raise ValueError("Odd number of values, frequencies and fluxes don't pair")
 
-    xfreq = (2.99702547e3) / xfreq
+        half = values.size // 2
+        xfreq = values[:half]
+        yint = values[half:]
+    else:
+        xfreq, yint = read_window(file_name, wave_min, wave_max)
+
+    xfreq = _FREQ_TO_WAVE / xfreq
     yint = (yint * 3 * 10**-5) / (xfreq * xfreq)
-    spectum_model = np.transpose([xfreq, yint])
+    spectum_model = np.column_stack((xfreq, yint))
 
     return spectum_model
 
 
-def parse_line(line, freq_flux_list):
+def read_window(file_name, wave_min=None, wave_max=None):
     """
-    Split and parse line
-    :param line: line to parse
-    :param freq_flux_list:  list with all items
+    Read frequency and flux segments for wavelength window.
+    File is memory-mapped and scanned by chunks for line layout,
+    window borders are found by binary search converting one line per step.
+    :param file_name: CMFGEN model filename
+    :param wave_min: left window limit, Angstrom
+    :param wave_max: right window limit, Angstrom
+    :return: (xfreq, yint) np.arrays
     """
-    line = line.rstrip().split()
-    if line == [] or "." not in line[0]:
-        return
-    elif "E" not in line[0]:
-        freq_flux_list.extend(list(map(lambda x: eval(x),line)))
+    if wave_min is None:
+        wave_min = -np.inf
+    if wave_max is None:
+        wave_max = np.inf
+
+    try:
+        buf = np.memmap(file_name, dtype=np.uint8, mode='r')
+    except ValueError:
+        # empty file can't be mapped
+        return np.zeros(0), np.zeros(0)
+
+    line_starts, line_ends, values_per_line = index_lines(buf)
+    first_values = np.concatenate(([0], np.cumsum(values_per_line)))
+    if first_values[-1] % 2:
+        raise ValueError("Odd number of values, frequencies and fluxes don't pair")
+    half = first_values[-1] // 2
+    if half == 0:
+        return np.zeros(0), np.zeros(0)
+
+    def read(start, stop):
+        return read_values(buf, line_starts, line_ends, first_values, start, stop)
+
+    def wave(index):
+        return _FREQ_TO_WAVE / read(index, index + 1)[0]
+
+    if wave(0) <= wave(half - 1):
+        start = _bisect(wave, half, wave_min, False)
+        stop = _bisect(wave, half, wave_max, True)
     else:
-        freq_flux_list.extend(line)
+        start = _bisect(lambda index: -wave(index), half, -wave_max, False)
+        stop = _bisect(lambda index: -wave(index), half, -wave_min, True)
+
+    start = max(start - 1, 0)
+    stop = min(stop + 1, half)
+    return read(start, stop), read(half + start, half + stop)
 
 
-def parse_line_eval(line, freq_flux_list):
+def read_values(buf, line_starts, line_ends, first_values, start, stop):
     """
-    Safe(Eval) split and parse line
-    Example: '1-303' can't be cast to float
-    :param line: line to parse
-    :param freq_flux_list:  list with all items
+    Convert values with indexes start..stop-1 parsing only lines containing them
+    :param buf: np.uint8 array or memmap with file content
+    :param line_starts: index_lines output
+    :param line_ends: index_lines output
+    :param first_values: index of first value in each line, cumulative sum of values_per_line
+    :param start: first value index
+    :param stop: last value index + 1
+    :return: np.array of float64
     """
-    line = line.rstrip().split()
-    if line == [] or "." not in line[0]:
-        return
-    else:
-        freq_flux_list.extend(list(map(lambda x: eval(x),line)))
+    if stop <= start:
+        return np.zeros(0)
+    first_line = np.searchsorted(first_values, start, 'right') - 1
+    last_line = np.searchsorted(first_values, stop - 1, 'right') - 1
+    segment = np.array(buf[line_starts[first_line]:line_ends[last_line]])
+    blank_header_lines(segment)
+    skip = start - first_values[first_line]
+    return parse_values(segment)[skip:skip + stop - start]
+
+
+def _bisect(key, size, value, strict):
+    """
+    Binary search over monotonically increasing key(0..size-1)
+    :return: first index with key >= value, or key > value if strict
+    """
+    low, high = 0, size
+    while low < high:
+        middle = (low + high) // 2
+        middle_key = key(middle)
+        if middle_key < value or (strict and middle_key == value):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def window(model, wave_min=None, wave_max=None):
+    """
+    Cut parsed model to wavelength window with one point on each side, like spectr_input
+    :param model: np.array(wave, flux)
+    :param wave_min: left window limit, Angstrom
+    :param wave_max: right window limit, Angstrom
+    :return: view of model
+    """
+    if wave_min is None:
+        wave_min = -np.inf
+    if wave_max is None:
+        wave_max = np.inf
+
+    wave = model[:, 0]
+    descending = wave.size > 1 and wave[0] > wave[-1]
+    if descending:
+        wave = wave[::-1]
+    start = max(np.searchsorted(wave, wave_min, 'left') - 1, 0)
+    stop = min(np.searchsorted(wave, wave_max, 'right') + 1, wave.size)
+    if descending:
+        start, stop = wave.size - stop, wave.size - start
+    return model[start:stop]
+
+
+def find_header_lines(buf, newlines):
+    """
+    Mark lines that are not rows of numbers:
+    block titles like 'Continuum Frequencies ( 10^15 Hz)' contain letters
+    other than exponent marks, empty or integer lines contain no '.'.
+    :param buf: np.uint8 array with file content
+    :param newlines: positions of '\\n' in buf
+    :return: np.array of bool, one item per line
+    """
+    has_dot = np.zeros(newlines.size + 1, dtype=bool)
+    has_letter = np.zeros(newlines.size + 1, dtype=bool)
+    for offset in range(0, buf.size, _CHUNK_SIZE):
+        chunk = np.asarray(buf[offset:offset + _CHUNK_SIZE])
+        lower = chunk | _LOWER_CASE
+        letters = np.flatnonzero((lower >= ord('a')) & (lower <= ord('z')) &
+                                 (lower != ord('e')) & (lower != ord('d'))) + offset
+        dots = np.flatnonzero(chunk == _DOT) + offset
+
+        has_dot[np.searchsorted(newlines, dots)] = True
+        has_letter[np.searchsorted(newlines, letters)] = True
+    return ~has_dot | has_letter
+
+
+def find_newlines(buf):
+    """
+    :param buf: np.uint8 array with file content
+    :return: positions of '\\n' in buf
+    """
+    newlines = [np.flatnonzero(np.asarray(buf[offset:offset + _CHUNK_SIZE]) == _NEWLINE) + offset
+                for offset in range(0, buf.size, _CHUNK_SIZE)]
+    return np.concatenate([np.zeros(0, dtype=np.intp)] + newlines)
+
+
+def index_lines(buf):
+    """
+    Find line borders and count numbers in data lines, scanning file by chunks
+    :param buf: np.uint8 array or memmap with file content
+    :return: (line_starts, line_ends, values_per_line), values_per_line is 0 for header lines
+    """
+    newlines = find_newlines(buf)
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_ends = np.concatenate((newlines, [buf.size]))
+
+    values_per_line = np.zeros(line_starts.size, dtype=np.intp)
+    for offset in range(0, buf.size, _CHUNK_SIZE):
+        chunk = np.asarray(buf[offset:offset + _CHUNK_SIZE])
+        space = chunk <= _SPACE
+        previous_space = offset == 0 or buf[offset - 1] <= _SPACE
+        token_starts = np.flatnonzero(~space & np.concatenate(([previous_space], space[:-1]))) + offset
+        values_per_line += np.bincount(np.searchsorted(newlines, token_starts),
+                                       minlength=line_starts.size)
+
+    values_per_line[find_header_lines(buf, newlines)] = 0
+    return line_starts, line_ends, values_per_line
+
+
+def blank_header_lines(buf):
+    """
+    Overwrite with spaces every line that is not a row of numbers, see find_header_lines
+    :param buf: np.uint8 array with file content, changed in place
+    """
+    newlines = find_newlines(buf)
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_ends = np.concatenate((newlines, [buf.size]))
+
+    is_header = find_header_lines(buf, newlines)
+    for start, end in zip(line_starts[is_header], line_ends[is_header]):
+        buf[start:end] = _SPACE
+
+
+def parse_values(buf):
+    """
+    Convert whitespace separated fortran numbers to float64 in one call.
+    Exponents without 'E' ('1-303' is 1E-303) and 'D' exponents are fixed first.
+    :param buf: np.uint8 array with numbers only
+    :return: np.array of float64
+    :raise ValueError: if a token is not a number, e.g. fortran overflow field '*****'
+    """
+    filled = buf > _SPACE
+    tokens = int(np.count_nonzero(filled[1:] & ~filled[:-1])) + int(filled[:1].any())
+    if tokens == 0:
+        return np.zeros(0)
+    fortran_exponents = np.flatnonzero(buf == _FORTRAN_EXPONENT)
+    if fortran_exponents.size:
+        buf = buf.copy()
+        buf[fortran_exponents] = _EXPONENT
+
+    signs = np.flatnonzero((buf[1:] == _PLUS) | (buf[1:] == _MINUS)) + 1
+    signs = signs[_IS_MANTISSA_END[buf[signs - 1]]]
+    if signs.size:
+        buf = np.insert(buf, signs, _EXPONENT)
+
+    # fromstring silently stops at the first bad token
+    values = np.fromstring(buf.tobytes(), dtype=np.float64, sep=' ')
+    if values.size != tokens:
+        raise ValueError("Can't parse value %d of %d" % (values.size + 1, tokens))
+    return values
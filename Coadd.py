@@ -0,0 +1,189 @@
+"""
+Coaddition of many spectra.
+Spectra are rebinned with flux conservation (see Rebin) onto one grid, spectra sharing
+an input grid in one batched call, and combined pixel by pixel with inverse-variance
+weighted mean or median after iterative sigma clipping. Variance of result is propagated.
+Output grid is processed in chunks, so memory is bounded by chunk size times number of spectra.
+"""
+
+from collections import namedtuple
+import numpy as np
+
+import Rebin
+
+CHUNK_SIZE = 65536
+
+CoaddResult = namedtuple('CoaddResult', ['wave', 'flux', 'variance', 'count'])
+
+
+def common_grid(waves, kind='log', step=None, overlap=False):
+    """
+    Grid for coaddition
+    :param waves: list of wavelength arrays, any order
+    :param kind: 'log' or 'uniform', see Rebin.make_grid
+    :param step: grid step, the finest median step of inputs by default
+    :param overlap: cover only range common to all spectra instead of their union
+    :return: new grid
+    """
+    waves = [Rebin.ascending(wave)[0] for wave in waves]
+    starts = [wave[0] for wave in waves]
+    ends = [wave[-1] for wave in waves]
+    wave_min, wave_max = (max(starts), min(ends)) if overlap else (min(starts), max(ends))
+    if wave_min >= wave_max:
+        raise ValueError("Spectra do not overlap")
+    if kind == 'log':
+        if step is None:
+            step = min(np.median(np.diff(np.log(wave))) for wave in waves)
+        return Rebin.log_grid(wave_min, wave_max, step)
+    elif kind == 'uniform':
+        if step is None:
+            step = min(np.median(np.diff(wave)) for wave in waves)
+        return Rebin.uniform_grid(wave_min, wave_max, step)
+    raise ValueError("kind must be 'log' or 'uniform'")
+
+
+def noise_variance(flux, fallback=1.0):
+    """
+    Noise variance of spectrum from robust scatter of neighbour differences,
+    for spectra without error arrays
+    :param fallback: returned when noise can't be estimated, e.g. for noiseless model spectrum,
+        default 1.0 gives equal weights in coadd
+    """
+    differences = np.diff(flux[np.isfinite(flux)])
+    if differences.size == 0:
+        return fallback
+    sigma = 1.4826 * np.median(np.abs(differences - np.median(differences))) / np.sqrt(2.0)
+    if sigma > 0:
+        return sigma ** 2
+    return fallback
+
+
+def _resample_chunk(wave, fluxes, variances, density, new_wave, new_edges):
+    """
+    Rebin stack of spectra on one grid to part of output grid
+    :param density: input pixels per Angstrom, counts input pixels averaged in output bin
+    :return: (fluxes, variances), NaN outside input
+    """
+    start = max(np.searchsorted(wave, new_edges[0]) - 2, 0)
+    stop = min(np.searchsorted(wave, new_edges[-1]) + 2, wave.size)
+    if stop - start < 2:
+        nan = np.full((fluxes.shape[0], new_wave.size), np.nan)
+        return nan, nan.copy()
+    window = slice(start, stop)
+    rebinned = Rebin.rebin(wave[window], np.vstack((fluxes[:, window], variances[:, window],
+                                                    density[window])), new_wave, new_edges)
+    rows = fluxes.shape[0]
+    pixels = np.maximum(rebinned[-1] * np.diff(new_edges), 1.0)
+    return rebinned[:rows], rebinned[rows:2 * rows] / pixels
+
+
+def _median(values, used):
+    """
+    Median along first axis of used values, NaN where none is used.
+    Sorting with NaN last is faster than np.nanmedian for stacks of few spectra.
+    """
+    ordered = np.sort(np.where(used, values, np.nan), axis=0)
+    count = np.sum(used, axis=0)
+    columns = np.arange(values.shape[1])
+    low = ordered[np.maximum(count - 1, 0) // 2, columns]
+    high = ordered[np.maximum(count, 1) // 2 - (count == 0), columns]
+    return np.where(count > 0, 0.5 * (low + high), np.nan)
+
+
+def _clip(fluxes, variances, clip, iterations):
+    """
+    Mask pixels deviating from median of other spectra by more than clip sigma
+    :return: boolean mask of used pixels
+    """
+    with np.errstate(invalid='ignore'):
+        used = np.isfinite(fluxes) & np.isfinite(variances) & (variances > 0)
+    if clip is None or clip <= 0 or fluxes.shape[0] < 3:
+        return used
+    for _ in range(iterations):
+        center = _median(fluxes, used)
+        with np.errstate(invalid='ignore'):
+            keep = used & (np.abs(fluxes - center) <= clip * np.sqrt(variances))
+        # never reject all spectra of pixel
+        keep |= used & ~np.any(keep, axis=0)
+        if np.array_equal(keep, used):
+            break
+        used = keep
+    return used
+
+
+def _combine(fluxes, variances, used, method):
+    """
+    :return: (flux, variance, count) of chunk
+    """
+    count = np.sum(used, axis=0)
+    weights = np.where(used, 1.0 / np.where(used, variances, 1.0), 0.0)
+    weight_sum = np.sum(weights, axis=0)
+    covered = weight_sum > 0
+    safe_sum = np.where(covered, weight_sum, 1.0)
+    variance = np.where(covered, 1.0 / safe_sum, np.nan)
+    if method == 'mean':
+        flux = np.where(covered, np.sum(weights * np.where(used, fluxes, 0.0), axis=0) / safe_sum, np.nan)
+    elif method == 'median':
+        flux = _median(fluxes, used)
+        # efficiency of median relative to mean for gaussian noise
+        variance = variance * np.where(count > 2, np.pi / 2, 1.0)
+    else:
+        raise ValueError("method must be 'mean' or 'median'")
+    return flux, variance, count
+
+
+def coadd(waves, fluxes, variances=None, grid=None, method='mean', clip=3.0, iterations=3,
+          chunk_size=CHUNK_SIZE, report=None):
+    """
+    Coadd spectra
+    :param waves: list of wavelength arrays, any order, spectra are sorted on entry
+    :param fluxes: list of flux arrays
+    :param variances: list of variance arrays or None, estimated by noise_variance for None items
+    :param grid: output grid, common_grid(waves) by default, sorted if not ascending
+    :param method: 'mean' for inverse-variance weighted mean or 'median'
+    :param clip: sigma clipping threshold, None or 0 to use every pixel
+    :param iterations: maximum number of clipping iterations
+    :param chunk_size: output pixels processed at once
+    :param report: progress callback
+    :return: CoaddResult, flux and variance are NaN and count is 0 where no spectrum is used
+    """
+    if variances is None:
+        variances = [None] * len(fluxes)
+    spectra = []
+    for wave, flux, variance in zip(waves, fluxes, variances):
+        wave, flux, order = Rebin.ascending(wave, flux)
+        if variance is None:
+            variance = np.full(flux.shape, noise_variance(flux))
+        else:
+            variance = np.asarray(variance, dtype=np.float64)
+            variance = variance if order is None else variance[order]
+        spectra.append((wave, flux, variance))
+    waves, fluxes, variances = [[spectrum[item] for spectrum in spectra] for item in range(3)]
+    new_wave = common_grid(waves) if grid is None else np.sort(np.asarray(grid, dtype=np.float64))
+    new_edges = Rebin.bin_edges(new_wave)
+
+    groups = []
+    for group in Rebin.same_grid_groups(waves):
+        wave = waves[group[0]]
+        density = 1.0 / np.diff(Rebin.bin_edges(wave))
+        groups.append((group, wave, np.vstack([fluxes[index] for index in group]),
+                       np.vstack([variances[index] for index in group]), density))
+
+    result_flux = np.empty(new_wave.size)
+    result_variance = np.empty(new_wave.size)
+    result_count = np.empty(new_wave.size, dtype=int)
+    chunk_fluxes = np.empty((len(fluxes), min(chunk_size, new_wave.size)))
+    chunk_variances = np.empty_like(chunk_fluxes)
+    for start in range(0, new_wave.size, chunk_size):
+        stop = min(start + chunk_size, new_wave.size)
+        size = stop - start
+        for group, wave, group_fluxes, group_variances, density in groups:
+            chunk_fluxes[group, :size], chunk_variances[group, :size] = _resample_chunk(
+                wave, group_fluxes, group_variances, density, new_wave[start:stop], new_edges[start:stop + 1])
+        part_fluxes, part_variances = chunk_fluxes[:, :size], chunk_variances[:, :size]
+        used = _clip(part_fluxes, part_variances, clip, iterations)
+        result_flux[start:stop], result_variance[start:stop], result_count[start:stop] = _combine(
+            part_fluxes, part_variances, used, method)
+        if report is not None:
+            report(float(stop) / new_wave.size)
+    return CoaddResult(new_wave, result_flux, result_variance, result_count)
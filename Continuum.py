@@ -0,0 +1,229 @@
+"""
+Automatic continuum fitting.
+Continuum is Chebyshev polynomial or cubic spline with uniform knots fitted by least squares
+with iterative asymmetric sigma clipping, so absorption and emission lines drop out of the fit.
+Windows around catalog lines can be masked beforehand and manual points pin the fit as anchors.
+Spectra sharing a grid are fitted together: design matrix is shared and
+normal equations of all spectra are built and solved in one numpy step.
+Groups of spectra on different grids are distributed over process pool.
+"""
+
+import multiprocessing
+import numpy as np
+from scipy import sparse
+
+import Rebin
+from Broadening import SPEED_OF_LIGHT
+
+METHODS = ('chebyshev', 'spline')
+
+
+def mask_intervals(line_waves, velocity, wave_min=None, wave_max=None):
+    """
+    Merged windows around lines
+    :param line_waves: line wavelengths, e.g. LineMarkerLayer.waves
+    :param velocity: half width of window, km/s
+    :param wave_min: drop windows outside range
+    :param wave_max: drop windows outside range
+    :return: np.array (windows, 2) of sorted non-overlapping (start, end)
+    """
+    line_waves = np.sort(np.asarray(line_waves, dtype=np.float64))
+    if wave_min is not None:
+        line_waves = line_waves[line_waves * (1 + velocity / SPEED_OF_LIGHT) >= wave_min]
+    if wave_max is not None:
+        line_waves = line_waves[line_waves * (1 - velocity / SPEED_OF_LIGHT) <= wave_max]
+    if line_waves.size == 0 or velocity <= 0:
+        return np.zeros((0, 2))
+    starts = line_waves * (1 - velocity / SPEED_OF_LIGHT)
+    ends = line_waves * (1 + velocity / SPEED_OF_LIGHT)
+    # window starts a new group if it begins after every previous window ended
+    new_group = np.concatenate(([True], starts[1:] > np.maximum.accumulate(ends)[:-1]))
+    group = np.cumsum(new_group) - 1
+    merged_ends = np.full(group[-1] + 1, -np.inf)
+    np.maximum.at(merged_ends, group, ends)
+    return np.column_stack((starts[new_group], merged_ends))
+
+
+def interval_mask(wave, intervals):
+    """
+    :param intervals: sorted non-overlapping (start, end) windows, see mask_intervals
+    :return: boolean array, True for points inside windows
+    """
+    intervals = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)
+    if intervals.size == 0:
+        return np.zeros(np.shape(wave), dtype=bool)
+    # odd position among flattened edges means inside window
+    return np.searchsorted(intervals.ravel(), wave, 'right') % 2 == 1
+
+
+def _spline_basis(x, pieces):
+    """
+    Uniform cubic B-spline basis on [0, 1]
+    :return: (first basis index of every point, np.array (points, 4) of nonzero basis values)
+    """
+    t = np.clip(x, 0.0, 1.0) * pieces
+    index = np.minimum(t.astype(np.intp), pieces - 1)
+    u = t - index
+    values = np.column_stack(((1 - u) ** 3, 3 * u ** 3 - 6 * u ** 2 + 4, -3 * u ** 3 + 3 * u ** 2 + 3 * u + 1,
+                              u ** 3)) / 6.0
+    return index, values
+
+
+class _Basis(object):
+    """Design matrix of continuum model on one grid, shared by all spectra of the grid."""
+
+    def __init__(self, wave, method, order):
+        self.wave_min, self.wave_max = wave[0], wave[-1]
+        self.method = method
+        self.order = order
+        x = self.scaled(wave)
+        if method == 'chebyshev':
+            self.size = order + 1
+            self.vander = np.polynomial.chebyshev.chebvander(x, order)
+            self.products = (self.vander[:, :, np.newaxis] * self.vander[:, np.newaxis, :]).reshape(wave.size, -1)
+        elif method == 'spline':
+            self.size = order + 3
+            index, values = _spline_basis(x, order)
+            # every point touches 4 basis functions, 16 products, sparse matrices keep cost linear in points
+            offsets = np.arange(4)
+            points = np.repeat(np.arange(wave.size), 4)
+            self.design = sparse.csr_matrix((values.ravel(), (points, (index[:, np.newaxis] + offsets).ravel())),
+                                            shape=(wave.size, self.size))
+            columns = (index[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis]) * self.size + \
+                      (index[:, np.newaxis, np.newaxis] + offsets)
+            products = values[:, :, np.newaxis] * values[:, np.newaxis, :]
+            self.products = sparse.csr_matrix((products.ravel(), (np.repeat(np.arange(wave.size), 16),
+                                                                 columns.ravel())),
+                                              shape=(wave.size, self.size ** 2))
+        else:
+            raise ValueError("method must be one of %s" % ', '.join(METHODS))
+
+    def scaled(self, wave):
+        x = (np.asarray(wave, dtype=np.float64) - self.wave_min) / (self.wave_max - self.wave_min)
+        return 2 * x - 1 if self.method == 'chebyshev' else x
+
+    def normal_equations(self, weight, fluxes):
+        """
+        :return: (A, b) of weighted least squares for all spectra, shapes (spectra, size, size) and (spectra, size)
+        """
+        spectra = weight.shape[0]
+        if self.method == 'chebyshev':
+            matrix = np.dot(weight, self.products).reshape(spectra, self.size, self.size)
+            return matrix, np.dot(weight * fluxes, self.vander)
+        matrix = np.asarray(self.products.T.dot(weight.T)).T.reshape(spectra, self.size, self.size)
+        return matrix, np.asarray(self.design.T.dot((weight * fluxes).T)).T
+
+    def point_rows(self, wave):
+        """
+        :return: full design matrix rows at wave, np.array (points, size)
+        """
+        x = self.scaled(wave)
+        if self.method == 'chebyshev':
+            return np.polynomial.chebyshev.chebvander(x, self.order)
+        index, values = _spline_basis(x, self.order)
+        rows = np.zeros((x.size, self.size))
+        for a in range(4):
+            rows[np.arange(x.size), index + a] = values[:, a]
+        return rows
+
+    def evaluate(self, coefficients):
+        """
+        :param coefficients: np.array (spectra, size)
+        :return: continua on grid, np.array (spectra, points)
+        """
+        if self.method == 'chebyshev':
+            return np.dot(coefficients, self.vander.T)
+        return np.asarray(self.design.dot(coefficients.T)).T
+
+
+def _solve(basis, weight, fluxes, anchor_rows, anchor_fluxes):
+    """
+    Weighted least squares with anchors carrying as much weight as all points of spectrum
+    :return: coefficients, np.array (spectra, size)
+    """
+    matrix, vector = basis.normal_equations(weight, fluxes)
+    if anchor_rows.shape[0]:
+        anchor_weight = np.maximum(np.sum(weight, axis=1), 1.0) / anchor_rows.shape[0]
+        matrix += anchor_weight[:, np.newaxis, np.newaxis] * np.dot(anchor_rows.T, anchor_rows)
+        vector += anchor_weight[:, np.newaxis] * np.dot(anchor_rows.T, anchor_fluxes)
+    # smoothness penalty keeps pieces without points (masked lines, gaps) solvable
+    scale = np.maximum(np.trace(matrix, axis1=1, axis2=2) / basis.size, 1e-300)
+    difference = np.diff(np.eye(basis.size), 2, axis=0)
+    penalty = np.dot(difference.T, difference) + 1e-6 * np.eye(basis.size)
+    matrix += 1e-6 * scale[:, np.newaxis, np.newaxis] * penalty
+    return np.linalg.solve(matrix, vector[..., np.newaxis])[..., 0]
+
+
+def fit_continuum(wave, fluxes, method='chebyshev', order=5, low=2.0, high=3.0, iterations=10,
+                  intervals=(), anchors=()):
+    """
+    Fit continua of spectra on one grid
+    :param wave: ascending wavelength array
+    :param fluxes: flux array or np.array (spectra, wave.size)
+    :param method: 'chebyshev' or 'spline'
+    :param order: polynomial degree or number of spline pieces
+    :param low: points more than low sigma below continuum are rejected
+    :param high: points more than high sigma above continuum are rejected
+    :param iterations: maximum number of clipping iterations
+    :param intervals: masked windows, see mask_intervals
+    :param anchors: ((wave, flux), ...) points continuum must pass near
+    :return: continuum array of fluxes shape
+    """
+    wave = np.asarray(wave, dtype=np.float64)
+    fluxes = np.asarray(fluxes, dtype=np.float64)
+    single = fluxes.ndim == 1
+    fluxes = np.atleast_2d(fluxes)
+    basis = _Basis(wave, method, order)
+
+    anchors = np.asarray(anchors, dtype=np.float64).reshape(-1, 2)
+    anchors = anchors[(anchors[:, 0] >= wave[0]) & (anchors[:, 0] <= wave[-1])]
+    anchor_rows = basis.point_rows(anchors[:, 0])
+
+    finite = np.isfinite(fluxes)
+    base = finite & ~interval_mask(wave, intervals)[np.newaxis, :]
+    fluxes = np.where(finite, fluxes, 0.0)
+    used = base
+    for iteration in range(iterations + 1):
+        continua = basis.evaluate(_solve(basis, used.astype(np.float64), fluxes, anchor_rows, anchors[:, 1]))
+        if iteration == iterations:
+            break
+        residual = fluxes - continua
+        points = np.maximum(np.sum(used, axis=1) - basis.size, 1)
+        sigma = np.sqrt(np.sum(np.where(used, residual, 0.0) ** 2, axis=1) / points)[:, np.newaxis]
+        clipped = base & (residual >= -low * sigma) & (residual <= high * sigma)
+        if np.array_equal(clipped, used):
+            break
+        used = clipped
+    return continua[0] if single else continua
+
+
+def _fit_task(task):
+    wave, fluxes, options = task
+    return fit_continuum(wave, fluxes, **options)
+
+
+def fit_spectra(spectra, processes=None, **options):
+    """
+    Fit continua of many spectra, spectra on the same grid are fitted together
+    :param spectra: list of (wave, flux)
+    :param processes: pool size for groups on different grids, all cores by default, 1 to run in this process
+    :param options: fit_continuum parameters
+    :return: list of continuum arrays in order of spectra
+    """
+    waves = [np.asarray(wave, dtype=np.float64) for wave, flux in spectra]
+    groups = Rebin.same_grid_groups(waves)
+    tasks = [(waves[group[0]], np.vstack([spectra[index][1] for index in group]), options) for group in groups]
+    if processes == 1 or len(tasks) <= 1:
+        results = [_fit_task(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_fit_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    continua = [None] * len(spectra)
+    for group, result in zip(groups, results):
+        for row, index in enumerate(group):
+            continua[index] = result[row]
+    return continua
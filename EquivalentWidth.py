@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Batch equivalent widths and line fluxes.
+Flux is integrated by cumulative trapezoid once per spectrum, integral over any window
+is difference of cumulative integral at its edges (exact for partial pixels), so every line
+of catalog in every spectrum on one grid is measured in one numpy step.
+Continuum is 1 for normalized spectra or linear between mean fluxes of side bands.
+
+Example:
+    python EquivalentWidth.py lines/Dib_all.dat spectrum1.txt spectrum2.txt --width 6 --output ew.txt
+"""
+
+import argparse
+import sys
+import numpy as np
+
+import Coadd
+import LineCatalog
+import Rebin
+
+EW_DTYPE = [('spectrum', object), ('line', np.float64), ('label', object),
+            ('ew', np.float64), ('ew_error', np.float64), ('flux', np.float64), ('flux_error', np.float64),
+            ('continuum', np.float64), ('points', np.int64), ('success', bool)]
+
+
+def cumulative_trapezoid(wave, values):
+    """
+    :param values: np.array (spectra, wave.size)
+    :return: integrals from wave[0] to every point, np.array (spectra, wave.size)
+    """
+    cumulative = np.zeros(values.shape)
+    np.cumsum(0.5 * (values[:, 1:] + values[:, :-1]) * np.diff(wave), axis=1, out=cumulative[:, 1:])
+    return cumulative
+
+
+def integral_to(wave, values, cumulative, x):
+    """
+    Integral of piecewise linear values from wave[0] to x, partial pixels are integrated exactly
+    :param x: points inside wave range, np.array (lines,)
+    :return: np.array (spectra, lines)
+    """
+    index = np.clip(np.searchsorted(wave, x, 'right') - 1, 0, wave.size - 2)
+    step = wave[index + 1] - wave[index]
+    dx = np.clip(x - wave[index], 0.0, step)
+    left, right = values[:, index], values[:, index + 1]
+    return cumulative[:, index] + left * dx + 0.5 * (right - left) / step * dx ** 2
+
+
+def measure_grid(wave, fluxes, line_waves, width, band=None, normalized=False):
+    """
+    Equivalent widths of lines in spectra on one grid
+    :param wave: ascending wavelength array
+    :param fluxes: np.array (spectra, wave.size)
+    :param line_waves: line centers
+    :param width: integration window, Angstrom
+    :param band: width of continuum bands on both sides of window, width / 2 by default
+    :param normalized: continuum is 1, side bands are not used
+    :return: dict of np.arrays (spectra, lines): ew, ew_error, flux, flux_error, continuum, points, success
+        and covered, whether windows are inside spectrum, errors are NaN if noise can't be estimated
+    """
+    wave = np.asarray(wave, dtype=np.float64)
+    fluxes = np.atleast_2d(np.asarray(fluxes, dtype=np.float64))
+    line_waves = np.asarray(line_waves, dtype=np.float64)
+    band = 0.5 * width if band is None else band
+    start, end = line_waves - 0.5 * width, line_waves + 0.5 * width
+    outer_start, outer_end = (start, end) if normalized else (start - band, end + band)
+    covered = (outer_start >= wave[0]) & (outer_end <= wave[-1])
+    finite = np.isfinite(fluxes)
+    values = np.where(finite, fluxes, 0.0)
+    cumulative = cumulative_trapezoid(wave, values)
+    missing = (~finite).astype(np.float64)
+    missing_cumulative = cumulative_trapezoid(wave, missing)
+
+    def integral(left, right, values=values, cumulative=cumulative):
+        return integral_to(wave, values, cumulative, np.clip(right, wave[0], wave[-1])) - \
+            integral_to(wave, values, cumulative, np.clip(left, wave[0], wave[-1]))
+
+    line_integral = integral(start, end)
+    points = np.searchsorted(wave, end, 'right') - np.searchsorted(wave, start, 'left')
+    # NaN pixels spoil windows they touch
+    spoiled = integral(outer_start, outer_end, missing, missing_cumulative) > 0
+
+    # noiseless (model) spectra get NaN errors
+    noise = np.array([np.sqrt(Coadd.noise_variance(flux, fallback=np.nan)) for flux in fluxes])[:, np.newaxis]
+    pixel_step = width / np.maximum(points, 1)
+    if normalized:
+        continuum = np.ones_like(line_integral)
+        continuum_integral = np.full_like(line_integral, width)
+        continuum_error = np.zeros_like(line_integral)
+    else:
+        left_mean = integral(start - band, start) / band
+        right_mean = integral(end, end + band) / band
+        continuum = 0.5 * (left_mean + right_mean)
+        # linear continuum between band centers integrates to width times its value at line center
+        continuum_integral = width * continuum
+        band_points = np.searchsorted(wave, start, 'left') - np.searchsorted(wave, start - band, 'left') + \
+            np.searchsorted(wave, end + band, 'right') - np.searchsorted(wave, end, 'right')
+        continuum_error = noise / np.sqrt(np.maximum(band_points, 1))
+
+    flux = line_integral - continuum_integral
+    flux_error = np.sqrt(noise ** 2 * points * pixel_step ** 2 + (width * continuum_error) ** 2)
+    success = covered & ~spoiled & (points > 1) & (continuum > 0)
+    safe_continuum = np.where(success, continuum, 1.0)
+    return {'ew': np.where(success, -flux / safe_continuum, np.nan),
+            'ew_error': np.where(success, flux_error / safe_continuum, np.nan),
+            'flux': np.where(success, flux, np.nan),
+            'flux_error': np.where(success, flux_error, np.nan),
+            'continuum': np.where(success, continuum, np.nan),
+            'points': np.broadcast_to(points, flux.shape),
+            'success': success,
+            'covered': np.broadcast_to(covered, flux.shape)}
+
+
+def measure_spectra(spectra, line_waves, labels=None, width=5.0, band=None, normalized=False, covered_only=True,
+                    report=None):
+    """
+    Equivalent widths of catalog lines in many spectra, spectra on one grid are measured together
+    :param spectra: list of (name, wave, flux), wavelengths in any order
+    :param line_waves: line centers
+    :param labels: line labels, '' by default
+    :param width: integration window, Angstrom
+    :param band: width of continuum bands, see measure_grid
+    :param normalized: spectra are continuum-normalized
+    :param covered_only: skip lines whose windows are outside spectrum
+    :param report: progress callback
+    :return: structured array EW_DTYPE ordered by spectrum and line, positive ew for absorption
+    """
+    line_waves = np.asarray(line_waves, dtype=np.float64)
+    labels = np.array([''] * line_waves.size, dtype=object) if labels is None else np.asarray(labels, dtype=object)
+    spectra = [(name,) + Rebin.ascending(wave, flux)[:2] for name, wave, flux in spectra]
+    waves = [wave for name, wave, flux in spectra]
+    tables = [None] * len(spectra)
+    groups = Rebin.same_grid_groups(waves)
+    for done, group in enumerate(groups):
+        fluxes = np.vstack([spectra[index][2] for index in group])
+        result = measure_grid(waves[group[0]], fluxes, line_waves, width, band, normalized)
+        for row, index in enumerate(group):
+            table = np.zeros(line_waves.size, dtype=EW_DTYPE)
+            table['spectrum'] = spectra[index][0]
+            table['line'] = line_waves
+            table['label'] = labels
+            for name in ('ew', 'ew_error', 'flux', 'flux_error', 'continuum', 'points', 'success'):
+                table[name] = result[name][row]
+            if covered_only:
+                table = table[result['covered'][row]]
+            tables[index] = table
+        if report is not None:
+            report(float(done + 1) / len(groups))
+    return np.concatenate([np.zeros(0, dtype=EW_DTYPE)] + tables)
+
+
+def format_table(table):
+    """
+    :param table: measure_spectra result
+    :return: text table
+    """
+    lines = ['# spectrum line label ew ew_error flux flux_error continuum points success']
+    for row in table:
+        label = row['label'].decode('latin-1') if isinstance(row['label'], bytes) else row['label']
+        lines.append('%s %0.3f "%s" %0.5f %0.5f %0.6e %0.6e %0.6e %d %d' % (
+            row['spectrum'], row['line'], label, row['ew'], row['ew_error'], row['flux'], row['flux_error'],
+            row['continuum'], row['points'], row['success']))
+    return '\n'.join(lines)
+
+
+def write_table(file_name, table):
+    """
+    Write measure_spectra result as text table
+    """
+    with open(file_name, 'w') as table_file:
+        table_file.write(format_table(table) + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Equivalent widths of catalog lines in two-column spectra')
+    parser.add_argument('catalog', help='line list, any format of lines/')
+    parser.add_argument('spectra', nargs='+', help='two-column tables')
+    parser.add_argument('--width', type=float, default=5.0, help='integration window, Angstrom')
+    parser.add_argument('--normalized', action='store_true', help='spectra are continuum-normalized')
+    parser.add_argument('--output', help='table file, printed if not given')
+    args = parser.parse_args(argv)
+
+    catalog = LineCatalog.load_catalog_file(args.catalog)
+    spectra = []
+    for file_name in args.spectra:
+        data = np.loadtxt(file_name)
+        spectra.append((file_name, data[:, 0], data[:, 1]))
+    table = measure_spectra(spectra, catalog['wave'], catalog['label'], args.width, normalized=args.normalized)
+    if args.output:
+        write_table(args.output, table)
+    else:
+        print(format_table(table))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Interstellar extinction on spectrum grids.
+Fitzpatrick (1999) curve A(lambda) / E(B-V) is computed once per grid and R_V and cached,
+dereddening for any number of Av values is then one broadcasted product.
+Av scans score dereddened spectrum against model by scatter of their log ratio with free scale,
+which is quadratic in Av, so the whole Av grid and the best Av come from a few sums.
+"""
+
+import numpy as np
+from PyAstronomy import pyasl
+
+import Rebin
+
+DEFAULT_R_V = 3.1
+
+SCAN_DTYPE = [('r_v', np.float64), ('a_v', np.float64), ('rms', np.float64), ('best', bool)]
+
+_curve_cache = {}
+_MAX_CACHED = 32
+_LN_10 = np.log(10.0)
+
+
+def extinction_curve(wave, r_v=DEFAULT_R_V):
+    """
+    Fitzpatrick (1999) extinction curve, cached by grid and R_V
+    :param wave: wavelength array, Angstrom
+    :param r_v: ratio of total to selective extinction
+    :return: A(lambda) / E(B-V) on wave, read-only
+    """
+    wave = np.ascontiguousarray(wave, dtype=np.float64)
+    key = (round(float(r_v), 9), Rebin.grid_key(wave))
+    curve = _curve_cache.get(key)
+    if curve is None:
+        # astrolib unred of unit flux for E(B-V) = 1 is 10 ** (0.4 * A(lambda) / E(B-V))
+        curve = 2.5 * np.log10(pyasl.unred(wave, np.ones(wave.size), 1.0, R_V=float(r_v)))
+        curve.setflags(write=False)
+        if len(_curve_cache) >= _MAX_CACHED:
+            _curve_cache.clear()
+        _curve_cache[key] = curve
+    return curve
+
+
+def deredden(wave, flux, a_v, r_v=DEFAULT_R_V):
+    """
+    Deredden flux for E(B-V) = Av / R_V, negative Av reddens
+    :param wave: wavelength array, Angstrom
+    :param flux: flux array
+    :param a_v: Av, number or array
+    :param r_v: R_V, number or array broadcastable with a_v
+    :return: dereddened flux, np.array (a_v.shape..., wave.size) for array a_v or r_v
+    """
+    a_v, r_v = np.broadcast_arrays(np.asarray(a_v, dtype=np.float64), np.asarray(r_v, dtype=np.float64))
+    flux = np.asarray(flux, dtype=np.float64)
+    exponent = np.empty(a_v.shape + (flux.size,))
+    for value in np.unique(r_v):
+        rows = r_v == value
+        exponent[rows] = (0.4 * a_v[rows] / value)[..., np.newaxis] * extinction_curve(wave, value)
+    return flux * 10 ** exponent
+
+
+def scan(wave, flux, model_wave, model_flux, a_v_values, r_v_values=(DEFAULT_R_V,)):
+    """
+    Score dereddened spectrum against model over grid of Av and R_V.
+    Score is rms of log10(dereddened flux / model) around its mean, in dex,
+    points with non-positive flux or outside model are skipped.
+    :param wave: ascending spectrum wavelengths
+    :param flux: observed flux
+    :param model_wave: ascending model wavelengths, model is interpolated to spectrum grid
+    :param model_flux: model flux, any scale
+    :param a_v_values: scanned Av
+    :param r_v_values: scanned R_V
+    :return: structured array SCAN_DTYPE, rows for every (R_V, Av) followed by exact best Av
+        for every R_V inside scanned Av range, marked best
+    """
+    wave = np.asarray(wave, dtype=np.float64)
+    flux = np.asarray(flux, dtype=np.float64)
+    a_v_values = np.asarray(a_v_values, dtype=np.float64)
+    r_v_values = np.atleast_1d(np.asarray(r_v_values, dtype=np.float64))
+
+    inside = (wave >= model_wave[0]) & (wave <= model_wave[-1])
+    model = np.interp(wave, model_wave, model_flux)
+    with np.errstate(invalid='ignore'):
+        good = inside & np.isfinite(flux) & (flux > 0) & (model > 0)
+    if np.sum(good) < 2:
+        raise ValueError("Spectrum does not overlap model")
+    # log(dereddened / model) = ratio + Av * slope, its variance is quadratic in Av
+    ratio = np.log(flux[good] / model[good])
+    ratio -= np.mean(ratio)
+
+    table = np.zeros(r_v_values.size * (a_v_values.size + 1), dtype=SCAN_DTYPE)
+    for index, r_v in enumerate(r_v_values):
+        slope = 0.4 * _LN_10 / r_v * extinction_curve(wave, r_v)[good]
+        slope -= np.mean(slope)
+        variance_ratio = np.mean(ratio ** 2)
+        covariance = np.mean(ratio * slope)
+        variance_slope = np.mean(slope ** 2)
+
+        def rms(a_v):
+            variance = variance_ratio + 2 * a_v * covariance + a_v ** 2 * variance_slope
+            return np.sqrt(np.maximum(variance, 0.0)) / _LN_10
+
+        rows = table[index * a_v_values.size:(index + 1) * a_v_values.size]
+        rows['r_v'] = r_v
+        rows['a_v'] = a_v_values
+        rows['rms'] = rms(a_v_values)
+        best_a_v = -covariance / variance_slope if variance_slope > 0 else a_v_values[0]
+        best_a_v = np.clip(best_a_v, np.min(a_v_values), np.max(a_v_values))
+        table[r_v_values.size * a_v_values.size + index] = (r_v, best_a_v, rms(best_a_v), True)
+    return table
+
+
+def format_table(table):
+    """
+    :param table: scan result
+    :return: text table
+    """
+    lines = ['# r_v a_v rms_dex best']
+    for row in table:
+        lines.append('%0.3f %0.4f %0.6f %d' % (row['r_v'], row['a_v'], row['rms'], row['best']))
+    return '\n'.join(lines)
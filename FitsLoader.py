@@ -0,0 +1,228 @@
+"""
+FITS spectra loading with memory mapping.
+Every image HDU row (echelle order) and every table HDU with wavelength and flux columns is a spectrum.
+Wavelengths come from linear or logarithmic WCS keywords, IRAF multispec WAT keywords
+or wavelength extension of the same shape. Only requested order and wavelength slice
+are read from disk, the rest of file is never touched.
+"""
+
+import re
+from collections import namedtuple
+import numpy as np
+from astropy.io import fits
+
+SpectrumLocation = namedtuple('SpectrumLocation', ['hdu', 'order', 'size', 'label'])
+
+WAVE_COLUMNS = ('WAVE', 'WAVELENGTH', 'LAMBDA', 'LOGLAM', 'WAVE_AIR', 'WAVE_VAC')
+FLUX_COLUMNS = ('FLUX', 'FLUX_REDUCED', 'FLUX_NORM', 'SPEC', 'DATA', 'COUNTS')
+
+_WAVE_EXTENSION_RE = re.compile(r'WAVE', re.IGNORECASE)
+_SPEC_RE = re.compile(r'spec(\d+)\s*=\s*"([^"]*)"')
+
+
+def _open(file_name):
+    return fits.open(file_name, memmap=True, do_not_scale_image_data=True)
+
+
+def _column(names, candidates):
+    upper = [name.upper() for name in names]
+    for candidate in candidates:
+        if candidate in upper:
+            return names[upper.index(candidate)]
+    return None
+
+
+def _image_shape(header):
+    """
+    :return: (orders, points) of image HDU, (0, 0) if there is no data
+    """
+    axes = header.get('NAXIS', 0)
+    if axes == 0:
+        return 0, 0
+    points = header['NAXIS1']
+    orders = 1
+    if axes >= 2:
+        orders = header['NAXIS2']
+    return orders, points
+
+
+def _is_wave_extension(hdu):
+    return bool(_WAVE_EXTENSION_RE.search(hdu.name)) and isinstance(hdu, (fits.ImageHDU, fits.PrimaryHDU))
+
+
+def find_spectra(file_name):
+    """
+    List spectra of file reading headers only
+    :param file_name: FITS filename
+    :return: list of SpectrumLocation
+    """
+    spectra = []
+    with _open(file_name) as hdu_list:
+        for index, hdu in enumerate(hdu_list):
+            name = hdu.name or 'EXT'
+            if isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)):
+                if _is_wave_extension(hdu):
+                    continue
+                orders, points = _image_shape(hdu.header)
+                for order in range(orders if points > 1 else 0):
+                    label = '%d %s' % (index, name) if orders == 1 else '%d %s order %d' % (index, name, order + 1)
+                    spectra.append(SpectrumLocation(index, order, points, label))
+            elif isinstance(hdu, fits.BinTableHDU):
+                names = hdu.columns.names
+                wave_column = _column(names, WAVE_COLUMNS)
+                flux_column = _column(names, FLUX_COLUMNS)
+                if wave_column is None or flux_column is None:
+                    continue
+                repeat = hdu.columns[flux_column].format.repeat
+                rows = hdu.header['NAXIS2']
+                if repeat > 1:
+                    # spectrum per row in array cells
+                    for order in range(rows):
+                        label = '%d %s' % (index, name) if rows == 1 else '%d %s row %d' % (index, name, order + 1)
+                        spectra.append(SpectrumLocation(index, order, repeat, label))
+                elif rows > 1:
+                    spectra.append(SpectrumLocation(index, 0, rows, '%d %s' % (index, name)))
+    return spectra
+
+
+def _multispec_parameters(header, order):
+    """
+    Parameters of order from IRAF multispec WAT2 keywords
+    :return: list of floats of 'specN' record or None
+    """
+    wat = ''.join(header.get('WAT2_%03d' % index, '').ljust(68)
+                  for index in range(1, 1000) if 'WAT2_%03d' % index in header)
+    for match in _SPEC_RE.finditer(wat):
+        if int(match.group(1)) == order + 1:
+            return [float(value) for value in match.group(2).split()]
+    return None
+
+
+def _multispec_wave(parameters, pixels):
+    """
+    Wavelengths of IRAF multispec order, linear, log-linear and Chebyshev/Legendre dispersion
+    :param parameters: 'specN' record: ap beam dtype w1 dw nw z aplow aphigh [function]
+    :param pixels: 1-based pixel numbers
+    """
+    dispersion_type, w1, dw, z = int(parameters[2]), parameters[3], parameters[4], parameters[6]
+    if dispersion_type in (0, 1):
+        wave = w1 + dw * (pixels - 1)
+        if dispersion_type == 1:
+            wave = 10 ** wave
+        return wave / (1 + z)
+    if dispersion_type == 2:
+        weight, offset, function_type, order = parameters[9], parameters[10], int(parameters[11]), int(parameters[12])
+        p_min, p_max = parameters[13], parameters[14]
+        coefficients = parameters[15:15 + order]
+        normalized = (2 * pixels - (p_max + p_min)) / (p_max - p_min)
+        if function_type == 1:
+            wave = np.polynomial.chebyshev.chebval(normalized, coefficients)
+        elif function_type == 2:
+            wave = np.polynomial.legendre.legval(normalized, coefficients)
+        else:
+            raise ValueError("Unsupported multispec dispersion function %d" % function_type)
+        return weight * (offset + wave) / (1 + z)
+    raise ValueError("Unsupported multispec dispersion type %d" % dispersion_type)
+
+
+def wcs_wave(header, order, pixels):
+    """
+    Wavelengths of pixels from header
+    :param header: image HDU header
+    :param order: row of image
+    :param pixels: 0-based pixel indexes
+    :return: wavelength array
+    """
+    pixel_numbers = np.asarray(pixels, dtype=np.float64) + 1
+    if 'multispec' in header.get('WAT0_001', ''):
+        parameters = _multispec_parameters(header, order)
+        if parameters is not None:
+            return _multispec_wave(parameters, pixel_numbers)
+    reference = header.get('CRVAL1', 0.0)
+    step = header.get('CDELT1', header.get('CD1_1', 1.0))
+    reference_pixel = header.get('CRPIX1', 1.0)
+    wave = reference + step * (pixel_numbers - reference_pixel)
+    ctype = header.get('CTYPE1', '').upper()
+    if header.get('DC-FLAG', 0) == 1:
+        wave = 10 ** wave
+    elif ctype.endswith('-LOG'):
+        wave = reference * np.exp(step * (pixel_numbers - reference_pixel) / reference)
+    return wave
+
+
+def _scaled(hdu, data):
+    scale = hdu.header.get('BSCALE', 1.0)
+    zero = hdu.header.get('BZERO', 0.0)
+    data = np.asarray(data, dtype=np.float64)
+    if scale != 1.0 or zero != 0.0:
+        data = data * scale + zero
+    return data
+
+
+def _wave_extension(hdu_list, shape):
+    """
+    :return: wavelength image HDU of the same shape or None
+    """
+    for hdu in hdu_list:
+        if _is_wave_extension(hdu) and _image_shape(hdu.header) == shape:
+            return hdu
+    return None
+
+
+def _slice(wave, wave_min, wave_max):
+    """
+    :return: slice of ascending or descending wave inside limits
+    """
+    descending = wave.size > 1 and wave[0] > wave[-1]
+    ascending_wave = wave[::-1] if descending else wave
+    start = 0 if wave_min is None else np.searchsorted(ascending_wave, wave_min, 'left')
+    stop = wave.size if wave_max is None else np.searchsorted(ascending_wave, wave_max, 'right')
+    if descending:
+        start, stop = wave.size - stop, wave.size - start
+    return slice(start, stop)
+
+
+def _image_row(hdu, order):
+    data = hdu.data
+    while data.ndim > 2:
+        # multispec bands, first band is the spectrum
+        data = data[0]
+    return data if data.ndim == 1 else data[order]
+
+
+def read_spectrum(file_name, hdu=0, order=0, wave_min=None, wave_max=None):
+    """
+    Read one spectrum, only its wavelength slice is read from disk
+    :param file_name: FITS filename
+    :param hdu: HDU index, see find_spectra
+    :param order: image row or table row
+    :param wave_min: left limit, Angstrom, whole spectrum if None
+    :param wave_max: right limit, Angstrom
+    :return: (wave, flux) ascending in wavelength
+    """
+    with _open(file_name) as hdu_list:
+        spectrum_hdu = hdu_list[hdu]
+        if isinstance(spectrum_hdu, fits.BinTableHDU):
+            names = spectrum_hdu.columns.names
+            wave_column = spectrum_hdu.data[_column(names, WAVE_COLUMNS)]
+            flux_column = spectrum_hdu.data[_column(names, FLUX_COLUMNS)]
+            if spectrum_hdu.columns[_column(names, FLUX_COLUMNS)].format.repeat > 1:
+                wave_column, flux_column = wave_column[order], flux_column[order]
+            wave = np.array(wave_column, dtype=np.float64)
+            if _column(names, WAVE_COLUMNS).upper() == 'LOGLAM':
+                wave = 10 ** wave
+            window = _slice(wave, wave_min, wave_max)
+            wave, flux = wave[window], np.array(flux_column[window], dtype=np.float64)
+        else:
+            orders, points = _image_shape(spectrum_hdu.header)
+            wave_hdu = _wave_extension(hdu_list, (orders, points))
+            if wave_hdu is not None:
+                wave = _scaled(wave_hdu, _image_row(wave_hdu, order))
+            else:
+                wave = wcs_wave(spectrum_hdu.header, order, np.arange(points))
+            window = _slice(wave, wave_min, wave_max)
+            wave = np.array(wave[window])
+            flux = _scaled(spectrum_hdu, _image_row(spectrum_hdu, order)[window])
+    if wave.size > 1 and wave[0] > wave[-1]:
+        wave, flux = wave[::-1], flux[::-1]
+    return wave, flux
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Ranking of model grid against observed spectrum.
+Models are resampled onto observed wavelength grid chunk by chunk,
+chi-square with optional mask and free scale factor is computed for whole chunk at once,
+chunks are distributed over process pool.
+
+Example:
+    python GridFit.py observed.fits processed/ --window 4400 4950 --top 20
+"""
+
+import os
+import sys
+import argparse
+import multiprocessing
+import numpy as np
+
+import CmfgenParse
+
+RESULT_DTYPE = [('model', object), ('chi2', np.float64), ('reduced_chi2', np.float64),
+                ('scale', np.float64), ('points', np.int64)]
+
+
+def load_model_file(file_name):
+    """
+    Load model spectrum: table from CmfgenBatch (*.data) or raw CMFGEN model
+    :param file_name: model filename
+    :return: (wave, flux) with ascending wave
+    """
+    if file_name.endswith('.data'):
+        data = np.loadtxt(file_name)
+    else:
+        data = CmfgenParse.load_model(file_name)
+    if data[0, 0] > data[-1, 0]:
+        data = data[::-1]
+    return data[:, 0], data[:, 1]
+
+
+def find_model_files(models_dir, pattern='.data'):
+    """
+    :param models_dir: root of processed grid
+    :param pattern: filename suffix of models
+    :return: sorted list of model paths
+    """
+    model_files = []
+    for directory, subdirectories, files in os.walk(models_dir):
+        model_files.extend(os.path.join(directory, name) for name in files if name.endswith(pattern))
+    model_files.sort()
+    return model_files
+
+
+def resample_models(waves, fluxes, new_wave):
+    """
+    Linear interpolation of many spectra with own grids onto one grid in one step.
+    All spectra are shifted apart along wavelength axis and concatenated,
+    so single searchsorted finds neighbours for every model and every point.
+    :param waves: list of ascending wavelength arrays
+    :param fluxes: list of flux arrays
+    :param new_wave: ascending target grid
+    :return: np.array (models, new_wave.size), NaN outside model range
+    """
+    lengths = np.array([wave.size for wave in waves])
+    origin = min(np.min(new_wave), min(wave[0] for wave in waves))
+    span = max(np.max(new_wave), max(wave[-1] for wave in waves)) - origin + 1.0
+    shifts = np.arange(len(waves)) * span
+
+    flat_wave = np.concatenate(waves) - origin + np.repeat(shifts, lengths)
+    flat_flux = np.concatenate(fluxes)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+
+    query = (new_wave - origin)[np.newaxis, :] + shifts[:, np.newaxis]
+    right = np.searchsorted(flat_wave, query, 'right')
+    right = np.clip(right, (starts + 1)[:, np.newaxis], (ends - 1)[:, np.newaxis])
+    left = right - 1
+
+    step = flat_wave[right] - flat_wave[left]
+    weight = (query - flat_wave[left]) / np.where(step > 0, step, 1.0)
+    resampled = flat_flux[left] + weight * (flat_flux[right] - flat_flux[left])
+
+    inside = (query >= flat_wave[starts][:, np.newaxis]) & (query <= flat_wave[ends - 1][:, np.newaxis])
+    inside &= (lengths > 1)[:, np.newaxis]
+    resampled[~inside] = np.nan
+    return resampled
+
+
+def chi_square(flux, models, sigma=None, mask=None, fit_scale=True):
+    """
+    Chi-square of observed spectrum for stack of models on the same grid
+    :param flux: observed flux, shape (points,)
+    :param models: model fluxes, shape (models, points), NaN points are ignored
+    :param sigma: flux errors, unit weights if None
+    :param mask: boolean array, False points are ignored
+    :param fit_scale: fit best scale factor for each model analytically
+    :return: (chi2, reduced_chi2, scale, points) arrays of shape (models,)
+    """
+    weight = np.ones(flux.size) if sigma is None else 1.0 / sigma ** 2
+    if mask is not None:
+        weight = np.where(mask, weight, 0.0)
+    weight = np.where(np.isfinite(flux), weight, 0.0)
+    flux = np.nan_to_num(flux)
+
+    weights = np.where(np.isfinite(models), weight[np.newaxis, :], 0.0)
+    models = np.where(weights > 0, models, 0.0)
+
+    if fit_scale:
+        denominator = np.sum(weights * models ** 2, axis=1)
+        scale = np.sum(weights * models * flux, axis=1) / np.where(denominator > 0, denominator, 1.0)
+    else:
+        scale = np.ones(models.shape[0])
+
+    chi2 = np.sum(weights * (flux - scale[:, np.newaxis] * models) ** 2, axis=1)
+    points = np.sum(weights > 0, axis=1)
+    degrees = points - (1 if fit_scale else 0)
+    reduced_chi2 = np.where(degrees > 0, chi2 / np.maximum(degrees, 1), np.inf)
+    return chi2, reduced_chi2, scale, points
+
+
+def mask_from_windows(wave, windows):
+    """
+    :param wave: wavelength grid
+    :param windows: list of (wave_min, wave_max) to include
+    :return: boolean mask
+    """
+    mask = np.zeros(wave.size, dtype=bool)
+    for wave_min, wave_max in windows:
+        mask |= (wave >= wave_min) & (wave <= wave_max)
+    return mask
+
+
+_observed = {}
+
+
+def _init_worker(observed):
+    _observed.update(observed)
+
+
+def _fit_chunk(model_files):
+    """
+    Pool worker: load, resample and score chunk of models against _observed
+    :return: list of result tuples
+    """
+    waves, fluxes, loaded = [], [], []
+    for model_file in model_files:
+        try:
+            wave, flux = _observed['loader'](model_file)
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+        waves.append(wave)
+        fluxes.append(flux)
+        loaded.append(model_file)
+    if not loaded:
+        return []
+
+    models = resample_models(waves, fluxes, _observed['wave'])
+    chi2, reduced_chi2, scale, points = chi_square(_observed['flux'], models, _observed['sigma'],
+                                                   _observed['mask'], _observed['fit_scale'])
+    return list(zip(loaded, chi2, reduced_chi2, scale, points))
+
+
+def fit_grid(wave, flux, model_files, sigma=None, mask=None, fit_scale=True,
+             chunk_size=32, processes=None, loader=load_model_file, report=None):
+    """
+    Score observed spectrum against every model
+    :param wave: observed wavelength grid, ascending
+    :param flux: observed flux
+    :param model_files: list of model filenames
+    :param sigma: flux errors
+    :param mask: boolean array, False points are ignored
+    :param fit_scale: fit free scale factor
+    :param chunk_size: models resampled at once, memory is chunk_size * wave.size floats per worker
+    :param processes: pool size, all cores by default, 1 to run in this process
+    :param loader: function model filename -> (wave, flux), must be picklable
+    :param report: progress callback
+    :return: structured array RESULT_DTYPE sorted by reduced chi-square
+    """
+    observed = {'wave': np.asarray(wave, dtype=np.float64),
+                'flux': np.asarray(flux, dtype=np.float64),
+                'sigma': sigma, 'mask': mask, 'fit_scale': fit_scale, 'loader': loader}
+    chunks = [model_files[i:i + chunk_size] for i in range(0, len(model_files), chunk_size)]
+
+    rows = []
+    if processes == 1 or len(chunks) <= 1:
+        _init_worker(observed)
+        for done, chunk in enumerate(chunks):
+            rows.extend(_fit_chunk(chunk))
+            if report is not None:
+                report(float(done + 1) / len(chunks))
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (observed,))
+        try:
+            for done, chunk_rows in enumerate(pool.imap_unordered(_fit_chunk, chunks)):
+                rows.extend(chunk_rows)
+                if report is not None:
+                    report(float(done + 1) / len(chunks))
+        finally:
+            pool.close()
+            pool.join()
+
+    table = np.array(rows, dtype=RESULT_DTYPE)
+    return table[np.argsort(table['reduced_chi2'], kind='mergesort')]
+
+
+def format_table(table, top=None):
+    """
+    :param table: fit_grid result
+    :param top: number of best rows
+    :return: text table
+    """
+    lines = ['# rank reduced_chi2 chi2 scale points model']
+    for rank, row in enumerate(table[:top], 1):
+        lines.append('%d %0.6e %0.6e %0.6e %d %s' % (rank, row['reduced_chi2'], row['chi2'],
+                                                     row['scale'], row['points'], row['model']))
+    return '\n'.join(lines)
+
+
+def load_observed(file_name):
+    """
+    :param file_name: 1D FITS or two-column table
+    :return: (wave, flux)
+    """
+    if file_name.lower().endswith(('.fits', '.fit', '.fts')):
+        from PyAstronomy import pyasl
+        return pyasl.read1dFitsSpec(file_name)
+    data = np.loadtxt(file_name)
+    return data[:, 0], data[:, 1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rank model grid against observed spectrum.')
+    parser.add_argument('observed', help='observed spectrum, 1D FITS or two-column table')
+    parser.add_argument('models_dir', help='directory with processed models (CmfgenBatch output)')
+    parser.add_argument('--pattern', default='.data', help='model filename suffix (default: .data)')
+    parser.add_argument('--window', nargs=2, type=float, action='append', metavar=('WAVE_MIN', 'WAVE_MAX'),
+                        help='fit only inside window, can be repeated')
+    parser.add_argument('--no-scale', action='store_true', help='do not fit scale factor')
+    parser.add_argument('--chunk-size', type=int, default=32, help='models per chunk')
+    parser.add_argument('--processes', type=int, default=None, help='pool size (default: all cores)')
+    parser.add_argument('--top', type=int, default=None, help='print only best models')
+    parser.add_argument('--output', default=None, help='save ranked table to file')
+    args = parser.parse_args(argv)
+
+    wave, flux = load_observed(args.observed)
+    mask = mask_from_windows(wave, args.window) if args.window else None
+    table = fit_grid(wave, flux, find_model_files(args.models_dir, args.pattern), mask=mask,
+                     fit_scale=not args.no_scale, chunk_size=args.chunk_size, processes=args.processes)
+    text = format_table(table, args.top)
+    print(text)
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            output.write(format_table(table) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bulk reading of spectrum files.
+FITS files (every spectrum of file, see FitsLoader) and two-column tables
+are read on process pool and returned as they finish, so callers can show first files
+while the rest are still read.
+
+Example:
+    python Ingest.py night/
+"""
+
+import os
+import sys
+import multiprocessing
+import numpy as np
+
+import FitsLoader
+
+FITS_SUFFIXES = ('.fits', '.fit', '.fts', '.fits.gz', '.fit.gz')
+TABLE_SUFFIXES = ('.txt', '.dat', '.tab', '.asc', '.csv', '.spec')
+
+
+def is_fits_file(file_name):
+    return file_name.lower().endswith(FITS_SUFFIXES)
+
+
+def is_spectrum_file(file_name):
+    """
+    :return: True for FITS and table files, hidden and temporary files are skipped
+    """
+    name = os.path.basename(file_name)
+    if name.startswith('.') or name.endswith(('~', '.tmp', '.part')):
+        return False
+    return name.lower().endswith(FITS_SUFFIXES + TABLE_SUFFIXES)
+
+
+def find_spectrum_files(directory, recursive=False):
+    """
+    :param directory: directory with spectra
+    :param recursive: look into subdirectories
+    :return: sorted list of spectrum file paths
+    """
+    files = []
+    for root, subdirectories, names in os.walk(directory):
+        subdirectories[:] = [name for name in subdirectories if not name.startswith('.')] if recursive else []
+        files.extend(os.path.join(root, name) for name in names if is_spectrum_file(name))
+    files.sort()
+    return files
+
+
+def read_table(file_name):
+    """
+    Read first two columns of text table, '#' lines are comments.
+    Regular numeric tables are converted by np.fromstring in one call,
+    others fall back to np.loadtxt.
+    :return: (wave, flux)
+    """
+    with open(file_name, 'rb') as table_file:
+        lines = [line for line in table_file.read().replace(b',', b' ').splitlines()
+                 if line.strip() and not line.lstrip().startswith(b'#')]
+    if lines:
+        columns = len(lines[0].split())
+        values = np.fromstring(b' '.join(lines), sep=' ')
+        if columns >= 2 and values.size == columns * len(lines):
+            data = values.reshape(-1, columns)
+            return data[:, 0], data[:, 1]
+    delimiter = ',' if file_name.lower().endswith('.csv') else None
+    data = np.loadtxt(file_name, usecols=(0, 1), delimiter=delimiter, ndmin=2)
+    return data[:, 0], data[:, 1]
+
+
+def read_spectrum_file(file_name):
+    """
+    Read all spectra of file
+    :param file_name: FITS or table filename
+    :return: list of (name, wave, flux, fits_path), fits_path is None for tables
+    """
+    base_name = os.path.basename(file_name)
+    if not is_fits_file(file_name):
+        wave, flux = read_table(file_name)
+        return [(base_name, wave, flux, None)]
+    spectra = FitsLoader.find_spectra(file_name)
+    result = []
+    for spectrum in spectra:
+        wave, flux = FitsLoader.read_spectrum(file_name, spectrum.hdu, spectrum.order)
+        name = base_name if len(spectra) == 1 else '%s [%s]' % (base_name, spectrum.label)
+        result.append((name, wave, flux, file_name))
+    return result
+
+
+def read_file(file_name):
+    """
+    read_spectrum_file for pools and threads, errors are returned instead of raised
+    :return: (file_name, spectra, error message or None)
+    """
+    try:
+        return file_name, read_spectrum_file(file_name), None
+    except Exception as exception:
+        return file_name, [], '%s: %s' % (type(exception).__name__, exception)
+
+
+def ingest(files, processes=None):
+    """
+    Read files on process pool
+    :param files: list of filenames
+    :param processes: pool size, all cores by default, 1 to read in this process
+    :return: iterator over (file_name, spectra, error) in order of completion
+    """
+    if processes == 1 or len(files) <= 1:
+        for file_name in files:
+            yield read_file(file_name)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(read_file, files):
+            yield result
+        pool.close()
+    finally:
+        # also stops reading when caller abandons iterator
+        pool.terminate()
+        pool.join()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    files = []
+    for path in argv:
+        files.extend(find_spectrum_files(path) if os.path.isdir(path) else [path])
+    errors = 0
+    for file_name, spectra, error in ingest(files):
+        if error is not None:
+            errors += 1
+            print("%s: %s" % (file_name, error))
+        for name, wave, flux, fits_path in spectra:
+            print("%s %d points %0.2f-%0.2f" % (name, wave.size, np.min(wave), np.max(wave)))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
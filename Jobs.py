@@ -0,0 +1,233 @@
+from PyQt4.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+
+class JobCancelled(Exception):
+    """Raised inside job function by Job.report after cancel"""
+    pass
+
+
+class JobSignals(QObject):
+    """Signals of Job, QRunnable is not QObject and can't have own signals.
+    Signals are emitted from pool thread and delivered in GUI thread.
+    """
+    progress = pyqtSignal(object, float)
+    partial = pyqtSignal(object, object)
+    finished = pyqtSignal(object, object)
+    failed = pyqtSignal(object, str)
+    cancelled = pyqtSignal(object)
+
+
+class Job(QRunnable):
+    """Function call executed on thread pool.
+     Attributes:
+         name (str): text for status area.
+         fraction (float): last reported progress, None if job doesn't report it.
+         is_cancelled (bool): cancel was requested.
+    """
+
+    def __init__(self, name, function, args=(), kwargs=None):
+        QRunnable.__init__(self)
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.signals = JobSignals()
+        self.fraction = None
+        self.is_cancelled = False
+        self.batch = None
+        self.index = None
+
+    def cancel(self):
+        """
+        Request cancel, job stops at next report call or is dropped before start
+        """
+        self.is_cancelled = True
+
+    def report(self, fraction):
+        """
+        Progress callback for job function
+        :param fraction: done part, 0..1
+        """
+        if self.is_cancelled:
+            raise JobCancelled()
+        self.signals.progress.emit(self, fraction)
+
+    def deliver(self, result):
+        """
+        Partial result callback for job function, e.g. one file of many
+        :param result: passed to on_partial in GUI thread
+        """
+        if self.is_cancelled:
+            raise JobCancelled()
+        self.signals.partial.emit(self, result)
+
+    def run(self):
+        try:
+            if self.is_cancelled:
+                raise JobCancelled()
+            result = self.function(*self.args, **self.kwargs)
+            if self.is_cancelled:
+                raise JobCancelled()
+        except JobCancelled:
+            self.signals.cancelled.emit(self)
+            return
+        except Exception as exception:
+            self.signals.failed.emit(self, str(exception))
+            return
+        self.signals.finished.emit(self, result)
+
+
+class JobBatch(object):
+    """Jobs started together by JobManager.map, one job per item, shown as one entry in status area.
+     Attributes:
+         name (str): text for status area.
+         results (list): results in order of items, None for failed items.
+         remaining (int): jobs not finished yet.
+         is_cancelled (bool): some job was cancelled, on_result is not called.
+    """
+
+    def __init__(self, name, size, on_result=None):
+        self.name = name
+        self.results = [None] * size
+        self.remaining = size
+        self.on_result = on_result
+        self.is_cancelled = False
+
+    def fraction(self):
+        return 1.0 - float(self.remaining) / len(self.results)
+
+
+class JobManager(QObject):
+    """Runs jobs on thread pool and passes results to callbacks in GUI thread.
+     Attributes:
+         jobs (list): submitted and not finished jobs.
+    """
+    changed = pyqtSignal()
+
+    def __init__(self, parent=None, max_threads=None):
+        QObject.__init__(self, parent)
+        self.pool = QThreadPool(self)
+        if max_threads is not None:
+            self.pool.setMaxThreadCount(max_threads)
+        self.jobs = []
+
+    def submit(self, name, function, args=(), kwargs=None, on_result=None, on_error=None, report=False,
+               on_partial=None):
+        """
+        Start function(*args, **kwargs) on pool
+        :param name: text for status area
+        :param on_result: called with result in GUI thread
+        :param on_error: called with error message in GUI thread
+        :param report: pass job.report to function as 'report' keyword for progress and cancel
+        :param on_partial: called in GUI thread with every partial result,
+            job.deliver is passed to function as 'deliver' keyword
+        :return: Job
+        """
+        job = Job(name, function, args, kwargs)
+        if report:
+            job.kwargs['report'] = job.report
+            job.fraction = 0.0
+        if on_partial is not None:
+            job.kwargs['deliver'] = job.deliver
+        job.on_result = on_result
+        job.on_error = on_error
+        job.on_partial = on_partial
+        job.signals.progress.connect(self.job_progress)
+        job.signals.partial.connect(self.job_partial)
+        job.signals.finished.connect(self.job_finished)
+        job.signals.failed.connect(self.job_failed)
+        job.signals.cancelled.connect(self.job_cancelled)
+        self.jobs.append(job)
+        self.pool.start(job)
+        self.changed.emit()
+        return job
+
+    def map(self, name, function, items, on_item=None, on_result=None, on_error=None):
+        """
+        Start function(item) for every item as separate job, items are processed in parallel by pool threads.
+        Use it for many independent files or spectra: file reading and numpy release GIL,
+        and no process is forked from GUI process.
+        :param name: text for status area
+        :param on_item: called in GUI thread with result of every item as soon as it is done
+        :param on_result: called in GUI thread with JobBatch.results when all items are done
+        :param on_error: called with error message of every failed item
+        :return: JobBatch
+        """
+        batch = JobBatch(name, len(items), on_result)
+        if not items and on_result is not None:
+            on_result([])
+        for index, item in enumerate(items):
+            job = self.submit(name, function, (item,), on_result=on_item, on_error=on_error)
+            # signals are delivered to GUI thread, so job can't finish before this
+            job.batch = batch
+            job.index = index
+        return batch
+
+    def cancel_all(self):
+        for job in self.jobs:
+            job.cancel()
+
+    def remove(self, job):
+        if job in self.jobs:
+            self.jobs.remove(job)
+        self.changed.emit()
+
+    def job_progress(self, job, fraction):
+        job.fraction = fraction
+        self.changed.emit()
+
+    def job_partial(self, job, result):
+        if job.on_partial is not None and not job.is_cancelled:
+            job.on_partial(result)
+
+    def job_finished(self, job, result):
+        self.remove(job)
+        if job.on_result is not None:
+            job.on_result(result)
+        self.batch_item_done(job, result)
+
+    def job_failed(self, job, message):
+        self.remove(job)
+        if job.on_error is not None:
+            job.on_error(unicode(message))
+        self.batch_item_done(job, None)
+
+    def job_cancelled(self, job):
+        self.remove(job)
+        if job.batch is not None:
+            job.batch.is_cancelled = True
+        self.batch_item_done(job, None)
+
+    def batch_item_done(self, job, result):
+        """
+        Store result of batch job, call on_result of batch after its last job
+        """
+        batch = job.batch
+        if batch is None:
+            return
+        batch.results[job.index] = result
+        batch.remaining -= 1
+        if batch.remaining == 0 and not batch.is_cancelled and batch.on_result is not None:
+            batch.on_result(batch.results)
+
+    def status(self):
+        """
+        :return: (text, progress) for status area,
+            progress is mean fraction of reporting jobs in percents or None
+        """
+        parts = []
+        fractions = []
+        batches = set()
+        for job in self.jobs:
+            if job.batch is not None:
+                if job.batch not in batches:
+                    batches.add(job.batch)
+                    parts.append('%s %d%%' % (job.batch.name, 100 * job.batch.fraction()))
+                    fractions.append(job.batch.fraction())
+            elif job.fraction is None:
+                parts.append(job.name)
+            else:
+                parts.append('%s %d%%' % (job.name, 100 * job.fraction))
+                fractions.append(job.fraction)
+        progress = int(100 * sum(fractions) / len(fractions)) if fractions else None
+        return ' | '.join(parts), progress
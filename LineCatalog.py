@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compiled store of line lists from lines/ tree.
+Every file is parsed once into structured array CATALOG_DTYPE,
+all rows are sorted by wavelength and saved as .npy, which is memory-mapped on load,
+so wavelength and ion queries are binary search plus filtering of a small slice.
+
+Example:
+    python LineCatalog.py lines/ --query 6000 6500 --ion "Fe II"
+"""
+
+import os
+import re
+import hashlib
+import sys
+import argparse
+import numpy as np
+
+from SpectrumCache import SpectrumCache
+
+CATALOG_DTYPE = [('wave', np.float64), ('species', 'S4'), ('ion', 'S6'), ('forbidden', bool),
+                 ('label', 'S24'), ('extra', 'S96'), ('source', 'S128')]
+
+SKIPPED_SUFFIXES = ('~', '.b', '.ps', '.pro', '.fits', '.fit', '.npy')
+SKIPPED_NAMES = ('header',)
+
+_ROMAN = ('I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X',
+          'XI', 'XII', 'XIII', 'XIV', 'XV', 'XVI', 'XVII', 'XVIII', 'XIX', 'XX')
+
+# H!7d!3 (IDL greek), H9, Hdel, Heps, Ly beta
+_HYDROGEN_RE = re.compile(r'^(H(?:!7|\d|alp|bet|gam|del|eps|zet|eta)|Ly(?:\s|$|[a-z]))')
+# Fe II, FeII, [O III], Si II], He i
+_ION_RE = re.compile(r'^(\[?([A-Z][a-z]?)\s?([IVX]+|[ivx]+)\]?)(?![A-Za-z])')
+# 'Fe 2' 42, 4923.9270
+_QUOTED_RE = re.compile(r"^'([A-Z][a-z]?)\s*(\d+)'\s*(.*?),\s*(\d+\.\d*)\s*$")
+
+catalog_cache = SpectrumCache()
+
+
+def is_catalog_file(file_name):
+    """
+    :return: False for backups, scripts, figures and format headers
+    """
+    name = os.path.basename(file_name)
+    return not (name.startswith('.') or name in SKIPPED_NAMES or name.endswith(SKIPPED_SUFFIXES))
+
+
+def parse_identification(text):
+    """
+    :param text: identification like 'Fe II', '[FeII]', 'Si II]', 'He i', 'H!7d!3', 'TiO'
+    :return: (species, ion, forbidden), species and ion are '' if unknown
+    """
+    text = text.strip()
+    if _HYDROGEN_RE.match(text):
+        return 'H', 'I', False
+    match = _ION_RE.match(text)
+    if match is None:
+        return '', '', text.startswith('[')
+    return match.group(2), match.group(3).upper(), text.startswith('[') or match.group(1).endswith(']')
+
+
+def _is_number(token):
+    try:
+        float(token)
+    except ValueError:
+        return False
+    return True
+
+
+def parse_row(line):
+    """
+    Parse one line of line list.
+    Supported rows: 'wave id [extra]', 'wave number(s) [id] [extra]',
+    'number wave id ...' (sequence column) and "'Fe 2' 42, 4923.9270" multiplet tables.
+    Identification may contain space ('O II'), headers and comments give None.
+    :param line: text line
+    :return: (wave, label, extra) or None
+    """
+    match = _QUOTED_RE.match(line.strip())
+    if match is not None:
+        element, ion, multiplet, wave = match.groups()
+        ion = int(ion)
+        ion = _ROMAN[ion - 1] if 0 < ion <= len(_ROMAN) else str(ion)
+        return float(wave), '%s %s' % (element, ion), multiplet.strip()
+
+    tokens = line.split()
+    if len(tokens) > 1 and tokens[0].isdigit() and not tokens[0].startswith('0') and '.' in tokens[1]:
+        # sequence number column
+        tokens = tokens[1:]
+    if not tokens or '.' not in tokens[0] or not _is_number(tokens[0]):
+        return None
+    wave = float(tokens[0])
+    if not wave > 0:
+        return None
+
+    numbers = []
+    rest = tokens[1:]
+    while rest and _is_number(rest[0]):
+        numbers.append(rest.pop(0))
+    rest = ' '.join(rest)
+
+    match = _ION_RE.match(rest)
+    if match is not None:
+        label = match.group(1)
+    elif rest:
+        label = rest.split()[0]
+    else:
+        # numeric table (e.g. DIBs), first number as label
+        label = numbers.pop(0) if numbers else ''
+    extra = ' '.join(numbers + [rest[len(label):].strip()]).strip()
+    return wave, label, extra
+
+
+def load_catalog_file(file_name):
+    """
+    Parsed line list through the on-disk cache
+    :param file_name: line list filename
+    :return: structured array CATALOG_DTYPE in file order
+    """
+    return catalog_cache.load(file_name, read_catalog_file, 'read_catalog_file')
+
+
+def read_catalog_file(file_name, source=None):
+    """
+    Parse line list file of any supported format
+    :param file_name: line list filename
+    :param source: value of 'source' column, file_name if None
+    :return: structured array CATALOG_DTYPE in file order
+    """
+    if source is None:
+        source = file_name
+    rows = []
+    with open(file_name, 'rb') as catalog_file:
+        for line in catalog_file:
+            row = parse_row(line.decode('latin-1'))
+            if row is None:
+                continue
+            wave, label, extra = row
+            species, ion, forbidden = parse_identification(label)
+            rows.append((wave, species, ion, forbidden, label.encode('latin-1'),
+                         extra.encode('latin-1'), source.encode('utf-8')))
+    return np.array(rows, dtype=CATALOG_DTYPE)
+
+
+def find_catalog_files(lines_dir):
+    """
+    :param lines_dir: root of line lists tree
+    :return: sorted list of line list paths, backups, scripts and headers are skipped
+    """
+    catalog_files = []
+    for directory, subdirectories, files in os.walk(lines_dir):
+        subdirectories[:] = [name for name in subdirectories if not name.startswith('.')]
+        catalog_files.extend(os.path.join(directory, name) for name in files
+                             if is_catalog_file(name) and os.path.getsize(os.path.join(directory, name)) > 0)
+    catalog_files.sort()
+    return catalog_files
+
+
+def compile_catalog(lines_dir):
+    """
+    Parse all line lists of tree into one array
+    :param lines_dir: root of line lists tree
+    :return: structured array CATALOG_DTYPE sorted by wavelength,
+        'source' is path relative to lines_dir
+    """
+    catalogs = [np.zeros(0, dtype=CATALOG_DTYPE)]
+    for file_name in find_catalog_files(lines_dir):
+        catalogs.append(read_catalog_file(file_name, os.path.relpath(file_name, lines_dir)))
+    catalog = np.concatenate(catalogs)
+    return catalog[np.argsort(catalog['wave'], kind='mergesort')]
+
+
+def catalog_file_name(lines_dir):
+    """
+    :return: compiled catalog path in cache directory, one file per tree
+    """
+    digest = hashlib.sha1(os.path.abspath(lines_dir).encode('utf-8')).hexdigest()
+    return os.path.join(catalog_cache.cache_dir, 'line_catalog_' + digest + '.npy')
+
+
+def is_up_to_date(lines_dir, output_file):
+    """
+    Compiled catalog is up to date if it is newer than every line list and every directory of tree,
+    directory mtime changes when files are added, removed or renamed
+    """
+    if not os.path.exists(output_file):
+        return False
+    output_time = os.path.getmtime(output_file)
+    for directory, subdirectories, files in os.walk(lines_dir):
+        subdirectories[:] = [name for name in subdirectories if not name.startswith('.')]
+        paths = [directory] + [os.path.join(directory, name) for name in files if is_catalog_file(name)]
+        if any(os.path.getmtime(path) > output_time for path in paths):
+            return False
+    return True
+
+
+def load_catalog(lines_dir, output_file=None, force=False):
+    """
+    Load compiled catalog of tree, recompiling it if any line list changed
+    :param lines_dir: root of line lists tree
+    :param output_file: compiled .npy path, in cache directory by default
+    :param force: recompile even up to date catalog
+    :return: memory-mapped structured array CATALOG_DTYPE sorted by wavelength
+    """
+    if output_file is None:
+        output_file = catalog_file_name(lines_dir)
+    if force or not is_up_to_date(lines_dir, output_file):
+        catalog_cache.store(output_file, compile_catalog(lines_dir))
+    return np.load(output_file, mmap_mode='r')
+
+
+def _searchsorted(wave, value, right):
+    """
+    Binary search on strided wave column, np.searchsorted would copy the column first
+    :return: first index with wave >= value, or wave > value if right
+    """
+    low, high = 0, wave.size
+    while low < high:
+        middle = (low + high) // 2
+        if wave[middle] < value or (right and wave[middle] == value):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def query(catalog, wave_min=None, wave_max=None, ion=None, source=None):
+    """
+    Lines in wavelength range with optional ion and source filters
+    :param catalog: sorted structured array CATALOG_DTYPE
+    :param wave_min: left limit, Angstrom
+    :param wave_max: right limit, Angstrom
+    :param ion: 'Fe II', 'FeII', '[Fe II]' or element only, 'Fe'
+    :param source: catalog source path
+    :return: structured array CATALOG_DTYPE
+    """
+    wave = catalog['wave']
+    start = 0 if wave_min is None else _searchsorted(wave, wave_min, False)
+    stop = wave.size if wave_max is None else _searchsorted(wave, wave_max, True)
+    lines = catalog[start:stop]
+
+    if ion is not None:
+        species, ion_stage, forbidden = parse_identification(ion)
+        if not species:
+            species = ion.strip()
+        selected = lines['species'] == species.encode('latin-1')
+        if ion_stage:
+            selected &= lines['ion'] == ion_stage.encode('latin-1')
+        if ion.strip().startswith('['):
+            selected &= lines['forbidden']
+        lines = lines[selected]
+    if source is not None:
+        lines = lines[lines['source'] == source.encode('utf-8')]
+    return lines
+
+
+def format_lines(lines):
+    """
+    :param lines: structured array CATALOG_DTYPE
+    :return: text table
+    """
+    rows = ['# wave label species ion extra source']
+    for line in lines:
+        rows.append('%0.3f %s %s %s %s %s' % (line['wave'], line['label'].decode('latin-1'),
+                                             line['species'].decode('latin-1') or '-',
+                                             line['ion'].decode('latin-1') or '-',
+                                             line['extra'].decode('latin-1') or '-',
+                                             line['source'].decode('utf-8')))
+    return '\n'.join(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compile and query line lists tree.')
+    parser.add_argument('lines_dir', help='root directory of line lists')
+    parser.add_argument('--output', default=None, help='compiled catalog path (default: in cache directory)')
+    parser.add_argument('--force', action='store_true', help='recompile up to date catalog')
+    parser.add_argument('--query', nargs=2, type=float, metavar=('WAVE_MIN', 'WAVE_MAX'),
+                        help='print lines in wavelength range')
+    parser.add_argument('--ion', default=None, help='ion filter for query, e.g. "Fe II"')
+    args = parser.parse_args(argv)
+
+    catalog = load_catalog(args.lines_dir, args.output, args.force)
+    if args.query is None:
+        print("%d lines from %d files" % (catalog.size, np.unique(catalog['source']).size))
+    else:
+        print(format_lines(query(catalog, args.query[0], args.query[1], args.ion)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Batched Gaussian fitting of spectral lines.
+Every line is fitted with gaussian on linear continuum inside window around its center.
+Windows of one spectrum are padded to common length and fitted together
+by Levenberg-Marquardt with analytic jacobian, all lines do one iteration in one numpy step.
+Spectra are distributed over process pool.
+"""
+
+import multiprocessing
+import numpy as np
+
+FWHM_TO_SIGMA = 2.0 * np.sqrt(2.0 * np.log(2.0))
+
+LINE_FIT_DTYPE = [('spectrum', object), ('line', np.float64),
+                  ('center', np.float64), ('center_error', np.float64),
+                  ('fwhm', np.float64), ('fwhm_error', np.float64),
+                  ('amplitude', np.float64), ('amplitude_error', np.float64),
+                  ('slope', np.float64), ('offset', np.float64),
+                  ('reduced_chi2', np.float64), ('points', np.int64), ('success', bool)]
+
+_PARAMETERS = 5
+
+
+def gauss_model(x, parameters, x0):
+    """
+    Gaussian on linear continuum: A * exp(-(x - mu)**2 / (2 * sig**2)) + slope * (x - x0) + offset
+    :param x: np.array (lines, points)
+    :param parameters: np.array (lines, 5) of A, mu, sig, slope, offset
+    :param x0: np.array (lines,) continuum reference point
+    :return: (model, jacobian), shapes (lines, points) and (lines, points, 5)
+    """
+    amplitude, center, sigma, slope, offset = [parameters[:, i:i + 1] for i in range(_PARAMETERS)]
+    dx = x - center
+    gauss = np.exp(-dx ** 2 / (2.0 * sigma ** 2))
+    continuum_x = x - x0[:, np.newaxis]
+
+    model = amplitude * gauss + slope * continuum_x + offset
+    jacobian = np.empty(x.shape + (_PARAMETERS,))
+    jacobian[..., 0] = gauss
+    jacobian[..., 1] = amplitude * gauss * dx / sigma ** 2
+    jacobian[..., 2] = amplitude * gauss * dx ** 2 / sigma ** 3
+    jacobian[..., 3] = continuum_x
+    jacobian[..., 4] = 1.0
+    return model, jacobian
+
+
+def extract_windows(wave, flux, centers, half_width):
+    """
+    Cut windows around line centers and pad them to common length
+    :param wave: ascending wavelength array
+    :param flux: flux array
+    :param centers: line centers
+    :param half_width: half width of window, Angstrom
+    :return: (x, y, weight) np.arrays (lines, points), padding has zero weight
+    """
+    centers = np.asarray(centers, dtype=np.float64)
+    starts = np.searchsorted(wave, centers - half_width, 'left')
+    stops = np.searchsorted(wave, centers + half_width, 'right')
+    length = max(np.max(stops - starts), 1) if centers.size else 1
+
+    index = starts[:, np.newaxis] + np.arange(length)[np.newaxis, :]
+    inside = index < stops[:, np.newaxis]
+    index = np.minimum(index, wave.size - 1)
+    x = wave[index]
+    y = flux[index]
+    weight = (inside & np.isfinite(y)).astype(np.float64)
+    return x, np.where(weight > 0, y, 0.0), weight
+
+
+def initial_guess(x, y, weight, centers):
+    """
+    Guess parameters from data: continuum through window edges,
+    amplitude from extreme residual, sigma from number of points above half maximum
+    :return: np.array (lines, 5)
+    """
+    lines = x.shape[0]
+    points = np.sum(weight, axis=1).astype(np.intp)
+    edge = np.maximum(points // 10, 1)
+    rows = np.arange(lines)
+
+    cumulative_y = np.concatenate((np.zeros((lines, 1)), np.cumsum(y, axis=1)), axis=1)
+    cumulative_x = np.concatenate((np.zeros((lines, 1)), np.cumsum(x, axis=1)), axis=1)
+    left_y = cumulative_y[rows, edge] / edge
+    left_x = cumulative_x[rows, edge] / edge
+    right_y = (cumulative_y[rows, points] - cumulative_y[rows, points - edge]) / edge
+    right_x = (cumulative_x[rows, points] - cumulative_x[rows, points - edge]) / edge
+    slope = np.where(right_x > left_x, (right_y - left_y) / np.where(right_x > left_x, right_x - left_x, 1.0), 0.0)
+    offset = left_y + slope * (centers - left_x)
+
+    residual = np.where(weight > 0, y - (slope[:, np.newaxis] * (x - centers[:, np.newaxis]) + offset[:, np.newaxis]),
+                        0.0)
+    peak = np.argmax(np.abs(residual), axis=1)
+    amplitude = residual[rows, peak]
+
+    step = np.where(points > 1, (x[rows, points - 1] - x[:, 0]) / np.maximum(points - 1, 1), 1.0)
+    above_half = np.sum(residual / np.where(amplitude != 0, amplitude, 1.0)[:, np.newaxis] > 0.5, axis=1)
+    sigma = np.maximum(above_half, 2) * step / FWHM_TO_SIGMA
+    return np.column_stack((amplitude, x[rows, peak], sigma, slope, offset))
+
+
+def _normal_equations(jacobian, weight, residual):
+    """
+    :return: (J^T W J, J^T W r) for stack of lines
+    """
+    weighted_transposed = np.swapaxes(jacobian * weight[..., np.newaxis], 1, 2)
+    return np.matmul(weighted_transposed, jacobian), np.matmul(weighted_transposed, residual[..., np.newaxis])[..., 0]
+
+
+def fit_lines(wave, flux, centers, half_width=100.0, error=None, max_iterations=100, tolerance=1e-8):
+    """
+    Fit all lines of one spectrum at once
+    :param wave: ascending wavelength array
+    :param flux: flux array
+    :param centers: approximate line centers
+    :param half_width: half width of fitting window, Angstrom
+    :param error: flux errors, reduced chi-square scales parameter errors if None
+    :param max_iterations: Levenberg-Marquardt iteration limit
+    :param tolerance: relative chi-square change for convergence
+    :return: structured array LINE_FIT_DTYPE without spectrum name
+    """
+    wave = np.asarray(wave, dtype=np.float64)
+    flux = np.asarray(flux, dtype=np.float64)
+    centers = np.atleast_1d(np.asarray(centers, dtype=np.float64))
+    x, y, weight = extract_windows(wave, flux, centers, half_width)
+    if error is not None:
+        _, sigma_flux, _ = extract_windows(wave, np.asarray(error, dtype=np.float64), centers, half_width)
+        weight = np.where(sigma_flux > 0, weight / np.where(sigma_flux > 0, sigma_flux, 1.0) ** 2, 0.0)
+
+    parameters = initial_guess(x, y, weight, centers)
+    model, jacobian = gauss_model(x, parameters, centers)
+    chi2 = np.sum(weight * (y - model) ** 2, axis=1)
+    damping = np.full(centers.size, 1e-3)
+    active = np.ones(centers.size, dtype=bool)
+
+    for iteration in range(max_iterations):
+        lines = np.flatnonzero(active)
+        if lines.size == 0:
+            break
+        line_x, line_y, line_weight = x[lines], y[lines], weight[lines]
+        line_jacobian = jacobian[lines]
+        normal, gradient = _normal_equations(line_jacobian, line_weight, line_y - model[lines])
+        diagonal = np.maximum(np.einsum('lii->li', normal), 1e-300)
+        damped = normal + (damping[lines, np.newaxis] * diagonal)[:, :, np.newaxis] * np.eye(_PARAMETERS)
+        try:
+            step = np.linalg.solve(damped, gradient[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.array([np.linalg.lstsq(matrix, vector, rcond=-1)[0] for matrix, vector in zip(damped, gradient)])
+
+        new_parameters = parameters[lines] + step
+        new_model, new_jacobian = gauss_model(line_x, new_parameters, centers[lines])
+        new_chi2 = np.sum(line_weight * (line_y - new_model) ** 2, axis=1)
+        better = np.isfinite(new_chi2) & (new_chi2 <= chi2[lines])
+        converged = better & (chi2[lines] - new_chi2 <= tolerance * np.maximum(chi2[lines], 1e-300))
+
+        accepted = lines[better]
+        parameters[accepted] = new_parameters[better]
+        model[accepted] = new_model[better]
+        jacobian[accepted] = new_jacobian[better]
+        chi2[accepted] = new_chi2[better]
+        damping[lines] = np.where(better, damping[lines] / 10.0, damping[lines] * 10.0)
+        active[lines] = ~converged & (damping[lines] < 1e16)
+
+    points = np.sum(weight > 0, axis=1)
+    degrees = points - _PARAMETERS
+    normal, gradient = _normal_equations(jacobian, weight, y - model)
+    covariance = np.full(normal.shape, np.nan)
+    invertible = np.abs(np.linalg.det(normal)) > 0
+    if np.any(invertible):
+        covariance[invertible] = np.linalg.inv(normal[invertible])
+    reduced_chi2 = np.where(degrees > 0, chi2 / np.maximum(degrees, 1), np.nan)
+    errors = np.sqrt(np.abs(np.einsum('lii->li', covariance)))
+    if error is None:
+        errors = errors * np.sqrt(reduced_chi2)[:, np.newaxis]
+
+    table = np.zeros(centers.size, dtype=LINE_FIT_DTYPE)
+    table['line'] = centers
+    table['center'] = parameters[:, 1]
+    table['center_error'] = errors[:, 1]
+    table['fwhm'] = FWHM_TO_SIGMA * np.abs(parameters[:, 2])
+    table['fwhm_error'] = FWHM_TO_SIGMA * errors[:, 2]
+    table['amplitude'] = parameters[:, 0]
+    table['amplitude_error'] = errors[:, 0]
+    table['slope'] = parameters[:, 3]
+    table['offset'] = parameters[:, 4]
+    table['reduced_chi2'] = reduced_chi2
+    table['points'] = points
+    table['success'] = ((degrees > 0) & invertible & ~active &
+                        (np.abs(parameters[:, 1] - centers) <= half_width))
+    return table
+
+
+def fit_model(table, wave, half_width=100.0):
+    """
+    Fitted profiles for plotting, one curve with NaN gaps between windows
+    :param table: fit_lines result for one spectrum
+    :param wave: wavelength array of spectrum
+    :return: (x, y)
+    """
+    x_parts, y_parts = [], []
+    for row in table:
+        x = wave[(wave >= row['line'] - half_width) & (wave <= row['line'] + half_width)]
+        parameters = np.array([[row['amplitude'], row['center'], row['fwhm'] / FWHM_TO_SIGMA,
+                                row['slope'], row['offset']]])
+        model, _ = gauss_model(x[np.newaxis, :], parameters, np.array([row['line']]))
+        x_parts.extend([x, [np.nan]])
+        y_parts.extend([model[0], [np.nan]])
+    if not x_parts:
+        return np.zeros(0), np.zeros(0)
+    return np.concatenate(x_parts), np.concatenate(y_parts)
+
+
+def _fit_task(task):
+    name, wave, flux, centers, half_width = task
+    table = fit_lines(wave, flux, centers, half_width)
+    table['spectrum'] = name
+    return table
+
+
+def fit_spectra(spectra, centers, half_width=100.0, processes=None):
+    """
+    Fit the same lines in many spectra
+    :param spectra: list of (name, wave, flux)
+    :param centers: approximate line centers
+    :param half_width: half width of fitting window, Angstrom
+    :param processes: pool size, all cores by default, 1 to run in this process
+    :return: structured array LINE_FIT_DTYPE ordered by spectrum and line
+    """
+    tasks = [(name, np.asarray(wave), np.asarray(flux), centers, half_width) for name, wave, flux in spectra]
+    if processes == 1 or len(tasks) <= 1:
+        tables = [_fit_task(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            tables = pool.map(_fit_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    return np.concatenate([np.zeros(0, dtype=LINE_FIT_DTYPE)] + tables)
+
+
+def format_table(table):
+    """
+    :param table: fit_spectra result
+    :return: text table
+    """
+    lines = ['# spectrum line center center_error fwhm fwhm_error amplitude amplitude_error '
+             'reduced_chi2 points success']
+    for row in table:
+        lines.append('%s %0.3f %0.4f %0.4f %0.4f %0.4f %0.6e %0.6e %0.4e %d %d' % (
+            row['spectrum'], row['line'], row['center'], row['center_error'], row['fwhm'], row['fwhm_error'],
+            row['amplitude'], row['amplitude_error'], row['reduced_chi2'], row['points'], row['success']))
+    return '\n'.join(lines)
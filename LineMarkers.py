@@ -0,0 +1,126 @@
+import numpy as np
+from collections import OrderedDict
+from PyQt4 import QtCore
+from pyqtgraph import InfiniteLine, mkColor
+
+
+LABEL_POSITIONS = (0.75, 0.85, 0.90)
+
+
+class LineMarkerLayer(object):
+    """Markers of spectral line catalogs on plot.
+    All catalogs are merged into one wavelength-sorted array. Only markers inside view range
+    are kept in scene, at most one per pixel, and labels are thinned to label_spacing pixels,
+    so scene size depends on view width, not on catalog size.
+     Attributes:
+         catalogs (OrderedDict): catalog name -> (waves, labels).
+         waves (np.array): merged sorted wavelengths.
+         labels (np.array): labels in the same order.
+    """
+
+    def __init__(self, plot_item, label_spacing=40):
+        self.pw = plot_item
+        self.label_spacing = label_spacing
+        self.catalogs = OrderedDict()
+        self.waves = np.zeros(0)
+        self.labels = np.zeros(0, dtype=object)
+        self.items = []
+        self.updating = False
+        self.pw.sigXRangeChanged.connect(self.update)
+        self.pw.getViewBox().sigResized.connect(self.update)
+
+    def add_catalog(self, name, waves, labels):
+        """
+        Add or replace catalog
+        :param name: catalog name, e.g. file name
+        :param waves: line wavelengths
+        :param labels: line labels
+        """
+        self.catalogs[name] = (np.asarray(waves, dtype=np.float64), np.asarray(labels, dtype=object))
+        self.merge()
+        self.update()
+
+    def remove_catalog(self, name):
+        self.catalogs.pop(name, None)
+        self.merge()
+        self.update()
+
+    def clear(self):
+        self.catalogs.clear()
+        self.merge()
+        self.update()
+
+    def merge(self):
+        """
+        Rebuild merged sorted arrays from catalogs
+        """
+        if self.catalogs:
+            waves = np.concatenate([waves for waves, labels in self.catalogs.values()])
+            labels = np.concatenate([labels for waves, labels in self.catalogs.values()])
+            order = np.argsort(waves, kind='mergesort')
+            self.waves = waves[order]
+            self.labels = labels[order]
+        else:
+            self.waves = np.zeros(0)
+            self.labels = np.zeros(0, dtype=object)
+
+    def nearest(self, wave, count):
+        """
+        Nearest lines to wavelength, binary search over merged array
+        :param wave: wavelength, Angstrom
+        :param count: number of lines
+        :return: indexes in merged arrays, nearest first
+        """
+        position = np.searchsorted(self.waves, wave)
+        start = max(position - count, 0)
+        candidates = np.arange(start, min(position + count, self.waves.size))
+        order = np.argsort(np.abs(self.waves[start:start + candidates.size] - wave), kind='mergesort')
+        return candidates[order[:count]]
+
+    def visible_markers(self, x_min, x_max, pixels):
+        """
+        Choose markers to draw: first line in every pixel column,
+        first marker in every label_spacing pixels gets label
+        :return: (indexes in merged arrays, boolean array of labeled markers)
+        """
+        start = np.searchsorted(self.waves, x_min, 'left')
+        stop = np.searchsorted(self.waves, x_max, 'right')
+        if stop <= start or x_max <= x_min:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=bool)
+
+        pixel = ((self.waves[start:stop] - x_min) * (pixels / (x_max - x_min))).astype(np.int64)
+        first_in_pixel = np.flatnonzero(np.concatenate(([True], pixel[1:] != pixel[:-1])))
+        label_bin = pixel[first_in_pixel] // self.label_spacing
+        labeled = np.concatenate(([True], label_bin[1:] != label_bin[:-1]))
+        return start + first_in_pixel, labeled
+
+    def update(self, *args):
+        """
+        Sync scene markers with view range, reusing InfiniteLine items
+        """
+        if self.updating:
+            return
+        self.updating = True
+        try:
+            view = self.pw.getViewBox()
+            x_min, x_max = view.viewRange()[0]
+            indexes, labeled = self.visible_markers(x_min, x_max, max(int(view.width()), 1))
+
+            while len(self.items) < indexes.size:
+                line = InfiniteLine(label='', labelOpts={'position': LABEL_POSITIONS[0], 'color': mkColor("w")})
+                line.setPen(style=QtCore.Qt.DotLine)
+                self.pw.addItem(line)
+                self.items.append(line)
+            while len(self.items) > indexes.size:
+                self.pw.removeItem(self.items.pop())
+
+            for line, index, has_label in zip(self.items, indexes, labeled):
+                line.setValue(self.waves[index])
+                line.label.setPosition(LABEL_POSITIONS[index % len(LABEL_POSITIONS)])
+                if has_label:
+                    # labels are format strings for InfLineLabel
+                    line.label.setFormat(str(self.labels[index]).replace('{', '{{').replace('}', '}}'))
+                else:
+                    line.label.setFormat('')
+        finally:
+            self.updating = False
@@ -0,0 +1,166 @@
+import numpy as np
+from pyqtgraph import PlotDataItem
+
+
+MIN_BLOCKS = 256
+DEFAULT_PIXELS = 2000
+
+
+def minmax_pyramid(y):
+    """
+    Min/max pyramid for level-of-detail drawing.
+    Level k holds min and max of y over blocks of 2**k points, the odd tail joins the last block.
+    NaN points are ignored.
+    :param y: flux array
+    :return: list of (mins, maxs) for k = 1, 2, ... while there are at least MIN_BLOCKS blocks
+    """
+    levels = []
+    mins = maxs = np.asarray(y, dtype=np.float64)
+    while mins.size >= 2 * MIN_BLOCKS:
+        pairs = mins.size // 2
+        new_mins = np.fmin(mins[0:2 * pairs:2], mins[1:2 * pairs:2])
+        new_maxs = np.fmax(maxs[0:2 * pairs:2], maxs[1:2 * pairs:2])
+        if mins.size % 2:
+            new_mins[-1] = np.fmin(new_mins[-1], mins[-1])
+            new_maxs[-1] = np.fmax(new_maxs[-1], maxs[-1])
+        levels.append((new_mins, new_maxs))
+        mins, maxs = new_mins, new_maxs
+    return levels
+
+
+def decimate(x, y, levels, x_min, x_max, pixels):
+    """
+    Points to draw for visible range: raw points if there are few of them,
+    else min and max of every pyramid block, about two points per pixel,
+    so every peak and dip stays visible.
+    :param x: ascending wavelength array
+    :param y: flux array
+    :param levels: minmax_pyramid(y), empty for unsorted x, whole data is returned then
+    :param x_min: left border of view
+    :param x_max: right border of view
+    :param pixels: view width in pixels
+    :return: (x, y) to draw
+    """
+    if not levels:
+        # searchsorted needs ascending x
+        return x, y
+    start = max(np.searchsorted(x, x_min, 'left') - 1, 0)
+    stop = min(np.searchsorted(x, x_max, 'right') + 1, x.size)
+    visible = stop - start
+    if visible <= 2 * pixels:
+        return x[start:stop], y[start:stop]
+
+    level = min(max(int(round(np.log2(visible / float(pixels)))), 1), len(levels))
+    mins, maxs = levels[level - 1]
+    block = 2 ** level
+    first_block = start // block
+    last_block = min((stop - 1) // block + 1, mins.size)
+
+    block_x = x[first_block * block:last_block * block:block]
+    blocks = block_x.size
+    x_display = np.repeat(block_x, 2)
+    y_display = np.empty(2 * blocks)
+    y_display[0::2] = maxs[first_block:first_block + blocks]
+    y_display[1::2] = mins[first_block:first_block + blocks]
+    return x_display, y_display
+
+
+class LodPlotDataItem(PlotDataItem):
+    """PlotDataItem drawing only visible range decimated with min/max pyramid.
+    getData returns full resolution data as plain PlotDataItem without downsampling does,
+    so all transforms work with original points.
+    """
+
+    def __init__(self, *args, **kargs):
+        self._pyramid = None
+        PlotDataItem.__init__(self, *args, **kargs)
+
+    def setData(self, *args, **kargs):
+        self._pyramid = None
+        PlotDataItem.setData(self, *args, **kargs)
+
+    def getData(self):
+        """
+        :return: full resolution (x, y)
+        """
+        return self.xData, self.yData
+
+    def pyramid(self):
+        """
+        Build min/max pyramid on first use after setData,
+        unsorted data is drawn without decimation
+        """
+        if self._pyramid is None:
+            x = self.xData
+            if x is not None and x.size > 1 and np.all(x[1:] >= x[:-1]):
+                self._pyramid = minmax_pyramid(self.yData)
+            else:
+                self._pyramid = []
+        return self._pyramid
+
+    def getDisplayData(self):
+        """
+        :return: (x, y) for current view range and width
+        """
+        x, y = self.xData, self.yData
+        if x is None or x.size < 2 * MIN_BLOCKS:
+            return x, y
+        levels = self.pyramid()
+        if not levels:
+            # descending or NaN-separated data is drawn whole
+            return x, y
+
+        view = self.getViewBox()
+        if view is None:
+            x_min, x_max = x[0], x[-1]
+            pixels = DEFAULT_PIXELS
+        else:
+            x_min, x_max = view.viewRange()[0]
+            pixels = max(int(view.width()), 1)
+        return decimate(x, y, levels, x_min, x_max, pixels)
+
+    def updateItems(self):
+        curveArgs = {}
+        for k, v in [('pen', 'pen'), ('shadowPen', 'shadowPen'), ('fillLevel', 'fillLevel'),
+                     ('fillBrush', 'brush'), ('antialias', 'antialias'), ('connect', 'connect'),
+                     ('stepMode', 'stepMode')]:
+            curveArgs[v] = self.opts[k]
+
+        scatterArgs = {}
+        for k, v in [('symbolPen', 'pen'), ('symbolBrush', 'brush'), ('symbol', 'symbol'),
+                     ('symbolSize', 'size'), ('data', 'data'), ('pxMode', 'pxMode'), ('antialias', 'antialias')]:
+            if k in self.opts:
+                scatterArgs[v] = self.opts[k]
+
+        x, y = self.getDisplayData()
+
+        if curveArgs['pen'] is not None or (curveArgs['brush'] is not None and curveArgs['fillLevel'] is not None):
+            self.curve.setData(x=x, y=y, **curveArgs)
+            self.curve.show()
+        else:
+            self.curve.hide()
+
+        if scatterArgs['symbol'] is not None:
+            self.scatter.setData(x=x, y=y, **scatterArgs)
+            self.scatter.show()
+        else:
+            self.scatter.hide()
+
+    def viewRangeChanged(self):
+        self.updateItems()
+
+    def dataBounds(self, ax, frac=1.0, orthoRange=None):
+        """
+        Bounds of full data, curve holds only visible part
+        """
+        x, y = self.xData, self.yData
+        if x is None or x.size == 0:
+            return [None, None]
+
+        data, other = (x, y) if ax == 0 else (y, x)
+        if orthoRange is not None:
+            data = data[(other >= orthoRange[0]) & (other <= orthoRange[1])]
+        data = data[np.isfinite(data)]
+        if data.size == 0:
+            return [None, None]
+        return [np.min(data), np.max(data)]
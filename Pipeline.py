@@ -0,0 +1,310 @@
+"""
+Processing chains of spectra.
+Every plot keeps its raw arrays, which are never changed, and ordered list of steps,
+step is name of registered operation with its parameters.
+Result of every stage is memoized by the steps leading to it,
+so editing one step recomputes only stages after it, and undo/redo only move position in the list.
+"""
+
+import threading
+import numpy as np
+from PyAstronomy import pyasl
+
+import Broadening
+import Continuum
+import Extinction
+import Rebin
+
+OPERATIONS = {}
+
+
+def operation(name, single=False):
+    """
+    Register function(wave, flux, *args) -> (wave, flux) as pipeline operation
+    :param name: operation name used in steps
+    :param single: operation is applied once, applying it again changes parameters of existing step
+    """
+    def register(function):
+        OPERATIONS[name] = (function, single)
+        return function
+    return register
+
+
+def _frozen(value):
+    """
+    Hashable copy of step parameter, arrays and lists become tuples
+    """
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return tuple(_frozen(item) for item in value)
+    return value
+
+
+def _read_only(array):
+    """
+    Read-only float array, already read-only arrays (e.g. memory-mapped session) are not copied
+    """
+    array = np.asarray(array, dtype=np.float64)
+    if array.flags.writeable:
+        array = array.copy()
+        array.setflags(write=False)
+    return array
+
+
+class Pipeline(object):
+    """Raw spectrum plus chain of operations.
+     Attributes:
+         wave (np.array): raw wavelengths, read-only.
+         flux (np.array): raw fluxes, read-only.
+         steps (list): (name, args) of all steps, steps after position were undone and can be redone.
+         position (int): number of applied steps.
+         memo (dict): results of chain prefixes, guarded by lock, written by worker threads too.
+    Class attributes:
+         line_catalogs (dict): catalog name -> (waves, labels) of line catalogs masked by auto_continuum steps,
+             e.g. LineMarkerLayer.catalogs, steps keep only catalog names.
+    """
+    line_catalogs = {}
+
+    def __init__(self, wave, flux):
+        self.wave = _read_only(wave)
+        self.flux = _read_only(flux)
+        self.steps = []
+        self.position = 0
+        self.lock = threading.Lock()
+        self.memo = {(): (self.wave, self.flux)}
+
+    def restore(self, steps, position, wave=None, flux=None):
+        """
+        Set saved chain
+        :param steps: list of (name, args)
+        :param position: number of applied steps
+        :param wave: saved result of applied steps, computed on demand if None
+        :param flux: saved result of applied steps
+        """
+        self.steps = [(name, _frozen(args)) for name, args in steps]
+        self.position = position
+        with self.lock:
+            self.memo = {(): (self.wave, self.flux)}
+            if wave is not None:
+                self.memo[self.applied()] = (_read_only(wave), _read_only(flux))
+
+    def applied(self):
+        """
+        :return: tuple of applied steps, key of current result
+        """
+        return tuple(self.steps[:self.position])
+
+    def append(self, name, *args):
+        """
+        Apply operation after current position, undone steps are dropped.
+        For single operation already applied its parameters are changed instead.
+        :return: index of step
+        """
+        function, single = OPERATIONS[name]
+        if single:
+            for index, (step_name, _) in enumerate(self.steps[:self.position]):
+                if step_name == name:
+                    self.replace(index, *args)
+                    return index
+        del self.steps[self.position:]
+        self.steps.append((name, _frozen(args)))
+        self.position += 1
+        self.prune()
+        return self.position - 1
+
+    def replace(self, index, *args):
+        """
+        Change parameters of step, stages before it stay memoized
+        """
+        self.steps[index] = (self.steps[index][0], _frozen(args))
+        self.prune()
+
+    def remove(self, index):
+        """
+        Drop step from chain
+        """
+        del self.steps[index]
+        if index < self.position:
+            self.position -= 1
+        self.prune()
+
+    def can_undo(self):
+        return self.position > 0
+
+    def can_redo(self):
+        return self.position < len(self.steps)
+
+    def undo(self):
+        if self.can_undo():
+            self.position -= 1
+
+    def redo(self):
+        if self.can_redo():
+            self.position += 1
+
+    def find(self, name):
+        """
+        :return: index of first applied step with operation name or None
+        """
+        for index, (step_name, _) in enumerate(self.steps[:self.position]):
+            if step_name == name:
+                return index
+        return None
+
+    def is_computed(self, steps=None):
+        """
+        :return: True if result of steps (applied steps by default) is memoized
+        """
+        with self.lock:
+            return (self.applied() if steps is None else tuple(steps)) in self.memo
+
+    def result(self, steps=None):
+        """
+        Result of chain, only stages missing from memo are computed.
+        Safe to call from worker thread with steps taken in GUI thread,
+        stages are computed without lock and kept only while they are still prefixes of the chain.
+        :param steps: tuple of steps, applied steps by default
+        :return: (wave, flux), read-only arrays
+        """
+        steps = self.applied() if steps is None else tuple(steps)
+        done = len(steps)
+        with self.lock:
+            stage = self.memo.get(steps)
+            while stage is None:
+                done -= 1
+                stage = self.memo.get(steps[:done])
+        wave, flux = stage
+        for index in range(done, len(steps)):
+            name, args = steps[index]
+            wave, flux = OPERATIONS[name][0](np.array(wave), np.array(flux), *args)
+            wave, flux = _read_only(wave), _read_only(flux)
+            with self.lock:
+                if tuple(self.steps[:index + 1]) == steps[:index + 1]:
+                    self.memo[steps[:index + 1]] = (wave, flux)
+        return wave, flux
+
+    def set_result(self, wave, flux, steps=None):
+        """
+        Memoize result computed elsewhere, e.g. by batch job over many plots
+        :param steps: tuple of steps leading to result, applied steps by default
+        """
+        with self.lock:
+            self.memo[self.applied() if steps is None else tuple(steps)] = (_read_only(wave), _read_only(flux))
+
+    def prune(self):
+        """
+        Forget stages which are not prefixes of the current chain
+        """
+        prefixes = set(tuple(self.steps[:index]) for index in range(len(self.steps) + 1))
+        with self.lock:
+            for key in list(self.memo):
+                if key not in prefixes:
+                    del self.memo[key]
+
+    def describe(self):
+        """
+        :return: list of step descriptions, undone steps are marked
+        """
+        return ['%d: %s%r%s' % (index + 1, name, args, '' if index < self.position else ' (undone)')
+                for index, (name, args) in enumerate(self.steps)]
+
+
+@operation('distance', single=True)
+def rescale_distance(wave, flux, distance):
+    """
+    Rescale flux to 1 kpc from distance in kpc
+    """
+    return wave, flux * distance ** 2
+
+
+@operation('doppler')
+def doppler_shift(wave, flux, velocity):
+    """
+    Shift flux by radial velocity in km/s on the same grid
+    """
+    shifted_flux, _ = pyasl.dopplerShift(wave, flux, velocity, edgeHandling="firstlast")
+    return wave, shifted_flux
+
+
+@operation('redshift')
+def redshift(wave, flux, z):
+    """
+    Scale wavelengths by 1 + z
+    """
+    return wave * (1 + z), flux
+
+
+@operation('rotation', single=True)
+def rotation(wave, flux, vsini, epsilon=0.0):
+    """
+    Rotational broadening, see Broadening.broaden_rotation
+    """
+    return wave, Broadening.broaden_rotation(wave, flux, vsini, epsilon)
+
+
+@operation('unred', single=True)
+def unred(wave, flux, a_v, r_v=Extinction.DEFAULT_R_V):
+    """
+    Deredden flux with Fitzpatrick (1999) curve for E(B-V) = Av / R_V, see Extinction.deredden
+    """
+    return wave, Extinction.deredden(wave, flux, a_v, r_v)
+
+
+@operation('smooth')
+def smooth(wave, flux, window_length):
+    """
+    Hamming window smoothing, window in Angstrom
+    """
+    window_length_cell = int(window_length / max(wave[1:] - wave[0:-1]))
+    if window_length_cell % 2 == 0:
+        window_length_cell += 1
+    return wave, pyasl.smooth(flux, window_length_cell, 'hamming')
+
+
+@operation('rebin')
+def rebin(wave, flux, kind='log', step=None):
+    """
+    Flux-conserving rebinning, see Rebin.rebin_spectrum
+    """
+    return Rebin.rebin_spectrum(wave, flux, kind, step)
+
+
+@operation('continuum')
+def continuum(wave, flux, points):
+    """
+    Divide by continuum interpolated through points and cut spectrum to their range
+    :param points: ((wave, flux), ...) sorted by wave
+    """
+    points = np.array(points)
+    inside = slice(np.where(wave > np.min(points[:, 0]))[0][0], np.where(wave < np.max(points[:, 0]))[0][-1])
+    wave, flux = wave[inside], flux[inside]
+    return wave, flux / pyasl.intep(points[:, 0], points[:, 1], wave)
+
+
+def catalog_intervals(wave, velocity, catalogs):
+    """
+    Windows around lines of catalogs inside spectrum, see Continuum.mask_intervals
+    :param velocity: half width of window, km/s
+    :param catalogs: names of Pipeline.line_catalogs
+    """
+    if velocity <= 0 or not catalogs:
+        return np.zeros((0, 2))
+    line_waves = []
+    for name in catalogs:
+        if name not in Pipeline.line_catalogs:
+            raise ValueError("Line catalog %s is not loaded" % name)
+        line_waves.append(Pipeline.line_catalogs[name][0])
+    return Continuum.mask_intervals(np.concatenate(line_waves), velocity, np.min(wave), np.max(wave))
+
+
+@operation('auto_continuum', single=True)
+def auto_continuum(wave, flux, method='chebyshev', order=5, low=2.0, high=3.0, velocity=0.0, catalogs=(),
+                   anchors=()):
+    """
+    Divide by continuum fitted with sigma clipping, see Continuum.fit_continuum,
+    lines of catalogs are masked with half width velocity, km/s
+    """
+    return wave, flux / Continuum.fit_continuum(wave, flux, method, order, low, high,
+                                                intervals=catalog_intervals(wave, velocity, catalogs),
+                                                anchors=anchors)
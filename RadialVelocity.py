@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Radial velocities by FFT cross-correlation with template.
+Spectra and template are rebinned to one log-lambda grid, where Doppler shift is a constant
+pixel shift, divided by low-order continuum and cross-correlated with FFT,
+a batch of spectra in one transform. Correlation peak is refined by parabola
+through three highest points, error follows Zucker (2003, MNRAS 342, 1291).
+
+Example:
+    python RadialVelocity.py template.txt spectrum1.txt spectrum2.txt --max-velocity 500
+"""
+
+import argparse
+import sys
+import numpy as np
+
+import Rebin
+from Broadening import SPEED_OF_LIGHT
+
+RV_DTYPE = [('spectrum', object), ('velocity', np.float64), ('velocity_error', np.float64),
+            ('peak', np.float64), ('points', np.int64), ('success', bool)]
+
+BATCH_SIZE = 16
+
+
+def velocity_grid(waves, template_wave, step=None):
+    """
+    Log-lambda grid covering spectra inside template range
+    :param waves: list of wavelength arrays of spectra, any order
+    :param template_wave: template wavelengths, any order
+    :param step: log-lambda step, the finest median step of spectra by default
+    :return: grid
+    """
+    waves = [Rebin.ascending(wave)[0] for wave in waves]
+    template_wave = Rebin.ascending(template_wave)[0]
+    wave_min = max(min(wave[0] for wave in waves), template_wave[0])
+    wave_max = min(max(wave[-1] for wave in waves), template_wave[-1])
+    if wave_min >= wave_max:
+        raise ValueError("Spectra do not overlap template")
+    if step is None:
+        step = min(np.median(np.diff(np.log(wave))) for wave in waves)
+    return Rebin.log_grid(wave_min, wave_max, step)
+
+
+def line_signal(wave, flux, grid, degree=3):
+    """
+    Spectrum on grid divided by polynomial continuum minus one, zero outside spectrum
+    :return: (signal, coverage mask)
+    """
+    rebinned = Rebin.rebin(wave, flux, grid)
+    covered = np.isfinite(rebinned)
+    signal = np.zeros(grid.size)
+    if np.sum(covered) > degree + 1:
+        x = np.linspace(-1.0, 1.0, grid.size)
+        continuum = np.polynomial.chebyshev.chebval(
+            x, np.polynomial.chebyshev.chebfit(x[covered], rebinned[covered], degree))
+        good = covered & (continuum != 0)
+        signal[good] = rebinned[good] / continuum[good] - 1.0
+        covered = good
+    else:
+        covered[:] = False
+    return signal, covered
+
+
+def _peaks(ccf, max_lag):
+    """
+    Sub-pixel peak of correlation rows by parabola through maximum and its neighbours
+    :param ccf: np.array (spectra, 2 * max_lag + 1), lags -max_lag..max_lag
+    :return: (shift, peak height, curvature, success)
+    """
+    rows = np.arange(ccf.shape[0])
+    top = np.argmax(ccf, axis=1)
+    success = (top > 0) & (top < ccf.shape[1] - 1)
+    top = np.clip(top, 1, ccf.shape[1] - 2)
+    left, middle, right = ccf[rows, top - 1], ccf[rows, top], ccf[rows, top + 1]
+    curvature = left - 2.0 * middle + right
+    success &= curvature < 0
+    offset = np.where(success, 0.5 * (left - right) / np.where(success, curvature, -1.0), 0.0)
+    peak = middle - 0.25 * (left - right) * offset
+    return top - max_lag + offset, peak, curvature, success
+
+
+def measure_velocities(spectra, template_wave, template_flux, max_velocity=1000.0, step=None,
+                       batch_size=BATCH_SIZE, report=None):
+    """
+    Velocities of spectra relative to template, positive for spectrum redshifted against template
+    :param spectra: list of (name, wave, flux), wavelengths in any order, spectra are sorted on entry
+    :param template_wave: template wavelengths, any order, e.g. CMFGEN model
+    :param template_flux: template flux
+    :param max_velocity: search range, km/s
+    :param step: log-lambda step of correlation grid, see velocity_grid
+    :param batch_size: spectra transformed at once
+    :param report: progress callback
+    :return: structured array RV_DTYPE in order of spectra
+    """
+    spectra = [(name,) + Rebin.ascending(wave, flux)[:2] for name, wave, flux in spectra]
+    waves = [wave for name, wave, flux in spectra]
+    template_wave, template_flux, _ = Rebin.ascending(template_wave, template_flux)
+    grid = velocity_grid(waves, template_wave, step)
+    log_step = np.log(grid[1] / grid[0])
+    max_lag = min(int(np.ceil(np.log1p(max_velocity / SPEED_OF_LIGHT) / log_step)) + 1, grid.size - 2)
+    lags = np.arange(-max_lag, max_lag + 1)
+    size = 1 << int(np.ceil(np.log2(grid.size + max_lag + 1)))
+
+    template_signal, _ = line_signal(template_wave, template_flux, grid)
+    template_fft = np.conj(np.fft.rfft(template_signal, size))
+
+    table = np.zeros(len(spectra), dtype=RV_DTYPE)
+    for start in range(0, len(spectra), batch_size):
+        batch = spectra[start:start + batch_size]
+        signals = np.empty((len(batch), grid.size))
+        coverage = np.empty((len(batch), grid.size), dtype=bool)
+        for index, (name, wave, flux) in enumerate(batch):
+            signals[index], coverage[index] = line_signal(np.asarray(wave, dtype=np.float64),
+                                                          np.asarray(flux, dtype=np.float64), grid)
+        # ccf[k] = sum signal[i + k] * template[i], positive lag for redshifted spectrum
+        ccf = np.fft.irfft(np.fft.rfft(signals, size, axis=1) * template_fft, size, axis=1)[:, lags % size]
+        norm = np.sqrt(np.sum(signals ** 2, axis=1) * np.dot(coverage, template_signal ** 2))
+        ccf /= np.where(norm > 0, norm, 1.0)[:, np.newaxis]
+
+        shift, peak, curvature, success = _peaks(ccf, max_lag)
+        success &= (norm > 0) & (peak > 0) & (peak < 1)
+        # pixels of oversampled spectrum are not independent
+        native_steps = np.array([np.median(np.diff(np.log(waves[start + index]))) for index in range(len(batch))])
+        points = np.sum(coverage, axis=1) * np.minimum(log_step / native_steps, 1.0)
+        safe_peak = np.where(success, peak, 0.5)
+        information = -points * curvature / safe_peak * safe_peak ** 2 / (1.0 - safe_peak ** 2)
+        shift_error = np.where(success & (information > 0), 1.0 / np.sqrt(np.abs(information)), np.nan)
+
+        rows = table[start:start + len(batch)]
+        rows['spectrum'] = [name for name, wave, flux in batch]
+        rows['velocity'] = SPEED_OF_LIGHT * np.expm1(shift * log_step)
+        rows['velocity_error'] = SPEED_OF_LIGHT * np.exp(shift * log_step) * log_step * shift_error
+        rows['peak'] = peak
+        rows['points'] = np.sum(coverage, axis=1)
+        rows['success'] = success
+        if report is not None:
+            report(float(start + len(batch)) / len(spectra))
+    return table
+
+
+def format_table(table):
+    """
+    :param table: measure_velocities result
+    :return: text table
+    """
+    lines = ['# spectrum velocity velocity_error peak points success']
+    for row in table:
+        lines.append('%s %0.3f %0.3f %0.4f %d %d' % (row['spectrum'], row['velocity'], row['velocity_error'],
+                                                    row['peak'], row['points'], row['success']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Radial velocities of two-column spectra by cross-correlation')
+    parser.add_argument('template', help='template two-column table')
+    parser.add_argument('spectra', nargs='+', help='two-column tables')
+    parser.add_argument('--max-velocity', type=float, default=1000.0, help='search range, km/s')
+    args = parser.parse_args(argv)
+
+    template = np.loadtxt(args.template)
+    spectra = []
+    for file_name in args.spectra:
+        data = np.loadtxt(file_name)
+        spectra.append((file_name, data[:, 0], data[:, 1]))
+    table = measure_velocities(spectra, template[:, 0], template[:, 1], args.max_velocity)
+    print(format_table(table))
+    return 0 if np.all(table['success']) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""
+Flux-conserving rebinning between arbitrary wavelength grids.
+Flux is treated as constant inside bins around input points, its cumulative integral
+is interpolated at output bin edges, so every output bin gets mean flux over its range.
+Integral of flux over any range covered by output bins is conserved,
+NaN points and parts of output bins outside input are excluded from the mean.
+2D stacks of spectra on one grid are rebinned in one call.
+Grids may be in any order, see ascending.
+"""
+
+import hashlib
+import numpy as np
+
+
+def ascending(wave, fluxes=None):
+    """
+    Spectrum sorted by wavelength. Engines accept spectra in any wavelength order (two-column tables,
+    plot data) and sort them on entry with this, results on input grid are put back with restore_order.
+    :param wave: wavelength array
+    :param fluxes: flux array or np.array (spectra, wave.size), None to sort grid only
+    :return: (wave, fluxes, order), order is None and arrays are not copied if wave is already ascending
+    """
+    wave = np.asarray(wave, dtype=np.float64)
+    if fluxes is not None:
+        fluxes = np.asarray(fluxes, dtype=np.float64)
+    if wave.size < 2 or np.all(wave[1:] >= wave[:-1]):
+        return wave, fluxes, None
+    order = np.argsort(wave, kind='mergesort')
+    return wave[order], None if fluxes is None else fluxes[..., order], order
+
+
+def restore_order(values, order):
+    """
+    Put values computed on sorted grid back in input order
+    :param order: ascending output, None for input that was already ascending
+    """
+    if order is None:
+        return values
+    restored = np.empty_like(values)
+    restored[..., order] = values
+    return restored
+
+
+def bin_edges(wave):
+    """
+    Bin edges halfway between points, outer edges are extrapolated by half step
+    :param wave: ascending array of bin centers
+    :return: np.array of wave.size + 1 edges
+    """
+    wave = np.asarray(wave, dtype=np.float64)
+    if wave.size == 1:
+        return np.array([wave[0] - 0.5, wave[0] + 0.5])
+    middle = 0.5 * (wave[1:] + wave[:-1])
+    return np.concatenate(([wave[0] - (middle[0] - wave[0])], middle, [wave[-1] + (wave[-1] - middle[-1])]))
+
+
+def uniform_grid(wave_min, wave_max, step):
+    """
+    :return: wave_min, wave_min + step, ... not beyond wave_max
+    """
+    return wave_min + step * np.arange(int(np.floor((wave_max - wave_min) / step + 1e-9)) + 1)
+
+
+def log_grid(wave_min, wave_max, step):
+    """
+    :param step: log-lambda step, 1 / R for pixel of wave / R
+    :return: grid with constant wave ratio from wave_min, not beyond wave_max
+    """
+    return np.exp(uniform_grid(np.log(wave_min), np.log(wave_max), step))
+
+
+def make_grid(wave, kind='log', step=None):
+    """
+    Output grid covering input grid
+    :param wave: input grid, any order
+    :param kind: 'log' for log-uniform or 'uniform'
+    :param step: log-lambda step for 'log', Angstrom for 'uniform',
+        median input step by default, so dense parts of input are not collapsed to the coarsest spacing
+    :return: new grid
+    """
+    wave = np.asarray(wave, dtype=np.float64)
+    if np.any(wave[1:] < wave[:-1]):
+        wave = np.sort(wave)
+    if kind == 'log':
+        if step is None:
+            step = np.median(np.diff(np.log(wave)))
+        return log_grid(wave[0], wave[-1], step)
+    elif kind == 'uniform':
+        if step is None:
+            step = np.median(np.diff(wave))
+        return uniform_grid(wave[0], wave[-1], step)
+    raise ValueError("kind must be 'log' or 'uniform'")
+
+
+def grid_key(wave):
+    """
+    :return: hashable key identifying grid by its values, for caches of grid-dependent arrays
+    """
+    wave = np.ascontiguousarray(wave, dtype=np.float64)
+    return wave.size, hashlib.sha1(wave.tobytes()).hexdigest()
+
+
+def same_grid_groups(waves):
+    """
+    :param waves: list of wavelength arrays
+    :return: lists of indexes of spectra with identical grids, such spectra are processed as one 2D stack
+    """
+    groups = []
+    for index, wave in enumerate(waves):
+        for group in groups:
+            first = waves[group[0]]
+            if first.shape == wave.shape and np.array_equal(first, wave):
+                group.append(index)
+                break
+        else:
+            groups.append([index])
+    return groups
+
+
+def _cumulative(edges, values):
+    """
+    :return: integrals of piecewise constant values from edges[0] to every edge
+    """
+    integral = np.zeros(values.shape[:-1] + (edges.size,))
+    np.cumsum(values * np.diff(edges), axis=-1, out=integral[..., 1:])
+    return integral
+
+
+def rebin(wave, fluxes, new_wave, new_edges=None):
+    """
+    Flux-conserving rebinning of spectra from one grid to another
+    :param wave: input grid, any order and spacing
+    :param fluxes: flux array or np.array (spectra, wave.size)
+    :param new_wave: output grid, any spacing, ascending if new_edges are given
+    :param new_edges: output bin edges, bin_edges(new_wave) by default
+    :return: mean flux in output bins in order of new_wave, same number of dimensions as fluxes,
+        NaN for bins without input
+    """
+    wave, fluxes, _ = ascending(wave, fluxes)
+    if new_edges is None:
+        new_wave, _, new_order = ascending(new_wave)
+        if new_order is not None:
+            return restore_order(rebin(wave, fluxes, new_wave), new_order)
+    single = fluxes.ndim == 1
+    fluxes = np.atleast_2d(fluxes)
+    if new_edges is None:
+        new_edges = bin_edges(new_wave)
+    edges = bin_edges(wave)
+
+    finite = np.isfinite(fluxes)
+    flux_integral = _cumulative(edges, np.where(finite, fluxes, 0.0))
+    coverage_integral = _cumulative(edges, finite.astype(np.float64))
+
+    # cumulative integrals are linear between input edges, interpolation weights are shared by all rows
+    clipped = np.clip(new_edges, edges[0], edges[-1])
+    right = np.clip(np.searchsorted(edges, clipped, 'right'), 1, edges.size - 1)
+    left = right - 1
+    width = edges[right] - edges[left]
+    weight = np.clip((clipped - edges[left]) / np.where(width > 0, width, 1.0), 0.0, 1.0)
+
+    def at_edges(integral):
+        return integral[:, left] * (1.0 - weight) + integral[:, right] * weight
+
+    flux_sum = np.diff(at_edges(flux_integral), axis=1)
+    coverage = np.diff(at_edges(coverage_integral), axis=1)
+    covered = coverage > 1e-12 * np.diff(new_edges)
+    result = np.where(covered, flux_sum / np.where(covered, coverage, 1.0), np.nan)
+    return result[0] if single else result
+
+
+def rebin_spectrum(wave, flux, kind='log', step=None):
+    """
+    Rebin spectrum to grid made by make_grid
+    :return: (new_wave, new_flux)
+    """
+    new_wave = make_grid(wave, kind, step)
+    return new_wave, rebin(wave, flux, new_wave)
@@ -0,0 +1,66 @@
+import numpy as np
+from PyQt4.QtGui import QDialog, QVBoxLayout, QHBoxLayout, QPushButton, QTableWidget, QTableWidgetItem
+from PyQt4.QtGui import QFileDialog, QAbstractItemView
+from PyQt4 import QtCore
+
+
+class ResultTableDialog(QDialog):
+    """Window with structured array as table and button for saving it as text.
+     Attributes:
+         table (np.array): structured array, one row per table row.
+         text (str): table formatted for file.
+    """
+
+    def __init__(self, parent, title, table, text):
+        """
+        :param parent: main window
+        :param title: window title
+        :param table: structured array
+        :param text: text table to save, e.g. format_table(table)
+        """
+        QDialog.__init__(self, parent)
+        self.setWindowTitle(title)
+        self.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+        self.table = table
+        self.text = text
+
+        self.table_widget = QTableWidget(len(table), len(table.dtype.names), self)
+        self.table_widget.setHorizontalHeaderLabels(list(table.dtype.names))
+        self.table_widget.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        for row_index, row in enumerate(table):
+            for column_index, name in enumerate(table.dtype.names):
+                self.table_widget.setItem(row_index, column_index, QTableWidgetItem(self.format_value(row[name])))
+        self.table_widget.resizeColumnsToContents()
+
+        self.save_button = QPushButton('Save', self)
+        self.save_button.clicked.connect(self.save)
+        self.close_button = QPushButton('Close', self)
+        self.close_button.clicked.connect(self.close)
+
+        buttons = QHBoxLayout()
+        buttons.addStretch()
+        buttons.addWidget(self.save_button)
+        buttons.addWidget(self.close_button)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.table_widget)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+        self.resize(900, 400)
+
+    @staticmethod
+    def format_value(value):
+        if isinstance(value, (float, np.floating)):
+            return '%0.6g' % value
+        if isinstance(value, bytes):
+            return value.decode('latin-1')
+        return unicode(value)
+
+    def save(self):
+        """
+        Save text table to chosen file
+        """
+        file_name = unicode(QFileDialog.getSaveFileName(self, 'Save table'))
+        if file_name != '':
+            with open(file_name, 'w') as table_file:
+                table_file.write(self.text + '\n')
@@ -0,0 +1,107 @@
+"""
+Binary session container.
+File is magic, length of JSON header, JSON header and array blocks aligned to ALIGNMENT bytes.
+Header holds session description and table of arrays (dtype, shape, offset, compression).
+Raw arrays are memory-mapped on load without reading, zlib-compressed ones are decompressed.
+
+Layout:
+    MAGIC | header length, uint64 little-endian | header | padding | array blocks
+"""
+
+import os
+import json
+import zlib
+import struct
+import threading
+import numpy as np
+
+MAGIC = b'SPECSESS'
+VERSION = 1
+ALIGNMENT = 64
+
+_LENGTH = struct.Struct('<Q')
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_session(file_name, session, arrays, compress=False, level=1):
+    """
+    Write session description and arrays into one file, file is replaced atomically
+    :param file_name: session filename
+    :param session: JSON serializable description
+    :param arrays: dict name -> np.array of numeric or bytes dtype
+    :param compress: store arrays zlib-compressed, smaller file but load reads and decompresses them
+    :param level: zlib compression level
+    """
+    table = {}
+    blocks = []
+    offset = 0
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        if array.dtype.hasobject:
+            raise ValueError("Array %s has object dtype" % name)
+        data = array.tobytes()
+        if compress:
+            data = zlib.compress(data, level)
+        table[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset,
+                       'nbytes': len(data), 'compression': 'zlib' if compress else None}
+        blocks.append((offset, data))
+        offset = _aligned(offset + len(data))
+
+    header = json.dumps({'version': VERSION, 'session': session, 'arrays': table}).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + _LENGTH.size + len(header))
+
+    tmp_path = '%s.%d.%d.tmp' % (file_name, os.getpid(), threading.current_thread().ident)
+    with open(tmp_path, 'wb') as session_file:
+        session_file.write(MAGIC + _LENGTH.pack(len(header)) + header)
+        for block_offset, data in blocks:
+            session_file.seek(data_start + block_offset)
+            session_file.write(data)
+        session_file.truncate(data_start + offset)
+    os.rename(tmp_path, file_name)
+
+
+def read_header(file_name):
+    """
+    :return: (header dict, offset of array blocks)
+    """
+    with open(file_name, 'rb') as session_file:
+        if session_file.read(len(MAGIC)) != MAGIC:
+            raise IOError("%s is not a session file" % file_name)
+        length, = _LENGTH.unpack(session_file.read(_LENGTH.size))
+        header = json.loads(session_file.read(length).decode('utf-8'))
+    if header['version'] > VERSION:
+        raise IOError("Session file version %d is not supported" % header['version'])
+    return header, _aligned(len(MAGIC) + _LENGTH.size + length)
+
+
+def read_session(file_name):
+    """
+    Read session file, raw arrays are read-only views of one memory map
+    :param file_name: session filename
+    :return: (session description, dict name -> np.array)
+    """
+    header, data_start = read_header(file_name)
+    table = header['arrays']
+    arrays = {}
+    whole = None
+    if any(entry['compression'] is None and entry['nbytes'] > 0 for entry in table.values()):
+        whole = np.memmap(file_name, dtype=np.uint8, mode='r')
+    for name, entry in table.items():
+        dtype = np.dtype(str(entry['dtype']))
+        shape = tuple(entry['shape'])
+        start = data_start + entry['offset']
+        if entry['nbytes'] == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        elif entry['compression'] is None:
+            arrays[name] = np.asarray(whole[start:start + entry['nbytes']]).view(dtype).reshape(shape)
+        elif entry['compression'] == 'zlib':
+            with open(file_name, 'rb') as session_file:
+                session_file.seek(start)
+                data = zlib.decompress(session_file.read(entry['nbytes']))
+            arrays[name] = np.frombuffer(data, dtype=dtype).reshape(shape)
+        else:
+            raise IOError("Unknown compression %s" % entry['compression'])
+    return header['session'], arrays
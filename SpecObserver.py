@@ -1,20 +1,45 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 import numpy as np
 from PyQt4.QtGui import QMainWindow, QApplication, QHBoxLayout, QAbstractItemView, QWidget, QVBoxLayout
 from PyQt4.QtGui import QAction, QPushButton, QListWidget, QListWidgetItem, QLabel, QInputDialog
-from PyQt4.QtGui import QFileDialog
+from PyQt4.QtGui import QFileDialog, QProgressBar, QDialog
 from PyQt4.QtGui import QIcon
 from PyQt4.QtGui import QMessageBox
 from PyQt4 import QtCore
 from PyAstronomy import pyasl
-from pyqtgraph import GraphicsWindow, mkColor, InfiniteLine, SignalProxy, setConfigOption
-from scipy.optimize import curve_fit
+from pyqtgraph import GraphicsWindow, mkColor, SignalProxy, setConfigOption
 from scipy.interpolate import interp1d
 
+import BlackBody
+import Broadening
 import CmfgenParse
+import CmfgenBatch
+import Coadd
+import Continuum
+import EquivalentWidth
+import Extinction
+import FitsLoader
+import GridFit
+import Ingest
+import LineCatalog
+import LineFit
+import RadialVelocity
+import Rebin
+import Session
+from LodPlot import LodPlotDataItem
+from LineMarkers import LineMarkerLayer
+from Pipeline import Pipeline, catalog_intervals
+from Jobs import JobManager
+from ResultTable import ResultTableDialog
+from VsiniScan import VsiniScanDialog, scan_window
+
+SPEED_OF_LIGHT = 299792.458
+# models per grid fit job
+MODEL_CHUNK = 32
 
 
 class SpecObserver(QMainWindow):
@@ -25,65 +50,94 @@ class SpecObserver(QMainWindow):
 
     def fits_plot(self):
         """
-        Method for plotting spectrum from 1D FITS file.
-        If plotting completed successfully, method will change text color in main window,
-        else fits_plot will call fits_error_event for displaying IOError.
+        Method for plotting spectrum from FITS file, any extension or echelle order.
+        File is read in background, on success plot is added,
+        else fits_plot will call fits_error_event for displaying error.
         Call add_to_list_widget with plot item name.
         """
+        fits_file = unicode(QFileDialog.getOpenFileName(self, 'Open FITS file'))
+        if fits_file != '':
+            spectrum = self.choose_fits_spectrum(fits_file)
+            if spectrum is None:
+                return
+            plot_name, hdu, order = spectrum
+            self.jobs.submit('Loading ' + plot_name, FitsLoader.read_spectrum, (fits_file, hdu, order),
+                             on_result=lambda result: self.add_plot(plot_name, result[0], result[1], fits_file),
+                             on_error=self.fits_error_event)
+
+    def choose_fits_spectrum(self, fits_file):
+        """
+        List spectra of FITS file from headers and let user choose one if there are several
+        :return: (plot name, hdu, order) or None if cancelled or there are no spectra
+        """
         try:
-            fits_file = unicode(QFileDialog.getOpenFileName(self, 'Open FITS file'))
-            if fits_file != '':
-                wave, flux = pyasl.read1dFitsSpec(fits_file)
-                current_plot = self.pw.plot(wave, flux, pen=mkColor(self.i))
-                plot_name = fits_file.split("/")[-1]
-                self.all_plot_items[plot_name] = current_plot
-                self.all_fits_paths[plot_name] = fits_file
-                self.add_to_list_widget(plot_name)
-                self.i += 2
-        except IOError as exception:
-            self.fits_error_event(exception.message)
+            spectra = FitsLoader.find_spectra(fits_file)
+        except (IOError, ValueError, KeyError) as exception:
+            self.fits_error_event(unicode(exception))
+            return None
+        if not spectra:
+            self.fits_error_event('No spectra found')
+            return None
+        plot_name = fits_file.split("/")[-1]
+        if len(spectra) == 1:
+            return plot_name, spectra[0].hdu, spectra[0].order
+        labels = [spectrum.label for spectrum in spectra]
+        label, ok = QInputDialog.getItem(self, 'Open FITS file', 'Extension or order:', labels, 0, False)
+        if not ok:
+            return None
+        spectrum = spectra[labels.index(unicode(label))]
+        return '%s [%s]' % (plot_name, spectrum.label), spectrum.hdu, spectrum.order
 
     def fits_plot_binned(self):
         """
-        Method for plotting spectrum from 1D FITS file.
-        If plotting completed successfully, method will change text color in main window,
-        else fits_plot will call fits_error_event for displaying IOError.
+        Method for plotting binned spectrum from FITS file.
+        File is read in background, on success plot is added,
+        else fits_plot will call fits_error_event for displaying error.
         Call add_to_list_widget with plot item name.
         """
-        try:
-            fits_file = unicode(QFileDialog.getOpenFileName(self, 'Open FITS file'))
-            if fits_file != '':
-                wave, flux = pyasl.read1dFitsSpec(fits_file)
-                dt = 2 * (wave[1] - wave[0])
-                print dt
-                fits_binned_data, dt = pyasl.binningx0dt(wave, flux,
-                                                           x0=min(wave), dt=dt)
-                current_plot = self.pw.plot(fits_binned_data[:, 0], fits_binned_data[:, 1], pen=mkColor(self.i))
-                plot_name = fits_file.split("/")[-1]
-                self.all_plot_items[plot_name] = current_plot
-                self.all_fits_paths[plot_name] = fits_file
-                self.add_to_list_widget(plot_name)
-                self.i += 2
-        except IOError as exception:
-            self.fits_error_event(exception.message)
+        fits_file = unicode(QFileDialog.getOpenFileName(self, 'Open FITS file'))
+        if fits_file != '':
+            spectrum = self.choose_fits_spectrum(fits_file)
+            if spectrum is None:
+                return
+            plot_name, hdu, order = spectrum
+            self.jobs.submit('Loading ' + plot_name, SpecObserver.read_fits_binned, (fits_file, hdu, order),
+                             on_result=lambda result: self.add_plot(plot_name, result[0], result[1], fits_file),
+                             on_error=self.fits_error_event, report=True)
+
+    @staticmethod
+    def read_fits_binned(fits_file, hdu=0, order=0, report=None):
+        """
+        :return: (wave, flux) of FITS spectrum binned to two pixels
+        """
+        wave, flux = FitsLoader.read_spectrum(fits_file, hdu, order)
+        if report is not None:
+            report(0.5)
+        dt = 2 * (wave[1] - wave[0])
+        return Rebin.rebin_spectrum(wave, flux, 'uniform', dt)
 
     def fits_plot_smooth(self):
-        try:
-            fits_file = unicode(QFileDialog.getOpenFileName(self, 'Open FITS file'))
-            if fits_file != '':
-                wave, flux = pyasl.read1dFitsSpec(fits_file)
-                flux = np.nan_to_num(flux)
-                fits_smoothed, fwhm = pyasl.instrBroadGaussFast(wave, flux,
-                                                                  1050, fullout=True, edgeHandling="firstlast")
-                print fwhm
-                current_plot = self.pw.plot(wave, fits_smoothed, pen=mkColor(self.i))
-                plot_name = fits_file.split("/")[-1]
-                self.all_plot_items[plot_name] = current_plot
-                self.all_fits_paths[plot_name] = fits_file
-                self.add_to_list_widget(plot_name)
-                self.i += 2
-        except IOError as exception:
-            self.fits_error_event(exception.message)
+        fits_file = unicode(QFileDialog.getOpenFileName(self, 'Open FITS file'))
+        if fits_file != '':
+            spectrum = self.choose_fits_spectrum(fits_file)
+            if spectrum is None:
+                return
+            plot_name, hdu, order = spectrum
+            self.jobs.submit('Loading ' + plot_name, SpecObserver.read_fits_smooth, (fits_file, hdu, order),
+                             on_result=lambda result: self.add_plot(plot_name, result[0], result[1], fits_file),
+                             on_error=self.fits_error_event, report=True)
+
+    @staticmethod
+    def read_fits_smooth(fits_file, hdu=0, order=0, report=None):
+        """
+        :return: (wave, flux) of FITS spectrum broadened to R = 1050
+        """
+        wave, flux = FitsLoader.read_spectrum(fits_file, hdu, order)
+        if report is not None:
+            report(0.5)
+        flux = np.nan_to_num(flux)
+        fits_smoothed = Broadening.broaden(wave, flux, 1050)
+        return wave, fits_smoothed
 
     def fits_error_event(self, message):
         """
@@ -105,79 +159,95 @@ class SpecObserver(QMainWindow):
     def load_lines(self):
         """
         Method for plot spectrum lines with labels.
+        Lines of every file are kept as catalog of line_markers layer,
+        only lines in view range are drawn.
         Problems with flux < 10**-16
         """
         lines_data_file = unicode(QFileDialog.getOpenFileName(self, 'Open file'))
 
         if lines_data_file != '':
-            lines_data = np.genfromtxt(lines_data_file, dtype=str)
-
-            if len(lines_data) > 1:
-                lines_number = len(lines_data[:, 0])
-            else:
-                lines_number = 1
-            for i in range(lines_number):
-                if i % 3 == 0:
-                    line_label_position = 0.75
-                elif i % 3 == 1:
-                    line_label_position = 0.85
-                else:
-                    line_label_position = 0.90
-                line = InfiniteLine(pos=float(lines_data[i, 0]), label=lines_data[i, 1],
-                                    labelOpts={'position': line_label_position, 'color': mkColor("w")},
-                                    name=lines_data[i, 1])
-                line.setPen(style=QtCore.Qt.DotLine)
-                self.pw.addItem(line)
-                self.all_lines.append([float(lines_data[i, 0]), lines_data[i, 1]])
-                self.line_items.append(line)
-        """
-        Method asking user about exit from application
-        :param event: Accept close event
-        """
+            lines_data = LineCatalog.load_catalog_file(lines_data_file)
+            self.line_markers.add_catalog(lines_data_file.split("/")[-1], lines_data['wave'], lines_data['label'])
 
     def remove_lines(self):
-        for line in self.line_items:
-            self.pw.removeItem(line)
+        """
+        Remove line catalog, user chooses one if several catalogs are loaded
+        """
+        catalogs = list(self.line_markers.catalogs.keys())
+        if len(catalogs) > 1:
+            all_catalogs = 'All catalogs'
+            catalog, ok = QInputDialog.getItem(self, 'Remove lines', 'Catalog:',
+                                               [all_catalogs] + catalogs, 0, False)
+            if not ok:
+                return
+            catalog = unicode(catalog)
+            if catalog != all_catalogs:
+                self.line_markers.remove_catalog(catalog)
+                return
+        self.line_markers.clear()
 
     def table_plot(self):
         """
-        Plot data from simple table.
-        If plotting completed successfully, method will change text color in main window,
-        else table_plot will call table_error_event for displaying IOError.
+        Plot binned data from simple table.
+        User chooses output grid, file is read in background, on success plot is added,
+        else table_plot will call table_error_event for displaying error.
         Call add_to_list_widget with plot item name.
         """
-        try:
-            file_name = unicode(QFileDialog.getOpenFileName(self, 'Open two-column table data file'))
-            if file_name != '':
-                data = np.loadtxt(file_name)
-                dt = max(data[1:, 0] - data[0:-1, 0])
-                binned_data, dt = pyasl.binningx0dt(data[:, 0], data[:, 1], x0=min(data[:, 0]), dt=dt)
-                current_plot = self.pw.plot(binned_data[:, 0], binned_data[:, 1], pen=mkColor(self.i))
-                plot_name = file_name.split("/")[-1]
-                self.all_plot_items[plot_name] = current_plot
-                self.add_to_list_widget(plot_name)
-                self.i += 2
-        except IOError as exception:
-            self.table_error_event(exception.message)
+        file_name = unicode(QFileDialog.getOpenFileName(self, 'Open two-column table data file'))
+        if file_name != '':
+            grid = self.ask_rebin_grid('Table binning')
+            if grid is None:
+                return
+            plot_name = file_name.split("/")[-1]
+            self.jobs.submit('Loading ' + plot_name, SpecObserver.read_table_binned, (file_name,) + grid,
+                             on_result=lambda result: self.add_plot(plot_name, result[0], result[1]),
+                             on_error=self.table_error_event, report=True)
+
+    @staticmethod
+    def read_table_binned(file_name, kind='log', step=None, report=None):
+        """
+        :param kind: output grid, see Rebin.make_grid
+        :param step: output grid step, median step of table by default
+        :return: (wave, flux) of two-column table rebinned with flux conservation
+        """
+        data = np.loadtxt(file_name)
+        if report is not None:
+            report(0.5)
+        return Rebin.rebin_spectrum(data[:, 0], data[:, 1], kind, step)
+
+    def ask_rebin_grid(self, title):
+        """
+        Ask kind and step of rebinning grid
+        :return: (kind, step) for Rebin.make_grid, step is None for median step, None if cancelled
+        """
+        grids = ['Log-uniform, median step', 'Uniform, median step',
+                 'Log-uniform, resolving power', 'Uniform, step in Angstrom']
+        grid, ok = QInputDialog.getItem(self, title, 'Grid:', grids, 0, False)
+        if not ok:
+            return None
+        grid = grids.index(unicode(grid))
+        kind = 'log' if grid % 2 == 0 else 'uniform'
+        if grid < 2:
+            return kind, None
+        if kind == 'log':
+            value, ok = QInputDialog.getDouble(self, title, 'Resolving power:', 15000.0, 1.0, 1e7, 1)
+            return (kind, 1.0 / value) if ok else None
+        value, ok = QInputDialog.getDouble(self, title, 'Step, Angstrom:', 1.0, 1e-6, 1e6, 6)
+        return (kind, value) if ok else None
 
     def simple_table_plot(self):
         """
         Plot data from simple table.
-        If plotting completed successfully, method will change text color in main window,
-        else table_plot will call table_error_event for displaying IOError.
+        File is read in background, on success plot is added,
+        else table_plot will call table_error_event for displaying error.
         Call add_to_list_widget with plot item name.
         """
-        try:
-            file_name = unicode(QFileDialog.getOpenFileName(self, 'Open two-column table data file'))
-            if file_name != '':
-                data = np.loadtxt(file_name)
-                current_plot = self.pw.plot(data[:, 0], data[:, 1], pen=mkColor(self.i))
-                plot_name = file_name.split("/")[-1]
-                self.all_plot_items[plot_name] = current_plot
-                self.add_to_list_widget(plot_name)
-                self.i += 2
-        except IOError as exception:
-            self.table_error_event(exception.message)
+        file_name = unicode(QFileDialog.getOpenFileName(self, 'Open two-column table data file'))
+        if file_name != '':
+            plot_name = file_name.split("/")[-1]
+            self.jobs.submit('Loading ' + plot_name, np.loadtxt, (file_name,),
+                             on_result=lambda data: self.add_plot(plot_name, data[:, 0], data[:, 1]),
+                             on_error=self.table_error_event)
 
     def table_error_event(self, message):
         """
@@ -187,224 +257,477 @@ class SpecObserver(QMainWindow):
         """
         QMessageBox.critical(self, "IOError", "Can't read table file\n" + message)
 
+    def open_files(self):
+        """
+        Open many FITS and table files at once, see start_ingest
+        """
+        files = [unicode(file_name) for file_name in QFileDialog.getOpenFileNames(self, 'Open spectrum files')]
+        if files:
+            self.start_ingest(files)
+
+    def open_directory(self):
+        """
+        Open every FITS and table file of directory, see start_ingest
+        """
+        directory = unicode(QFileDialog.getExistingDirectory(self, 'Open directory with spectra'))
+        if directory != '':
+            files = Ingest.find_spectrum_files(directory)
+            if not files:
+                QMessageBox.information(self, 'Message', "No spectrum files in\n" + directory)
+                return
+            self.start_ingest(files)
+
+    def start_ingest(self, files):
+        """
+        Read files in parallel in background, one thread job per file,
+        every spectrum (all spectra of multi-extension FITS) is plotted and added to list widget
+        as soon as its file is read, unreadable files are listed by ingest_error_event when all files are done.
+        """
+        self.jobs.map('Reading %d files' % len(files), Ingest.read_file, files, on_item=self.add_ingested,
+                      on_result=self.ingest_finished, on_error=self.table_error_event)
+
+    def add_ingested(self, result):
+        """
+        Plot spectra of one read file
+        :param result: Ingest.read_file result
+        """
+        file_name, spectra, error = result
+        for name, wave, flux, fits_path in spectra:
+            self.add_plot(self.unique_plot_name(name), wave, flux, fits_path)
+
+    def ingest_finished(self, results):
+        """
+        List unreadable files when all files are read
+        :param results: list of Ingest.read_file results
+        """
+        self.ingest_error_event(['%s: %s' % (os.path.basename(file_name), error)
+                                 for file_name, spectra, error in filter(None, results) if error is not None])
+
+    def unique_plot_name(self, name):
+        """
+        :return: name, with number appended if plot with this name exists
+        """
+        unique_name = name
+        number = 2
+        while unique_name in self.all_plot_items:
+            unique_name = '%s (%d)' % (name, number)
+            number += 1
+        return unique_name
+
+    def ingest_error_event(self, errors):
+        """
+        Method creates window with list of files which can't be read.
+        :param errors: list of error messages, nothing is shown if empty.
+        """
+        if errors:
+            shown = errors[:20]
+            if len(errors) > len(shown):
+                shown.append('... and %d more' % (len(errors) - len(shown)))
+            QMessageBox.warning(self, "IOError", "Can't read %d files\n" % len(errors) + '\n'.join(shown))
+
+    def watch_folder(self):
+        """
+        Start watching directory, or stop if already watching.
+        Files appearing in directory are read when their size stops changing between two checks,
+        files present at start are skipped.
+        """
+        if self.watched_directory is not None:
+            self.watcher.removePath(self.watched_directory)
+            self.watch_timer.stop()
+            self.watched_directory = None
+            self.watch_action.setText('Watch folder')
+            return
+        directory = unicode(QFileDialog.getExistingDirectory(self, 'Select directory to watch'))
+        if directory == '':
+            return
+        self.watched_directory = directory
+        self.watched_files = set(Ingest.find_spectrum_files(directory))
+        self.pending_sizes = {}
+        self.watcher.addPath(directory)
+        self.watch_action.setText('Stop watching')
+
+    def check_watched_folder(self):
+        """
+        Read new files of watched directory whose size did not change since last check,
+        check again later while some files are still growing
+        """
+        if self.watched_directory is None:
+            return
+        new_files = []
+        for file_name in Ingest.find_spectrum_files(self.watched_directory):
+            if file_name in self.watched_files:
+                continue
+            try:
+                size = os.path.getsize(file_name)
+            except OSError:
+                continue
+            if size > 0 and self.pending_sizes.get(file_name) == size:
+                del self.pending_sizes[file_name]
+                self.watched_files.add(file_name)
+                new_files.append(file_name)
+            else:
+                self.pending_sizes[file_name] = size
+        if self.pending_sizes:
+            self.watch_timer.start()
+        if new_files:
+            self.start_ingest(new_files)
+
     def clear_plot(self):
         """
         Remove all plots from widget and reset color
         """
         self.i = 0
+        self.jobs.cancel_all()
         self.pw.clear()
         self.all_plot_items = {}
         self.all_point_items = {}
         self.all_fits_paths = {}
-        self.all_lines = []
-        self.line_items = []
+        self.plot_velocities = {}
+        self.pipelines = {}
+        self.line_markers.clear()
         self.listWidget.clear()
         self.listPointWidget.clear()
 
     def cmfgen_plot(self):
         """
         Method for plotting spectrum from CMFGEN model.
-        If plotting completed successfully, method will change text color in main window,
-        else cmfgen_plot will call cmfgen_error_event for displaying IOError.
+        Model is processed in background, on success plot is added,
+        else cmfgen_plot will call cmfgen_error_event for displaying error.
         Call add_to_list_widget with plot item name.
         """
-        try:
-            cmfgen_filename = unicode(QFileDialog.getOpenFileName(self, 'Open CMFGEN model file'))
-
-            if cmfgen_filename != '':
-                reply = QMessageBox.question(self, 'Message',
-                                             "Do you want to plot normalized spectrum from *cont file?",
-                                             QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
-
-                x_limit_left = 4400
-                x_limit_right = 4950
-
-                cmfgen_modeldata = CmfgenParse.spectr_input(cmfgen_filename)
-                cmfgen_modeldata = cmfgen_modeldata[:np.where(cmfgen_modeldata[:, 0] < x_limit_right)[0][-1], :]
-                cmfgen_modeldata = cmfgen_modeldata[np.where(cmfgen_modeldata[:, 0] > x_limit_left)[0][0]:, :]
-
-                dt = max(cmfgen_modeldata[1:, 0] - cmfgen_modeldata[0:-1, 0])
-                cmfgen_binned_data, dt = pyasl.binningx0dt(cmfgen_modeldata[:, 0], cmfgen_modeldata[:, 1],
-                                                           x0=min(cmfgen_modeldata[:, 0]), dt=dt)
-                cmfgen_smoothed, fwhm = pyasl.instrBroadGaussFast(cmfgen_binned_data[:, 0], cmfgen_binned_data[:, 1],
-                                                                  15000, fullout=True)
-                #cmfgen_smoothed = pyasl.rotBroad(cmfgen_binned_data[:, 0], cmfgen_smoothed, 0.1, 49)
-                print fwhm
-                cmfgen_smoothed = pyasl.rotBroad(cmfgen_binned_data[:, 0], cmfgen_smoothed, 0.0, 110.0)
-                if reply == QMessageBox.Yes:
-                    cmfgen_filename_cont = cmfgen_filename[0:-3] + 'cont'
-                    cont = CmfgenParse.spectr_input(cmfgen_filename_cont)
-                    interpolated_data = pyasl.intep(cont[:, 0], cont[:, 1], cmfgen_binned_data[:, 0])
-                    #rot = pyasl.rotBroad(cmfgen_binned_data[:, 0], cmfgen_smoothed / interpolated_data, 0.0, 49)
-                    #current_plot = self.pw.plot(cmfgen_binned_data[:, 0],
-                    #                            (rot), pen=mkColor(self.i))
-                    current_plot = self.pw.plot(cmfgen_binned_data[:, 0],
-                                                (cmfgen_smoothed / interpolated_data), pen=mkColor(self.i))
-                else:
-                    current_plot = self.pw.plot(cmfgen_binned_data[:, 0], cmfgen_smoothed, pen=mkColor(self.i))
-                plot_name = cmfgen_filename.split("/")[-3]
-                self.all_plot_items[plot_name] = current_plot
-                self.add_to_list_widget(plot_name)
-                self.i += 2
-        except IOError as exception:
-            self.cmfgen_error_event(exception.message)
+        cmfgen_filename = unicode(QFileDialog.getOpenFileName(self, 'Open CMFGEN model file'))
+
+        if cmfgen_filename != '':
+            reply = QMessageBox.question(self, 'Message',
+                                         "Do you want to plot normalized spectrum from *cont file?",
+                                         QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+
+            x_limit_left = 4400
+            x_limit_right = 4950
 
+            plot_name = cmfgen_filename.split("/")[-3]
+            self.jobs.submit('Processing ' + plot_name, CmfgenBatch.process_model,
+                             (cmfgen_filename, x_limit_left, x_limit_right, 15000),
+                             {'vsini': 110.0, 'normalize': reply == QMessageBox.Yes},
+                             on_result=lambda data: self.add_plot(plot_name, data[:, 0], data[:, 1]),
+                             on_error=self.cmfgen_error_event)
 
     def cmfgen_plot_bbcont(self):
         """
         Method for plotting spectrum with bb cont from CMFGEN model.
-        """
-        try:
-            cmfgen_filename = unicode(QFileDialog.getOpenFileName(self, 'Open CMFGEN model file + bb'))
+        Dilution factors of black bodies and scale of model are fitted to chosen plot or entered.
+        """
+        cmfgen_filename = unicode(QFileDialog.getOpenFileName(self, 'Open CMFGEN model file + bb'))
+
+        if cmfgen_filename != '':
+            reply = QMessageBox.question(self, 'Message',
+                                         "Do you want to plot normalized spectrum from *cont file?",
+                                         QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            text, ok = QInputDialog.getText(self, 'Black body continuum', 'Temperatures, K:', text='5400, 7700')
+            if not ok or text == '':
+                return
+            try:
+                temperatures = [float(value) for value in eval('(' + str(text) + ',)')]
+            except (NameError, SyntaxError, TypeError, ValueError) as exception:
+                self.name_error_event(unicode(exception))
+                return
+
+            choices = ['Fit to ' + unicode(self.listWidget.item(row).text()) for row in range(self.listWidget.count())]
+            choices.append('Enter dilution factors')
+            choice, ok = QInputDialog.getItem(self, 'Black body continuum', 'Dilution factors:', choices, 0, False)
+            if not ok:
+                return
+            observed = None
+            factors = None
+            if choices.index(unicode(choice)) < len(choices) - 1:
+                wave, flux = self.all_plot_items[unicode(choice)[len('Fit to '):]].getData()
+                observed = (np.array(wave), np.array(flux))
+            else:
+                text, ok = QInputDialog.getText(self, 'Black body continuum', 'Dilution factors:',
+                                                text=', '.join(['0'] * len(temperatures)))
+                if not ok or text == '':
+                    return
+                try:
+                    factors = [float(value) for value in eval('(' + str(text) + ',)')]
+                except (NameError, SyntaxError, TypeError, ValueError) as exception:
+                    self.name_error_event(unicode(exception))
+                    return
+
+            plot_name = cmfgen_filename.split("/")[-3] + 'bb'
+            self.jobs.submit('Processing ' + plot_name, SpecObserver.process_cmfgen_bbcont,
+                             (cmfgen_filename, reply == QMessageBox.Yes, temperatures, factors, observed),
+                             on_result=lambda result: self.show_cmfgen_bbcont(plot_name, temperatures, result),
+                             on_error=self.cmfgen_error_event, report=True)
+
+    def show_cmfgen_bbcont(self, plot_name, temperatures, result):
+        """
+        Add CMFGEN model with black body continuum and show its coefficients
+        """
+        wave, flux, base_scale, factors = result
+        self.add_plot(plot_name, wave, flux)
+        self.label.setText("Model scale %0.4e\n" % base_scale +
+                           "\n".join("%0.0f K: %0.4e" % (temperature, factor)
+                                      for temperature, factor in zip(temperatures, factors)))
 
-            if cmfgen_filename != '':
-                reply = QMessageBox.question(self, 'Message',
-                                             "Do you want to plot normalized spectrum from *cont file?",
-                                             QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+    @staticmethod
+    def process_cmfgen_bbcont(cmfgen_filename, normalize, temperatures, factors=None, observed=None, report=None):
+        """
+        CMFGEN model with black body continuum added
+        :param cmfgen_filename: CMFGEN model filename
+        :param normalize: divide by *cont file plus black body
+        :param temperatures: black-body temperatures, K
+        :param factors: dilution factors, model scale is 1, fitted to observed if None
+        :param observed: (wave, flux) observed spectrum for fitting model scale and dilution factors
+        :param report: progress callback
+        :return: (wave, flux, model scale, dilution factors)
+        """
+        x_limit_left = 4300
+        x_limit_right = 6800
+
+        cmfgen_modeldata = CmfgenParse.load_model(cmfgen_filename, x_limit_left, x_limit_right)
+        if report is not None:
+            report(0.3)
+
+        cmfgen_binned_data = np.column_stack(Rebin.rebin_spectrum(cmfgen_modeldata[:, 0], cmfgen_modeldata[:, 1]))
+        wave = cmfgen_binned_data[:, 0]
+        cmfgen_smoothed = Broadening.broaden(wave, cmfgen_binned_data[:, 1], 1650)
+        if report is not None:
+            report(0.6)
+
+        base_scale = 1.0
+        if factors is None:
+            observed_wave, observed_flux = observed
+            inside = (observed_wave >= wave[0]) & (observed_wave <= wave[-1])
+            if np.sum(inside) < len(temperatures) + 2:
+                raise ValueError("Observed spectrum does not overlap model")
+            base = np.interp(observed_wave[inside], wave, cmfgen_smoothed)
+            base_scale, factors, _ = BlackBody.fit_dilution(observed_wave[inside], observed_flux[inside],
+                                                            temperatures, base)
+        black_bodies = BlackBody.composite(wave, temperatures, factors)
+
+        if normalize:
+            cmfgen_filename_cont = cmfgen_filename[0:-3] + 'cont'
+            cont = CmfgenParse.load_model(cmfgen_filename_cont, x_limit_left, x_limit_right)
+            interpolated_data = pyasl.intep(cont[:, 0], cont[:, 1], wave)
+            final_spec = (base_scale * cmfgen_smoothed + black_bodies) / (base_scale * interpolated_data + black_bodies)
+        else:
+            final_spec = base_scale * cmfgen_smoothed + black_bodies
 
-                x_limit_left = 4300
-                x_limit_right = 6800
+        return wave, final_spec, base_scale, list(factors)
 
-                cmfgen_modeldata = CmfgenParse.spectr_input(cmfgen_filename)
-                cmfgen_modeldata = cmfgen_modeldata[:np.where(cmfgen_modeldata[:, 0] < x_limit_right)[0][-1], :]
-                cmfgen_modeldata = cmfgen_modeldata[np.where(cmfgen_modeldata[:, 0] > x_limit_left)[0][0]:, :]
+    def cmfgen_plot_rot(self):
+        """
+        Method for plotting spectrum from CMFGEN model with rotational broadening.
+        Model is processed in background, on success plot is added,
+        else cmfgen_plot will call cmfgen_error_event for displaying error.
+        Call add_to_list_widget with plot item name.
+        """
+        cmfgen_filename = unicode(QFileDialog.getOpenFileName(self, 'Open CMFGEN model file'))
 
-                dt = max(cmfgen_modeldata[1:, 0] - cmfgen_modeldata[0:-1, 0])
-                cmfgen_binned_data, dt = pyasl.binningx0dt(cmfgen_modeldata[:, 0], cmfgen_modeldata[:, 1],
-                                                   x0=min(cmfgen_modeldata[:, 0]), dt=dt)
-                cmfgen_smoothed, fwhm = pyasl.instrBroadGaussFast(cmfgen_binned_data[:, 0], cmfgen_binned_data[:, 1],
-                                                                   1650, fullout=True)
+        if cmfgen_filename != '':
+            reply = QMessageBox.question(self, 'Message',
+                                         "Do you want to plot normalized spectrum from *cont file?",
+                                         QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
 
-                print fwhm
+            plot_name = cmfgen_filename.split("/")[-3]
+            self.jobs.submit('Processing ' + plot_name, SpecObserver.process_cmfgen_rot,
+                             (cmfgen_filename, reply == QMessageBox.Yes),
+                             on_result=lambda result: self.add_plot(plot_name, result[0], result[1]),
+                             on_error=self.cmfgen_error_event, report=True)
 
-                bb5_4kK = np.loadtxt("bb5.4kK")
-                bb7_7kK = np.loadtxt("bb7.7kK")
+    @staticmethod
+    def process_cmfgen_rot(cmfgen_filename, normalize, report=None):
+        """
+        CMFGEN model with instrumental and rotational broadening
+        :param cmfgen_filename: CMFGEN model filename
+        :param normalize: divide by *cont file
+        :param report: progress callback
+        :return: (wave, flux)
+        """
+        x_limit_left = 1000
+        x_limit_right = 10000
+
+        cmfgen_modeldata = CmfgenParse.load_model(cmfgen_filename, x_limit_left, x_limit_right)
+        if report is not None:
+            report(0.2)
+
+        cmfgen_binned_data = np.column_stack(Rebin.rebin_spectrum(cmfgen_modeldata[:, 0], cmfgen_modeldata[:, 1]))
+        cmfgen_smoothed = Broadening.broaden(cmfgen_binned_data[:, 0], cmfgen_binned_data[:, 1], 1550)
+        if report is not None:
+            report(0.4)
+        cmfgen_smoothed = Broadening.broaden_rotation(cmfgen_binned_data[:, 0], cmfgen_smoothed, 49.0, 0.1)
+        if report is not None:
+            report(0.7)
+        if normalize:
+            cmfgen_filename_cont = cmfgen_filename[0:-3] + 'cont'
+            cont = CmfgenParse.load_model(cmfgen_filename_cont, x_limit_left, x_limit_right)
+            interpolated_data = pyasl.intep(cont[:, 0], cont[:, 1], cmfgen_binned_data[:, 0])
+            rot = Broadening.broaden_rotation(cmfgen_binned_data[:, 0], cmfgen_smoothed / interpolated_data, 80.0)
+            return cmfgen_binned_data[:, 0], rot
+        return cmfgen_binned_data[:, 0], cmfgen_smoothed
 
-                if reply == QMessageBox.Yes:
-                    cmfgen_filename_cont = cmfgen_filename[0:-3] + 'cont'
-                    cont = CmfgenParse.spectr_input(cmfgen_filename_cont)
-                    interpolated_data = pyasl.intep(cont[:, 0], cont[:, 1], cmfgen_binned_data[:, 0])
+    def cmfgen_plot_interp(self):
+        """
+        Method for plotting spectrum from CMFGEN model with interpolation smoothing.
+        Model is processed in background, on success plot is added,
+        else cmfgen_plot will call cmfgen_error_event for displaying error.
+        Call add_to_list_widget with plot item name.
+        """
+        cmfgen_filename = unicode(QFileDialog.getOpenFileName(self, 'Open CMFGEN model file'))
 
-                    bb54_inter = pyasl.intep(bb5_4kK[:, 0], bb5_4kK[:, 1], cmfgen_binned_data[:, 0])
-                    bb77_inter = pyasl.intep(bb7_7kK[:, 0], bb7_7kK[:, 1], cmfgen_binned_data[:, 0])
+        if cmfgen_filename != '':
+            reply = QMessageBox.question(self, 'Message',
+                                         "Do you want to plot normalized spectrum from *cont file?",
+                                         QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
 
-                    all_cont = interpolated_data + bb54_inter * (3.4 * 10 ** 3) ** 2 + bb77_inter * (0) ** 2
+            plot_name = cmfgen_filename.split("/")[-3] + 'interp'
+            self.jobs.submit('Processing ' + plot_name, SpecObserver.process_cmfgen_interp,
+                             (cmfgen_filename, reply == QMessageBox.Yes),
+                             on_result=lambda result: self.add_plot(plot_name, result[0], result[1]),
+                             on_error=self.cmfgen_error_event, report=True)
 
-                    final_spec = (cmfgen_smoothed + bb54_inter * (3.4 * 10 ** 3) ** 2 +
-                                        bb77_inter * (0) ** 2) / all_cont
+    @staticmethod
+    def process_cmfgen_interp(cmfgen_filename, normalize, report=None):
+        """
+        CMFGEN model interpolated to 0.05 A grid and broadened to FWHM 2.25 A
+        :param cmfgen_filename: CMFGEN model filename
+        :param normalize: divide by *cont file
+        :param report: progress callback
+        :return: (wave, flux)
+        """
+        x_limit_left = 2000
+        x_limit_right = 11000
+
+        cmfgen_modeldata = CmfgenParse.load_model(cmfgen_filename, x_limit_left, x_limit_right)
+        if report is not None:
+            report(0.3)
+
+        delta_x = np.max(cmfgen_modeldata[:, 0]) - np.min(cmfgen_modeldata[:, 0])
+        grid_step = 0.05
+        points_count = delta_x / grid_step
+        cmfgen_model_new_grid = np.linspace(np.min(cmfgen_modeldata[:, 0]), np.max(cmfgen_modeldata[:, 0]), points_count)
+
+        cmfgen_model_interp_function = interp1d(cmfgen_modeldata[:, 0], cmfgen_modeldata[:, 1])
+        cmfgen_model_new_flux = cmfgen_model_interp_function(cmfgen_model_new_grid)
+        #cmfgen_model_new_flux = pyasl.intep(cmfgen_modeldata[:, 0], cmfgen_modeldata[:, 1], cmfgen_model_new_grid)
+        if report is not None:
+            report(0.5)
+
+        fwhm = 2.25
+        cmfgen_model_new_flux = Broadening.broaden_fwhm(cmfgen_model_new_grid, cmfgen_model_new_flux, fwhm)
+        #cmfgen_model_new_flux = pyasl.rotBroad(cmfgen_model_new_grid, cmfgen_model_new_flux, 0.0, 50.0)
+        if report is not None:
+            report(0.8)
+        if normalize:
+            cmfgen_filename_cont = cmfgen_filename[0:-3] + 'cont'
+            cont = CmfgenParse.load_model(cmfgen_filename_cont, x_limit_left, x_limit_right)
+            interpolated_data = pyasl.intep(cont[:, 0], cont[:, 1], cmfgen_model_new_grid)
+            return cmfgen_model_new_grid, cmfgen_model_new_flux / interpolated_data
+        return cmfgen_model_new_grid, cmfgen_model_new_flux
+
+    def save_session(self):
+        """
+        Save plots with their raw data, processing chains, names and colors,
+        points and line catalogs into one binary file, file is written in background
+        """
+        file_name = unicode(QFileDialog.getSaveFileName(self, 'Save session', filter='Sessions (*.session)'))
+        if file_name != '':
+            reply = QMessageBox.question(self, 'Message',
+                                         "Do you want to compress arrays?\n(smaller file, slower opening)",
+                                         QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            session, arrays = self.session_state()
+            self.jobs.submit('Saving session', Session.write_session,
+                             (file_name, session, arrays, reply == QMessageBox.Yes),
+                             on_error=self.session_error_event)
+
+    def session_state(self):
+        """
+        :return: (description, arrays) for Session.write_session
+        """
+        plots = []
+        arrays = {}
+        for row in range(self.listWidget.count()):
+            item = self.listWidget.item(row)
+            name = unicode(item.text())
+            pipeline = self.pipeline(self.all_plot_items[name])
+            key = 'plot%d' % row
+            arrays[key + '_raw_wave'] = pipeline.wave
+            arrays[key + '_raw_flux'] = pipeline.flux
+            if pipeline.position > 0 and pipeline.is_computed():
+                arrays[key + '_wave'], arrays[key + '_flux'] = pipeline.result()
+            plots.append({'name': name, 'key': key, 'color': list(item.backgroundColor().getRgb()),
+                          'fits_path': self.all_fits_paths.get(name), 'velocity': self.plot_velocities.get(name),
+                          'steps': list(pipeline.steps), 'position': pipeline.position})
+
+        points = []
+        for index in range(self.listPointWidget.count()):
+            point_item = self.all_point_items[unicode(self.listPointWidget.item(index).text())]
+            points.append([float(point_item.getData()[0][0]), float(point_item.getData()[1][0])])
 
-                    current_plot = self.pw.plot(cmfgen_binned_data[:, 0],
-                                                final_spec, pen=mkColor(self.i))
-                else:
-                    bb54_inter = pyasl.intep(bb5_4kK[:, 0], bb5_4kK[:, 1], cmfgen_binned_data[:, 0])
-                    bb77_inter = pyasl.intep(bb7_7kK[:, 0], bb7_7kK[:, 1], cmfgen_binned_data[:, 0])
+        catalogs = []
+        for index, (name, (waves, labels)) in enumerate(self.line_markers.catalogs.items()):
+            arrays['catalog%d_waves' % index] = waves
+            arrays['catalog%d_labels' % index] = np.array(labels.tolist())
+            catalogs.append(name)
 
-                    final_spec = cmfgen_smoothed + bb54_inter *\
-                                       (0) ** 2 + bb77_inter * (3.4 * 10**3)**2
+        session = {'plots': plots, 'points': points, 'catalogs': catalogs,
+                   'color_index': self.i, 'hover_lines': self.hover_lines}
+        return session, arrays
 
-                    current_plot = self.pw.plot(cmfgen_binned_data[:, 0], final_spec, pen=mkColor(self.i))
+    def load_session(self):
+        """
+        Replace current plots with saved session.
+        Arrays are memory-mapped and saved results of processing chains are shown without recomputing.
+        """
+        file_name = unicode(QFileDialog.getOpenFileName(self, 'Open session', filter='Sessions (*.session)'))
+        if file_name == '':
+            return
+        try:
+            session, arrays = Session.read_session(file_name)
+        except (IOError, ValueError, KeyError) as exception:
+            self.session_error_event(unicode(exception))
+            return
 
-                plot_name = cmfgen_filename.split("/")[-3] + 'bb'
-                self.all_plot_items[plot_name] = current_plot
-                self.add_to_list_widget(plot_name)
-                self.i += 2
-        except IOError as exception:
-            self.cmfgen_error_event(exception.message)
+        self.clear_plot()
+        for plot in session['plots']:
+            key = plot['key']
+            pipeline = Pipeline(arrays[key + '_raw_wave'], arrays[key + '_raw_flux'])
+            pipeline.restore(plot['steps'], plot['position'], arrays.get(key + '_wave'), arrays.get(key + '_flux'))
+            wave, flux = pipeline.result()
+            plot_item = self.add_plot(plot['name'], wave, flux, plot['fits_path'], tuple(plot['color']))
+            self.pipelines[plot_item] = pipeline
+            if plot['velocity'] is not None:
+                self.plot_velocities[plot['name']] = plot['velocity']
+        for x, y in session['points']:
+            self.add_point(x, y)
+        for index, name in enumerate(session['catalogs']):
+            self.line_markers.add_catalog(name, arrays['catalog%d_waves' % index], arrays['catalog%d_labels' % index])
+        self.i = session['color_index']
+        self.hover_lines = session['hover_lines']
+        self.pw.autoRange()
 
-    def cmfgen_plot_rot(self):
+    def session_error_event(self, message):
         """
-        Method for plotting spectrum from CMFGEN model.
-        If plotting completed successfully, method will change text color in main window,
-        else cmfgen_plot will call cmfgen_error_event for displaying IOError.
-        Call add_to_list_widget with plot item name.
+        Method creates window with error message, when session can't be saved or opened.
+        :param message: The error message.
         """
-        try:
-            cmfgen_filename = unicode(QFileDialog.getOpenFileName(self, 'Open CMFGEN model file'))
-
-            if cmfgen_filename != '':
-                reply = QMessageBox.question(self, 'Message',
-                                             "Do you want to plot normalized spectrum from *cont file?",
-                                             QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
-
-                x_limit_left = 1000
-                x_limit_right = 10000
-
-                cmfgen_modeldata = CmfgenParse.spectr_input(cmfgen_filename)
-                cmfgen_modeldata = cmfgen_modeldata[:np.where(cmfgen_modeldata[:, 0] < x_limit_right)[0][-1], :]
-                cmfgen_modeldata = cmfgen_modeldata[np.where(cmfgen_modeldata[:, 0] > x_limit_left)[0][0]:, :]
-
-                dt = max(cmfgen_modeldata[1:, 0] - cmfgen_modeldata[0:-1, 0])
-                cmfgen_binned_data, dt = pyasl.binningx0dt(cmfgen_modeldata[:, 0], cmfgen_modeldata[:, 1],
-                                                           x0=min(cmfgen_modeldata[:, 0]), dt=dt)
-                cmfgen_smoothed, fwhm = pyasl.instrBroadGaussFast(cmfgen_binned_data[:, 0], cmfgen_binned_data[:, 1],
-                                                                  1550, fullout=True)
-                cmfgen_smoothed = pyasl.rotBroad(cmfgen_binned_data[:, 0], cmfgen_smoothed, 0.1, 49)
-                print fwhm
-                if reply == QMessageBox.Yes:
-                    cmfgen_filename_cont = cmfgen_filename[0:-3] + 'cont'
-                    cont = CmfgenParse.spectr_input(cmfgen_filename_cont)
-                    interpolated_data = pyasl.intep(cont[:, 0], cont[:, 1], cmfgen_binned_data[:, 0])
-                    rot = pyasl.rotBroad(cmfgen_binned_data[:, 0], cmfgen_smoothed / interpolated_data, 0.0, 80)
-                    current_plot = self.pw.plot(cmfgen_binned_data[:, 0],
-                                                (rot), pen=mkColor(self.i))
-                else:
-                    current_plot = self.pw.plot(cmfgen_binned_data[:, 0], cmfgen_smoothed, pen=mkColor(self.i))
-                plot_name = cmfgen_filename.split("/")[-3]
-                self.all_plot_items[plot_name] = current_plot
-                self.add_to_list_widget(plot_name)
-                self.i += 2
-        except IOError as exception:
-            self.cmfgen_error_event(exception.message)
+        QMessageBox.critical(self, "IOError", "Can't save or open session\n" + message)
 
-    def cmfgen_plot_interp(self):
+    def show_cache_stats(self):
         """
-        Method for plotting spectrum from CMFGEN model with interpolation smoothing.
-        If plotting completed successfully, method will change text color in main window,
-        else cmfgen_plot will call cmfgen_error_event for displaying IOError.
-        Call add_to_list_widget with plot item name.
+        Show statistics of CMFGEN model cache and offer to clear it
         """
-        try:
-            cmfgen_filename = unicode(QFileDialog.getOpenFileName(self, 'Open CMFGEN model file'))
-
-            if cmfgen_filename != '':
-                reply = QMessageBox.question(self, 'Message',
-                                             "Do you want to plot normalized spectrum from *cont file?",
-                                             QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
-
-                x_limit_left = 2000
-                x_limit_right = 11000
-
-                cmfgen_modeldata = CmfgenParse.spectr_input(cmfgen_filename)
-                cmfgen_modeldata = cmfgen_modeldata[:np.where(cmfgen_modeldata[:, 0] < x_limit_right)[0][-1], :]
-                cmfgen_modeldata = cmfgen_modeldata[np.where(cmfgen_modeldata[:, 0] > x_limit_left)[0][0]:, :]
-
-                delta_x = np.max(cmfgen_modeldata[:, 0]) - np.min(cmfgen_modeldata[:, 0])
-                grid_step = 0.05
-                points_count = delta_x / grid_step
-                cmfgen_model_new_grid = np.linspace(np.min(cmfgen_modeldata[:, 0]), np.max(cmfgen_modeldata[:, 0]), points_count)
-
-                cmfgen_model_interp_function = interp1d(cmfgen_modeldata[:, 0], cmfgen_modeldata[:, 1])
-                cmfgen_model_new_flux = cmfgen_model_interp_function(cmfgen_model_new_grid)
-                #cmfgen_model_new_flux = pyasl.intep(cmfgen_modeldata[:, 0], cmfgen_modeldata[:, 1], cmfgen_model_new_grid)
-
-                fwhm = 2.25
-                cmfgen_model_new_flux, fwhm = pyasl.instrBroadGaussFast(cmfgen_model_new_grid, cmfgen_model_new_flux,
-                                                                  np.mean(cmfgen_model_new_grid) / fwhm, fullout=True)
-                #cmfgen_model_new_flux = pyasl.rotBroad(cmfgen_model_new_grid, cmfgen_model_new_flux, 0.0, 50.0)
-                if reply == QMessageBox.Yes:
-                    cmfgen_filename_cont = cmfgen_filename[0:-3] + 'cont'
-                    cont = CmfgenParse.spectr_input(cmfgen_filename_cont)
-                    interpolated_data = pyasl.intep(cont[:, 0], cont[:, 1], cmfgen_model_new_grid)
-                    current_plot = self.pw.plot(cmfgen_model_new_grid,
-                                                (cmfgen_model_new_flux / interpolated_data), pen=mkColor(self.i))
-                else:
-                    current_plot = self.pw.plot(cmfgen_model_new_grid, cmfgen_model_new_flux, pen=mkColor(self.i))
-                plot_name = cmfgen_filename.split("/")[-3] + 'interp'
-                self.all_plot_items[plot_name] = current_plot
-                self.add_to_list_widget(plot_name)
-                self.i += 2
-        except IOError as exception:
-            self.cmfgen_error_event(exception.message)
+        stats = CmfgenParse.model_cache.stats()
+        reply = QMessageBox.question(self, 'Model cache',
+                                     "Cache directory: %s\n"
+                                     "Hits: %d, misses: %d, evictions: %d\n"
+                                     "Files: %d, size: %0.1f MB\n\n"
+                                     "Clear cache?" % (CmfgenParse.model_cache.cache_dir,
+                                                       stats['hits'], stats['misses'], stats['evictions'],
+                                                       stats['files'], stats['size'] / 1024.0 ** 2),
+                                     QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        if reply == QMessageBox.Yes:
+            CmfgenParse.model_cache.clear()
 
     def cmfgen_error_event(self, message):
         """
@@ -414,14 +737,161 @@ class SpecObserver(QMainWindow):
         """
         QMessageBox.critical(self, "IOError", "Can't read CMFGEN model file\n" + message)
 
-    def add_to_list_widget(self, name):
+    def plot_spectrum(self, wave, flux, color=None):
+        """
+        Add spectrum curve drawn with level-of-detail decimation
+        :param wave: wavelength array
+        :param flux: flux array
+        :param color: curve color, next color of cycle by default
+        :return: plot item
+        """
+        current_plot = LodPlotDataItem(wave, flux, pen=mkColor(self.i if color is None else color))
+        self.pw.addItem(current_plot)
+        return current_plot
+
+    def add_plot(self, plot_name, wave, flux, fits_path=None, color=None):
+        """
+        Plot spectrum and add it to list widget
+        :param plot_name: name in list widget
+        :param wave: wavelength array
+        :param flux: flux array
+        :param fits_path: source FITS file for export
+        :param color: curve color, next color of cycle by default
+        :return: plot item
+        """
+        current_plot = self.plot_spectrum(wave, flux, color)
+        self.all_plot_items[plot_name] = current_plot
+        if fits_path is not None:
+            self.all_fits_paths[plot_name] = fits_path
+        self.add_to_list_widget(plot_name, color)
+        self.i += 2
+        return current_plot
+
+    def pipeline(self, plot_item):
+        """
+        Processing chain of plot, created from its current data on first use
+        :return: Pipeline
+        """
+        if plot_item not in self.pipelines:
+            wave, flux = plot_item.getData()
+            self.pipelines[plot_item] = Pipeline(wave, flux)
+        return self.pipelines[plot_item]
+
+    def apply_to_selected_plots(self, operation, *args):
+        """
+        Append operation to chains of selected plots and show results
+        :param operation: name of Pipeline operation
+        """
+        for selected_item in self.listWidget.selectedItems():
+            name = unicode(selected_item.text())
+            plot_item = self.all_plot_items[name]
+            self.pipeline(plot_item).append(operation, *args)
+            self.refresh_plot(name, plot_item)
+
+    def refresh_plot(self, name, plot_item):
+        """
+        Show result of plot chain, stages missing from memo are computed in background
+        """
+        pipeline = self.pipeline(plot_item)
+        steps = pipeline.applied()
+        if pipeline.is_computed(steps):
+            plot_item.setData(*pipeline.result(steps))
+            return
+        self.jobs.submit('%s %s' % (steps[-1][0], name), pipeline.result, (steps,),
+                         on_result=lambda result: self.show_pipeline_result(plot_item, steps, result),
+                         on_error=self.job_error_event)
+
+    def show_pipeline_result(self, plot_item, steps, result):
+        """
+        Set data computed by refresh_plot if plot was not removed or changed while job was running
+        """
+        if plot_item in self.pipelines and self.pipelines[plot_item].applied() == steps:
+            plot_item.setData(*result)
+
+    def undo_selected_plots(self):
+        """
+        Undo last step of selected plots, previous result is taken from memo
+        """
+        for selected_item in self.listWidget.selectedItems():
+            name = unicode(selected_item.text())
+            plot_item = self.all_plot_items[name]
+            self.pipeline(plot_item).undo()
+            self.refresh_plot(name, plot_item)
+
+    def redo_selected_plots(self):
+        """
+        Redo undone step of selected plots
+        """
+        for selected_item in self.listWidget.selectedItems():
+            name = unicode(selected_item.text())
+            plot_item = self.all_plot_items[name]
+            self.pipeline(plot_item).redo()
+            self.refresh_plot(name, plot_item)
+
+    def edit_selected_plot_steps(self):
+        """
+        Change parameters of one step of selected plot or remove it,
+        only stages after changed step are recomputed
+        """
+        if len(self.listWidget.selectedItems()) != 1:
+            self.single_plot_warning_event()
+            return
+
+        name = unicode(self.listWidget.selectedItems()[0].text())
+        plot_item = self.all_plot_items[name]
+        pipeline = self.pipeline(plot_item)
+        if not pipeline.steps:
+            QMessageBox.information(self, 'Steps', 'No processing steps\n')
+            return
+        descriptions = pipeline.describe()
+        step, ok = QInputDialog.getItem(self, 'Steps', 'Step:', descriptions, len(descriptions) - 1, False)
+        if not ok:
+            return
+        index = descriptions.index(unicode(step))
+        step_name, args = pipeline.steps[index]
+        text, ok = QInputDialog.getText(self, 'Steps', 'Enter parameters of %s, empty to remove step:' % step_name,
+                                        text=', '.join(repr(arg) for arg in args))
+        try:
+            if ok is True:
+                if unicode(text).strip() == '':
+                    pipeline.remove(index)
+                else:
+                    pipeline.replace(index, *eval('(' + str(text) + ',)'))
+                self.refresh_plot(name, plot_item)
+        except (NameError, ValueError, SyntaxError) as exception:
+            self.name_error_event(exception.message)
+
+    def update_job_status(self):
+        """
+        Show running jobs and their progress in status bar
+        """
+        text, progress = self.jobs.status()
+        self.job_label.setText(text)
+        self.job_progress.setVisible(bool(self.jobs.jobs))
+        self.cancel_jobs_button.setVisible(bool(self.jobs.jobs))
+        if progress is None:
+            # busy indicator
+            self.job_progress.setRange(0, 0)
+        else:
+            self.job_progress.setRange(0, 100)
+            self.job_progress.setValue(progress)
+
+    def job_error_event(self, message):
+        """
+        Method creates window with error message, when background job fails.
+        :param message: The error message.
+        """
+        QMessageBox.critical(self, "Error", "Job failed\n" + message)
+
+    def add_to_list_widget(self, name, color=None):
         """
         Add item to widget list with name
         :param name: Plot item name 
+        :param color: background color, next color of cycle by default
         """
         item = QListWidgetItem('%s' % name)
         # print(self.all_plot_items[unicode(item.text())].getData())
-        item.setBackgroundColor(mkColor(self.i))
+        item.setBackgroundColor(mkColor(self.i if color is None else color))
         self.listWidget.addItem(item)
 
     def list_widget_clear_selection(self):
@@ -436,8 +906,38 @@ class SpecObserver(QMainWindow):
         :param evt Mouse event: 
         """
         self.mouse_point = self.pw.vb.mapSceneToView(evt[0])
-        self.label.setText("x = %0.2f, y = %0.2e" % (
-            self.mouse_point.x(), self.mouse_point.y()))
+        text = "x = %0.2f, y = %0.2e" % (self.mouse_point.x(), self.mouse_point.y())
+
+        if self.hover_lines > 0 and self.line_markers.waves.size:
+            selected_items = self.listWidget.selectedItems()
+            velocity = 0.0
+            if len(selected_items) == 1:
+                velocity = self.plot_velocities.get(unicode(selected_items[0].text()), 0.0)
+            rest_wave = self.mouse_point.x() / (1.0 + velocity / SPEED_OF_LIGHT)
+            for index in self.line_markers.nearest(rest_wave, self.hover_lines):
+                text += "\n%0.2f %s" % (self.line_markers.waves[index], self.line_markers.labels[index])
+        self.label.setText(text)
+
+    def set_hover_lines(self):
+        """
+        Set number of catalog lines shown near cursor and
+        radial velocity of selected plots for line identification
+        """
+        count, ok = QInputDialog.getInt(self, 'Line identification', 'Lines near cursor:',
+                                        self.hover_lines, 0, 50)
+        if not ok:
+            return
+        self.hover_lines = count
+
+        selected_items = self.listWidget.selectedItems()
+        if selected_items:
+            name = unicode(selected_items[0].text())
+            velocity, ok = QInputDialog.getDouble(self, 'Line identification',
+                                                  'Radial velocity of selected plots, km/s:',
+                                                  self.plot_velocities.get(name, 0.0), -1e5, 1e5, 1)
+            if ok:
+                for selected_item in selected_items:
+                    self.plot_velocities[unicode(selected_item.text())] = velocity
 
     def remove_selected_plots(self):
         """
@@ -446,8 +946,10 @@ class SpecObserver(QMainWindow):
         """
         for selected_item in self.listWidget.selectedItems():
             name = unicode(selected_item.text())
-            self.pw.removeItem(self.all_plot_items[name])
-            self.all_plot_items.pop(name)
+            plot_item = self.all_plot_items.pop(name)
+            self.pw.removeItem(plot_item)
+            self.plot_velocities.pop(name, None)
+            self.pipelines.pop(plot_item, None)
             self.listWidget.takeItem(self.listWidget.row(selected_item))
 
     def export_selected_plots(self):
@@ -471,14 +973,20 @@ class SpecObserver(QMainWindow):
         :return: 
         """
         if event.modifiers() == QtCore.Qt.ControlModifier:
-            x = np.array([self.mouse_point.x()])
-            y = np.array([self.mouse_point.y()])
-            name = "x = %0.2f, y = %0.4e" % (self.mouse_point.x(), self.mouse_point.y())
-            current_point = self.pw.plot(x, y, pen=None, symbol='x', symbolPen=None, symbolSize=15,
-                                         symbolBrush=mkColor(5))
-            self.all_point_items[name] = current_point
-            item = QListWidgetItem('%s' % name)
-            self.listPointWidget.addItem(item)
+            self.add_point(self.mouse_point.x(), self.mouse_point.y())
+
+    def add_point(self, x, y):
+        """
+        Plot point and add it to point list widget
+        :param x: wavelength
+        :param y: flux
+        """
+        name = "x = %0.2f, y = %0.4e" % (x, y)
+        current_point = self.pw.plot(np.array([x]), np.array([y]), pen=None, symbol='x', symbolPen=None,
+                                     symbolSize=15, symbolBrush=mkColor(5))
+        self.all_point_items[name] = current_point
+        item = QListWidgetItem('%s' % name)
+        self.listPointWidget.addItem(item)
 
     def remove_selected_points(self):
         """
@@ -509,12 +1017,8 @@ class SpecObserver(QMainWindow):
         try:
             if text != '' and ok is True:
                 distance = eval(str(text))
-                for selected_item in self.listWidget.selectedItems():
-                    name = unicode(selected_item.text())
-                    data = np.transpose(self.all_plot_items[name].getData())
-                    data[:, 1] = data[:, 1] * distance ** 2
-                    self.all_plot_items[name].setData(data)
-                    self.pw.autoRange()
+                self.apply_to_selected_plots('distance', distance)
+                self.pw.autoRange()
         except NameError as exception:
             self.name_error_event(exception.message)
 
@@ -527,51 +1031,167 @@ class SpecObserver(QMainWindow):
         try:
             if text != '' and ok is True:
                 window_length = eval(str(text))
-                for selected_item in self.listWidget.selectedItems():
-                    name = unicode(selected_item.text())
-                    data = np.transpose(self.all_plot_items[name].getData())
-                    window_length_cell = int(window_length / max(data[1:, 0] - data[0:-1, 0]))
-                    if window_length_cell % 2 == 0: window_length_cell += 1
-                    data[:, 1] = pyasl.smooth(data[:, 1], window_length_cell, 'hamming')
-                    self.all_plot_items[name].setData(data)
+                self.apply_to_selected_plots('smooth', window_length)
         except NameError and ValueError as exception:
             self.name_error_event(exception.message)
 
 
     def rot_broad_selected_plots(self):
         """
-        Smooth selected plots
+        Rotational broadening of selected plots.
+        Rotation is single step of chain, new velocity replaces previous one, so velocities don't accumulate.
         :return:
         """
         text, ok = QInputDialog.getText(self, 'Data rot broadening', 'Enter rotational velocity, km/s:')
         try:
             if text != '' and ok is True:
                 velocity = eval(str(text))
-                for selected_item in self.listWidget.selectedItems():
-                    name = unicode(selected_item.text())
-                    data = np.transpose(self.all_plot_items[name].getData())
-                    data[:, 1] = pyasl.rotBroad(data[:, 0], data[:, 1], 0.0, velocity)
-                    self.all_plot_items[name].setData(data)
+                self.apply_to_selected_plots('rotation', velocity, 0.0)
         except NameError and ValueError as exception:
             self.name_error_event(exception.message)
 
+    def scan_vsini_for_selected_plot(self):
+        """
+        Broaden visible part of selected plot with grid of vsini at once
+        and show slider for choosing velocity, chosen one is applied to whole plot
+        """
+        if len(self.listWidget.selectedItems()) != 1:
+            self.single_plot_warning_event()
+            return
+
+        text, ok = QInputDialog.getText(self, 'vsini scan',
+                                        'Enter first vsini, last vsini, step (km/s) and limb darkening:',
+                                        text='0, 300, 5, 0.6')
+        try:
+            if text != '' and ok is True:
+                vsini_first, vsini_last, vsini_step, epsilon = eval(str(text))
+                vsini_values = np.arange(vsini_first, vsini_last + 0.5 * vsini_step, vsini_step, dtype=np.float64)
+                name = unicode(self.listWidget.selectedItems()[0].text())
+                plot_item = self.all_plot_items[name]
+                pipeline = self.pipeline(plot_item)
+                steps = pipeline.applied()
+                rotation_index = pipeline.find('rotation')
+                if rotation_index is not None:
+                    steps = steps[:rotation_index]
+                x_min, x_max = self.pw.viewRange()[0]
+                self.jobs.submit('vsini scan ' + name, SpecObserver.scan_vsini,
+                                 (pipeline, steps, x_min, x_max, vsini_values, epsilon),
+                                 on_result=lambda result: self.show_vsini_scan(name, plot_item, result[0],
+                                                                               vsini_values, epsilon, result[1]),
+                                 on_error=self.job_error_event)
+        except (NameError, ValueError, TypeError, SyntaxError) as exception:
+            self.name_error_event(exception.message)
+
+    @staticmethod
+    def scan_vsini(pipeline, steps, x_min, x_max, vsini_values, epsilon):
+        """
+        Broaden view range of chain result before rotation step with every vsini
+        :return: (wave, np.array (vsini_values.size, wave.size))
+        """
+        wave, flux = pipeline.result(steps)
+        window = scan_window(wave, x_min, x_max, vsini_values[-1])
+        return wave[window], Broadening.broaden_rotation(wave[window], flux[window], vsini_values, epsilon)
+
+    def show_vsini_scan(self, name, plot_item, wave, vsini_values, epsilon, fluxes):
+        """
+        Slider dialog over vsini scan, rotation step with chosen vsini is applied to plot on apply
+        """
+        if plot_item not in self.pipelines:
+            return
+        dialog = VsiniScanDialog(self, self.pw, wave, vsini_values, fluxes)
+        if dialog.exec_() == QDialog.Accepted:
+            self.pipeline(plot_item).append('rotation', dialog.vsini, epsilon)
+            self.refresh_plot(name, plot_item)
+
+    def rebin_selected_plots(self):
+        """
+        Flux-conserving rebinning of selected plots to chosen grid, computed in background
+        """
+        grid = self.ask_rebin_grid('Rebin')
+        if grid is not None:
+            self.apply_to_selected_plots('rebin', *grid)
+
     def unred_selected_plots(self):
         """
         Unred selected plots from astrolib IDL
         :return: 
         """
-        text, ok = QInputDialog.getText(self, 'Deredden flux', 'Deredden a flux vector. Enter Av:')
+        text, ok = QInputDialog.getText(self, 'Deredden flux', 'Deredden a flux vector. Enter Av or Av, R_V:')
         try:
             if text != '' and ok is True:
-                a_v = eval(str(text))
-                for selected_item in self.listWidget.selectedItems():
-                    name = unicode(selected_item.text())
-                    data = np.transpose(self.all_plot_items[name].getData())
-                    data[:, 1] = pyasl.unred(data[:, 0], data[:, 1], ebv=a_v / 3.2)
-                    self.all_plot_items[name].setData(data)
+                values = eval('(' + str(text) + ',)')
+                self.apply_to_selected_plots('unred', *values)
         except NameError as exception:
             self.name_error_event(exception.message)
 
+    def scan_extinction_for_selected_plot(self):
+        """
+        Score selected plot dereddened with grid of Av and R_V against model plot or black body,
+        computed in background. Spectrum before its unred step is scanned.
+        """
+        if len(self.listWidget.selectedItems()) != 1:
+            self.single_plot_warning_event()
+            return
+        name = unicode(self.listWidget.selectedItems()[0].text())
+        models = [unicode(self.listWidget.item(row).text()) for row in range(self.listWidget.count())]
+        models = [model for model in models if model != name] + ['Black body']
+        model, ok = QInputDialog.getItem(self, 'Av scan', 'Model:', models, 0, False)
+        if not ok:
+            return
+        model = unicode(model)
+        if model == 'Black body':
+            temp, ok = QInputDialog.getDouble(self, 'Av scan', 'Temperature, K:', 10000.0, 100.0, 1e7, 0)
+            if not ok:
+                return
+            model_wave = np.array(self.all_plot_items[name].getData()[0])
+            model_flux = SpecObserver.black_body(model_wave, temp)
+        else:
+            model_wave, model_flux = self.all_plot_items[model].getData()
+
+        text, ok = QInputDialog.getText(self, 'Av scan', 'Av from, to, step, R_V values:', text='0, 5, 0.02, 3.1')
+        if not ok or text == '':
+            return
+        try:
+            values = eval('(' + str(text) + ',)')
+        except (NameError, SyntaxError) as exception:
+            self.name_error_event(unicode(exception))
+            return
+        a_v_values = np.arange(values[0], values[1] + 0.5 * values[2], values[2])
+        r_v_values = values[3:] or (Extinction.DEFAULT_R_V,)
+
+        plot_item = self.all_plot_items[name]
+        pipeline = self.pipeline(plot_item)
+        steps = pipeline.applied()
+        index = pipeline.find('unred')
+        if index is not None:
+            steps = steps[:index]
+        self.jobs.submit('Av scan ' + name, SpecObserver.scan_extinction,
+                         (pipeline, steps, np.array(model_wave), np.array(model_flux), a_v_values, r_v_values),
+                         on_result=lambda table: self.show_extinction_scan(name, plot_item, table),
+                         on_error=self.job_error_event)
+
+    @staticmethod
+    def scan_extinction(pipeline, steps, model_wave, model_flux, a_v_values, r_v_values):
+        """
+        :return: Extinction.scan table for result of steps
+        """
+        wave, flux = pipeline.result(steps)
+        return Extinction.scan(wave, flux, model_wave, model_flux, a_v_values, r_v_values)
+
+    def show_extinction_scan(self, name, plot_item, table):
+        """
+        Show Av scan table and offer to deredden plot with the best Av and R_V
+        """
+        ResultTableDialog(self, 'Av scan ' + name, table, Extinction.format_table(table)).show()
+        best = table[table['best']]
+        best = best[np.argmin(best['rms'])]
+        reply = QMessageBox.question(self, 'Message',
+                                     "Deredden %s with Av = %0.3f, R_V = %0.2f?" % (name, best['a_v'], best['r_v']),
+                                     QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        if reply == QMessageBox.Yes and plot_item in self.pipelines:
+            self.pipelines[plot_item].append('unred', float(best['a_v']), float(best['r_v']))
+            self.refresh_plot(name, plot_item)
+
     def calculate_red_shift_for_selected_plots(self):
         """
         Calculate red shift from z
@@ -581,12 +1201,7 @@ class SpecObserver(QMainWindow):
         try:
             if text != '' and ok is True:
                 vel = eval(str(text))
-                for selected_item in self.listWidget.selectedItems():
-                    name = unicode(selected_item.text())
-                    data = np.transpose(self.all_plot_items[name].getData())
-                    flux, wave = pyasl.dopplerShift(data[:, 0], data[:, 1], vel, edgeHandling="firstlast")
-                    data[:, 1] = flux
-                    self.all_plot_items[name].setData(data)
+                self.apply_to_selected_plots('doppler', vel)
         except NameError as exception:
             self.name_error_event(exception.message)
 
@@ -600,91 +1215,250 @@ class SpecObserver(QMainWindow):
         try:
             if text != '' and ok is True:
                 z = eval(str(text))
-                for selected_item in self.listWidget.selectedItems():
-                    name = unicode(selected_item.text())
-                    data = np.transpose(self.all_plot_items[name].getData())
-                    data[:, 0] = data[:, 0] * (1 + z)
-                    self.all_plot_items[name].setData(data)
+                self.apply_to_selected_plots('redshift', z)
         except NameError as exception:
             self.name_error_event(exception.message)
 
 
-    def calculate_continuum_for_selected_plots(self):
+    def measure_velocities_for_selected_plots(self):
         """
-        Calculate continuum for selected plots from all points
-        :return: 
+        Measure radial velocities of selected plots by cross-correlation with template plot,
+        e.g. loaded CMFGEN model, computed in background
         """
-        for selected_item in self.listWidget.selectedItems():
-            name = unicode(selected_item.text())
-            data = np.transpose(self.all_plot_items[name].getData())
+        names = [unicode(item.text()) for item in self.listWidget.selectedItems()]
+        if not names:
+            return
+        templates = [unicode(self.listWidget.item(row).text()) for row in range(self.listWidget.count())]
+        template, ok = QInputDialog.getItem(self, 'Radial velocity', 'Template:', templates, 0, False)
+        if not ok:
+            return
+        template = unicode(template)
+        max_velocity, ok = QInputDialog.getDouble(self, 'Radial velocity', 'Search range, km/s:',
+                                                  1000.0, 1.0, 1e5, 1)
+        if not ok:
+            return
+        spectra = []
+        for name in names:
+            if name != template:
+                wave, flux = self.all_plot_items[name].getData()
+                spectra.append((name, np.array(wave), np.array(flux)))
+        if not spectra:
+            return
+        template_wave, template_flux = self.all_plot_items[template].getData()
+        self.jobs.submit('Radial velocities', RadialVelocity.measure_velocities,
+                         (spectra, np.array(template_wave), np.array(template_flux), max_velocity),
+                         on_result=self.show_velocities, on_error=self.job_error_event, report=True)
 
-            point_data = []
-            for index in range(self.listPointWidget.count()):
-                point_name = unicode(self.listPointWidget.item(index).text())
-                point_data.append([self.all_point_items[point_name].getData()[0][0],
-                                   self.all_point_items[point_name].getData()[1][0]])
-                self.pw.removeItem(self.all_point_items[point_name])
+    def show_velocities(self, table):
+        """
+        Show table of measured velocities and shift plots to template frame
+        or keep velocities for line identification
+        """
+        ResultTableDialog(self, 'Radial velocities', table, RadialVelocity.format_table(table)).show()
+        measured = [row for row in table if row['success'] and row['spectrum'] in self.all_plot_items]
+        if not measured:
+            return
+        reply = QMessageBox.question(self, 'Message',
+                                     "Shift plots to template frame?\n"
+                                     "(No keeps velocities for line identification)",
+                                     QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        for row in measured:
+            name = row['spectrum']
+            if reply == QMessageBox.Yes:
+                plot_item = self.all_plot_items[name]
+                self.pipeline(plot_item).append('doppler', -float(row['velocity']))
+                self.refresh_plot(name, plot_item)
+                self.plot_velocities.pop(name, None)
+            else:
+                self.plot_velocities[name] = float(row['velocity'])
 
-            point_data.sort(key=lambda x: x[0], reverse=False)
-            point_data = np.array(point_data)
-            print point_data
+    def take_points(self):
+        """
+        Remove all points from plot and list widget
+        :return: list of (x, y) sorted by x
+        """
+        point_data = []
+        for index in range(self.listPointWidget.count()):
+            point_name = unicode(self.listPointWidget.item(index).text())
+            point_data.append([self.all_point_items[point_name].getData()[0][0],
+                               self.all_point_items[point_name].getData()[1][0]])
+            self.pw.removeItem(self.all_point_items[point_name])
+        self.listPointWidget.clear()
+        point_data.sort(key=lambda x: x[0], reverse=False)
+        return point_data
 
-            data = data[:np.where(data[:, 0] < np.max(point_data[:, 0]))[0][-1], :]
-            data = data[np.where(data[:, 0] > np.min(point_data[:, 0]))[0][0]:, :]
+    def calculate_continuum_for_selected_plots(self):
+        """
+        Calculate continuum for selected plots from all points,
+        the same points are used for every plot
+        """
+        if self.listPointWidget.count() < 2:
+            return
+        point_data = np.array(self.take_points())
+        for selected_item in self.listWidget.selectedItems():
+            name = unicode(selected_item.text())
+            plot_item = self.all_plot_items[name]
+            self.pipeline(plot_item).append('continuum', point_data)
+            self.refresh_plot(name, plot_item)
+        self.pw.autoRange()
 
-            interpolated_cont = pyasl.intep(point_data[:, 0], point_data[:, 1], data[:, 0])
+    def auto_continuum_for_selected_plots(self):
+        """
+        Fit continua of selected plots with sigma clipping and divide by them, computed in background.
+        Lines of loaded catalogs can be masked, points are used as anchors.
+        Every plot is fitted by its own job, see JobManager.map.
+        """
+        names = [unicode(item.text()) for item in self.listWidget.selectedItems()]
+        if not names:
+            return
+        methods = ['Chebyshev', 'Spline']
+        method, ok = QInputDialog.getItem(self, 'Continuum', 'Function:', methods, 0, False)
+        if not ok:
+            return
+        method = 'chebyshev' if methods.index(unicode(method)) == 0 else 'spline'
+        order, ok = QInputDialog.getInt(self, 'Continuum', 'Degree:' if method == 'chebyshev' else 'Spline pieces:',
+                                        5 if method == 'chebyshev' else 10, 1, 1000)
+        if not ok:
+            return
+        velocity = 0.0
+        if self.line_markers.waves.size:
+            velocity, ok = QInputDialog.getDouble(self, 'Continuum', 'Mask catalog lines, half width km/s (0 for none):',
+                                                  100.0, 0.0, 1e4, 1)
+            if not ok:
+                return
+        options = {'method': method, 'order': order, 'anchors': self.take_points()}
+
+        plots = []
+        inputs = []
+        for name in names:
+            plot_item = self.all_plot_items[name]
+            pipeline = self.pipeline(plot_item)
+            applied = pipeline.applied()
+            index = pipeline.find('auto_continuum')
+            plots.append((name, plot_item, applied))
+            inputs.append((pipeline, applied if index is None else applied[:index]))
+        options['velocity'] = velocity
+        options['catalogs'] = tuple(self.line_markers.catalogs.keys()) if velocity > 0 else ()
+        self.jobs.map('Continuum', lambda source: SpecObserver.fit_continuum(source, options),
+                      inputs, on_result=lambda results: self.show_continua(plots, options, results),
+                      on_error=self.job_error_event)
 
-            data[:, 1] = data[:, 1] / interpolated_cont
-            self.all_plot_items[name].setData(data)
-            self.listPointWidget.clear()
-            self.pw.autoRange()
+    @staticmethod
+    def fit_continuum(source, options):
+        """
+        :param source: (pipeline, steps before continuum step)
+        :param options: auto_continuum step parameters
+        :return: (wave, flux fitted, continuum)
+        """
+        pipeline, steps = source
+        wave, flux = pipeline.result(steps)
+        intervals = catalog_intervals(wave, options['velocity'], options['catalogs'])
+        return wave, flux, Continuum.fit_continuum(wave, flux, options['method'], options['order'],
+                                                   intervals=intervals, anchors=options['anchors'])
+
+    def show_continua(self, plots, options, results):
+        """
+        Append continuum steps with results of fit_continuum,
+        plots changed while jobs were running and failed fits are skipped
+        """
+        for (name, plot_item, applied), result in zip(plots, results):
+            pipeline = self.pipelines.get(plot_item)
+            if result is None or pipeline is None or pipeline.applied() != applied:
+                continue
+            wave, flux, continuum = result
+            index = pipeline.append('auto_continuum', options['method'], options['order'], 2.0, 3.0,
+                                    options['velocity'], options['catalogs'], options['anchors'])
+            pipeline.set_result(wave, flux / continuum, pipeline.applied()[:index + 1])
+            self.refresh_plot(name, plot_item)
+        self.pw.autoRange()
 
     def calculate_fwhm_for_intervals(self):
         """
-        Caclculate fwhm for lines between points
-        :return: 
+        Fit gaussians to lines at all points in all selected plots,
+        plot fitted profiles and show table with centers, FWHM and amplitudes
         """
-        point_data = []
+        centers = []
         for index in range(self.listPointWidget.count()):
             point_name = unicode(self.listPointWidget.item(index).text())
-            point_data.append([self.all_point_items[point_name].getData()[0][0],
-                               self.all_point_items[point_name].getData()[1][0]])
+            centers.append(self.all_point_items[point_name].getData()[0][0])
             self.pw.removeItem(self.all_point_items[point_name])
 
         self.listPointWidget.clear()
+        if not centers or not self.listWidget.selectedItems():
+            return
+
+        half_width, ok = QInputDialog.getDouble(self, 'Line fitting', 'Half width of fitting window, A:',
+                                                100.0, 0.1, 10000.0, 1)
+        if not ok:
+            return
 
-        for point in point_data:
-            top_peak = point[0]
-            for selected_item in self.listWidget.selectedItems():
-                    name = unicode(selected_item.text())
-                    data = np.transpose(self.all_plot_items[name].getData())
-                    data = data[:np.where(data[:, 0] < point[0] + 100)[0][-1], :]
-                    data = data[np.where(data[:, 0] > point[0] - 100)[0][0]:, :]
+        spectra = []
+        for selected_item in self.listWidget.selectedItems():
+            name = unicode(selected_item.text())
+            wave, flux = self.all_plot_items[name].getData()
+            spectra.append((name, wave, flux))
 
-                    x = data[:, 0]
-                    y = data[:, 1]
+        self.jobs.map('Line fitting', lambda spectrum: LineFit.fit_spectra([spectrum], centers, half_width), spectra,
+                      on_result=lambda tables: self.show_line_fits(tables, spectra, half_width),
+                      on_error=self.job_error_event)
 
-                    popt, pcov = curve_fit(lambda x, A, sig, lin, off: SpecObserver.func_gauss(x, A, top_peak, sig, lin, off),
-                                           x, y)
-                    y_fit = SpecObserver.func_gauss(x, popt[0], top_peak, popt[1], popt[2], popt[3])
-                    self.pw.plot(x, y_fit, pen=mkColor(self.i))
-                    self.i += 2
+    def show_line_fits(self, tables, spectra, half_width):
+        """
+        Plot fitted profiles and show table of line fits
+        :param tables: LineFit.fit_spectra results of every spectrum, None for failed ones
+        """
+        table = np.concatenate([np.zeros(0, dtype=LineFit.LINE_FIT_DTYPE)] +
+                               [item for item in tables if item is not None])
+        for name, wave, flux in spectra:
+            x_fit, y_fit = LineFit.fit_model(table[table['spectrum'] == name], wave, half_width)
+            self.pw.plot(x_fit, y_fit, pen=mkColor(self.i), connect='finite')
+            self.i += 2
 
-                    print popt[1] * 2.355
+        ResultTableDialog(self, 'Line fitting', table, LineFit.format_table(table)).show()
 
-    @staticmethod
-    def func_gauss(x, A, mu, sig, lin, off):
-        """
-        Gaussian function for approximation lines
-        :param x:
-        :param A:
-        :param mu:
-        :param sig:
-        :param lin:
-        :param off:
-        :return:
+    def measure_equivalent_widths(self):
+        """
+        Measure equivalent widths and fluxes of catalog lines in all selected plots, computed in background.
+        Catalog is one of loaded line catalogs or a line list file.
         """
-        return A * np.exp(-(x - mu) ** 2 / (2 * sig ** 2)) + x * lin + off
+        names = [unicode(item.text()) for item in self.listWidget.selectedItems()]
+        if not names:
+            return
+        from_file = 'Open file...'
+        catalog, ok = QInputDialog.getItem(self, 'Equivalent widths', 'Lines:',
+                                           list(self.line_markers.catalogs.keys()) + [from_file], 0, False)
+        if not ok:
+            return
+        catalog = unicode(catalog)
+        if catalog == from_file:
+            file_name = unicode(QFileDialog.getOpenFileName(self, 'Open line list'))
+            if file_name == '':
+                return
+            lines_data = LineCatalog.load_catalog_file(file_name)
+            line_waves, labels = lines_data['wave'], lines_data['label']
+        else:
+            line_waves, labels = self.line_markers.catalogs[catalog]
+        width, ok = QInputDialog.getDouble(self, 'Equivalent widths', 'Integration window, A:', 5.0, 0.01, 1e4, 2)
+        if not ok:
+            return
+        continua = ['Side bands', 'Normalized spectra']
+        continuum, ok = QInputDialog.getItem(self, 'Equivalent widths', 'Continuum:', continua, 0, False)
+        if not ok:
+            return
+        spectra = []
+        for name in names:
+            wave, flux = self.all_plot_items[name].getData()
+            spectra.append((name, np.array(wave), np.array(flux)))
+        self.jobs.submit('Equivalent widths', EquivalentWidth.measure_spectra,
+                         (spectra, np.array(line_waves), np.array(labels, dtype=object), width),
+                         {'normalized': continua.index(unicode(continuum)) == 1},
+                         on_result=self.show_equivalent_widths, on_error=self.job_error_event, report=True)
+
+    def show_equivalent_widths(self, table):
+        """
+        Show table of equivalent widths, positive for absorption
+        """
+        ResultTableDialog(self, 'Equivalent widths', table, EquivalentWidth.format_table(table)).show()
 
     def name_error_event(self, message):
         """
@@ -726,8 +1500,56 @@ class SpecObserver(QMainWindow):
             name = unicode(self.listWidget.selectedItems()[0].text())
             self.all_plot_items[unicode(text)] = self.all_plot_items[name]
             self.all_plot_items.pop(name)
+            if name in self.plot_velocities:
+                self.plot_velocities[unicode(text)] = self.plot_velocities.pop(name)
             self.listWidget.selectedItems()[0].setText(unicode(text));
 
+    def fit_model_grid_for_selected_plot(self):
+        """
+        Rank processed CMFGEN models (CmfgenBatch output) against selected plot
+        and plot the best model with fitted scale
+        """
+        if len(self.listWidget.selectedItems()) != 1:
+            self.single_plot_warning_event()
+            return
+
+        models_dir = unicode(QFileDialog.getExistingDirectory(self, 'Select directory with processed models'))
+        if models_dir != '':
+            name = unicode(self.listWidget.selectedItems()[0].text())
+            wave, flux = self.all_plot_items[name].getData()
+            wave, flux = np.array(wave), np.array(flux)
+            model_files = GridFit.find_model_files(models_dir)
+            chunks = [model_files[start:start + MODEL_CHUNK] for start in range(0, len(model_files), MODEL_CHUNK)]
+            self.jobs.map('Model grid fit', lambda chunk: GridFit.fit_grid(wave, flux, chunk, chunk_size=MODEL_CHUNK),
+                          chunks, on_result=lambda tables: self.model_grid_fitted(models_dir, tables),
+                          on_error=self.job_error_event)
+
+    def model_grid_fitted(self, models_dir, tables):
+        """
+        Merge rankings of model chunks and load the best model in background
+        :param tables: GridFit.fit_grid results of chunks, None for failed ones
+        """
+        table = np.concatenate([np.zeros(0, dtype=GridFit.RESULT_DTYPE)] +
+                               [item for item in tables if item is not None])
+        if len(table) == 0:
+            QMessageBox.warning(self, "Warning", "No models found\n")
+            return
+        table = table[np.argsort(table['reduced_chi2'], kind='mergesort')]
+        self.jobs.submit('Loading ' + os.path.basename(table[0]['model']), GridFit.load_model_file,
+                         (table[0]['model'],),
+                         on_result=lambda model: self.show_model_grid_fit(models_dir, table, model),
+                         on_error=self.job_error_event)
+
+    def show_model_grid_fit(self, models_dir, table, model):
+        """
+        Plot the best model with fitted scale and show the best rows of ranking
+        :param model: (wave, flux) of the best model
+        """
+        model_wave, model_flux = model
+        best = table[0]
+        self.add_plot(os.path.relpath(best['model'], models_dir), model_wave, model_flux * best['scale'])
+        QMessageBox.information(self, 'Model grid fit', GridFit.format_table(table, 10))
+
     def single_plot_warning_event(self):
         """
         Method creates window with warning message, when more than single plot chosen
@@ -735,68 +1557,92 @@ class SpecObserver(QMainWindow):
         QMessageBox.warning(self, "Warning", "Please choose one plot\n")
 
     @staticmethod
-    def black_body(temp):
-        lam = np.arange(1.0 * 1e-10, 20000. * 1e-10, 20e-10)
-        return lam, pyasl.planck(temp, lam=lam) * 1e-7 * 1e-18
+    def black_body(wave, temp):
+        """
+        :param wave: wavelength grid, Angstrom
+        :return: Planck function on grid in plot scale
+        """
+        return BlackBody.planck(wave, temp) * 1e-18
 
     def add_black_body_model(self):
         """
-        Add black-body model on plot
-        :return:
+        Add black-body model on plot, on grid of selected plot or of visible range.
+        For temperature range the selected plot is fitted by one black body at every temperature,
+        table of fits is shown and the best one is plotted.
         """
-        text, ok = QInputDialog.getText(self, 'Black body model', 'Enter temp, K:')
+        text, ok = QInputDialog.getText(self, 'Black body model',
+                                        'Enter temp, K, or from, to, step to fit selected plot:')
         try:
             if text != '' and ok is True:
-                temp = eval(str(text))
-                wave, flux = SpecObserver.black_body(temp)
-                current_plot = self.pw.plot(wave * 1e10, flux, pen=mkColor(self.i))
-                plot_name = "Black body " + str(temp) + " K"
-                self.all_plot_items[plot_name] = current_plot
-                self.add_to_list_widget(plot_name)
-                self.i += 2
-        except NameError and ValueError as exception:
-            self.name_error_event(exception.message)
+                values = eval('(' + str(text) + ',)')
+                selected_items = self.listWidget.selectedItems()
+                if len(selected_items) == 1:
+                    name = unicode(selected_items[0].text())
+                    wave, flux = self.all_plot_items[name].getData()
+                    wave = np.array(wave)
+                else:
+                    x_min, x_max = self.pw.viewRange()[0]
+                    wave = Rebin.log_grid(max(x_min, 100.0), max(x_max, 200.0), 1e-4)
+                if len(values) == 1:
+                    temp = values[0]
+                    self.add_plot(self.unique_plot_name("Black body " + str(temp) + " K"), wave,
+                                  SpecObserver.black_body(wave, temp))
+                elif len(selected_items) != 1:
+                    self.single_plot_warning_event()
+                else:
+                    temperatures = np.arange(values[0], values[1] + 0.5 * values[2], values[2])
+                    self.jobs.submit('Black body scan ' + name, BlackBody.scan_temperatures,
+                                     (wave, np.array(flux), temperatures),
+                                     on_result=lambda table: self.show_black_body_scan(name, wave, table),
+                                     on_error=self.job_error_event)
+        except (NameError, SyntaxError, ValueError) as exception:
+            self.name_error_event(unicode(exception))
 
-    def sum_plots(self):
+    def show_black_body_scan(self, name, wave, table):
         """
-        TEST
-        :return:
+        Show table of black body fits and plot the best one
         """
-        name = unicode(self.listWidget.selectedItems()[0].text())
-        data = np.transpose(self.all_plot_items[name].getData())
+        ResultTableDialog(self, 'Black body scan ' + name, table, BlackBody.format_table(table)).show()
+        best = table[table['best']][0]
+        self.add_plot(self.unique_plot_name("Black body %0.0f K" % best['temperature']), wave,
+                      best['dilution'] * BlackBody.planck(wave, best['temperature']))
 
-        name_second = unicode(self.listWidget.selectedItems()[1].text())
-        data_second = np.transpose(self.all_plot_items[name_second].getData())
-
-        data = data[:np.where(data[:, 0] < np.max(data_second[:, 0]))[0][-1], :]
-        data = data[np.where(data[:, 0] > np.min(data_second[:, 0]))[0][0]:, :]
-
-        interpolated_cont = pyasl.intep(data_second[:, 0], data_second[:, 1], data[:, 0])
-        data[:, 1] = data[:, 1] / interpolated_cont
-        self.all_plot_items[name].setData(data)
-
-        selected_item = self.listWidget.selectedItems()[1]
-        name = unicode(selected_item.text())
-        self.pw.removeItem(self.all_plot_items[name])
-        self.all_plot_items.pop(name)
-        self.listWidget.takeItem(self.listWidget.row(selected_item))
-
-        self.pw.autoRange()
+    def coadd_selected_plots(self):
         """
-        for selected_item in self.listWidget.selectedItems():
-            name = unicode(selected_item.text())
-            data = np.transpose(self.all_plot_items[name].getData())
-
-            data = data[:np.where(data[:, 0] < np.max(point_data[:, 0]))[0][-1], :]
-            data = data[np.where(data[:, 0] > np.min(point_data[:, 0]))[0][0]:, :]
-
-            interpolated_cont = pyasl.intep(point_data[:, 0], point_data[:, 1], data[:, 0])
+        Coadd selected plots into new plot: rebinning to common grid, sigma clipping
+        and weighted mean or median, computed in background
+        """
+        names = [unicode(item.text()) for item in self.listWidget.selectedItems()]
+        if len(names) < 2:
+            QMessageBox.warning(self, "Warning", "Please choose at least two plots\n")
+            return
+        methods = ['Weighted mean', 'Median']
+        method, ok = QInputDialog.getItem(self, 'Coadd', 'Combine:', methods, 0, False)
+        if not ok:
+            return
+        method = 'mean' if methods.index(unicode(method)) == 0 else 'median'
+        clip, ok = QInputDialog.getDouble(self, 'Coadd', 'Sigma clipping (0 for none):', 3.0, 0.0, 100.0, 1)
+        if not ok:
+            return
+        grid = self.ask_rebin_grid('Coadd grid')
+        if grid is None:
+            return
+        spectra = [self.all_plot_items[name].getData() for name in names]
+        waves = [np.array(wave) for wave, flux in spectra]
+        fluxes = [np.array(flux) for wave, flux in spectra]
+        plot_name = self.unique_plot_name('coadd of %d' % len(names))
+        self.jobs.submit('Coadding %d plots' % len(names), SpecObserver.coadd_spectra,
+                         (waves, fluxes) + grid + (method, clip),
+                         on_result=lambda result: self.add_plot(plot_name, result.wave, result.flux),
+                         on_error=self.job_error_event, report=True)
 
-            data[:, 1] = data[:, 1] / interpolated_cont
-            self.all_plot_items[name].setData(data)
-            self.listPointWidget.clear()
-            self.pw.autoRange()
-         """
+    @staticmethod
+    def coadd_spectra(waves, fluxes, kind, step, method, clip, report=None):
+        """
+        :return: Coadd.CoaddResult on grid made by Coadd.common_grid
+        """
+        grid = Coadd.common_grid(waves, kind, step)
+        return Coadd.coadd(waves, fluxes, grid=grid, method=method, clip=clip, report=report)
 
     def __init__(self):
         """
@@ -818,15 +1664,31 @@ class SpecObserver(QMainWindow):
         self.pw = self.win.addPlot()
         self.pw.showGrid(x=True, y=True)
 
+        self.jobs = JobManager(self)
+        self.jobs.changed.connect(self.update_job_status)
+
         self.init_ui()
         self.l.addWidget(self.win)
 
         self.i = 0
         self.all_plot_items = {}
         self.all_point_items = {}
-        self.all_lines = []
         self.all_fits_paths = {}
-        self.line_items = []
+        self.line_markers = LineMarkerLayer(self.pw)
+        Pipeline.line_catalogs = self.line_markers.catalogs
+        self.hover_lines = 5
+        self.plot_velocities = {}
+        self.pipelines = {}
+
+        self.watched_directory = None
+        self.watched_files = set()
+        self.pending_sizes = {}
+        self.watch_timer = QtCore.QTimer(self)
+        self.watch_timer.setSingleShot(True)
+        self.watch_timer.setInterval(1000)
+        self.watch_timer.timeout.connect(self.check_watched_folder)
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(lambda path: self.watch_timer.start())
 
     def init_ui(self):
         """
@@ -896,6 +1758,10 @@ class SpecObserver(QMainWindow):
         self.horizontal_third.addWidget(self.calculate_rot_broad)
         self.horizontal_third.addWidget(self.calculate_unred)
 
+        self.scan_av = QPushButton('Av scan', self)
+        self.scan_av.clicked.connect(self.scan_extinction_for_selected_plot)
+        self.scan_av.setFixedWidth(170)
+
         self.horizontal_fourth = QHBoxLayout()
         self.calculate_continuum = QPushButton('Continuum', self)
         self.calculate_continuum.clicked.connect(self.calculate_continuum_for_selected_plots)
@@ -907,6 +1773,14 @@ class SpecObserver(QMainWindow):
         self.horizontal_fourth.addWidget(self.calculate_continuum)
         self.horizontal_fourth.addWidget(self.calculate_fwhm)
 
+        self.auto_continuum = QPushButton('Auto continuum', self)
+        self.auto_continuum.clicked.connect(self.auto_continuum_for_selected_plots)
+        self.auto_continuum.setFixedWidth(170)
+
+        self.equivalent_widths = QPushButton('Equivalent widths', self)
+        self.equivalent_widths.clicked.connect(self.measure_equivalent_widths)
+        self.equivalent_widths.setFixedWidth(170)
+
         self.horizontal_fifth = QHBoxLayout()
         self.fits_export = QPushButton('Export FITS', self)
         self.fits_export.clicked.connect(self.export_as_fits_for_selected_plot)
@@ -929,34 +1803,86 @@ class SpecObserver(QMainWindow):
         self.remove_lines_button.clicked.connect(self.remove_lines)
         self.remove_lines_button.setFixedWidth(170)
 
-        self.sum_plots_button = QPushButton('Sum plots', self)
-        self.sum_plots_button.clicked.connect(self.sum_plots)
-        self.sum_plots_button.setFixedWidth(170)
-
+        self.coadd_button = QPushButton('Coadd plots', self)
+        self.coadd_button.clicked.connect(self.coadd_selected_plots)
+        self.coadd_button.setFixedWidth(170)
+
+
+        self.horizontal_sixth = QHBoxLayout()
+        self.scan_vsini_button = QPushButton('vsini scan', self)
+        self.scan_vsini_button.clicked.connect(self.scan_vsini_for_selected_plot)
+        self.scan_vsini_button.setFixedWidth(85)
+        self.rebin = QPushButton('Rebin', self)
+        self.rebin.clicked.connect(self.rebin_selected_plots)
+        self.rebin.setFixedWidth(85)
+
+        self.horizontal_sixth.addWidget(self.scan_vsini_button)
+        self.horizontal_sixth.addWidget(self.rebin)
+
+        self.horizontal_seventh = QHBoxLayout()
+        self.undo = QPushButton('Undo', self)
+        self.undo.clicked.connect(self.undo_selected_plots)
+        self.undo.setFixedWidth(55)
+        self.redo = QPushButton('Redo', self)
+        self.redo.clicked.connect(self.redo_selected_plots)
+        self.redo.setFixedWidth(55)
+        self.edit_steps = QPushButton('Steps', self)
+        self.edit_steps.clicked.connect(self.edit_selected_plot_steps)
+        self.edit_steps.setFixedWidth(55)
+
+        self.horizontal_seventh.addWidget(self.undo)
+        self.horizontal_seventh.addWidget(self.redo)
+        self.horizontal_seventh.addWidget(self.edit_steps)
 
         self.calc_z = QPushButton('Calc z', self)
         self.calc_z.clicked.connect(self.calculate_red_shift_by_z)
         self.calc_z.setFixedWidth(170)
 
+        self.measure_rv = QPushButton('Measure RV', self)
+        self.measure_rv.clicked.connect(self.measure_velocities_for_selected_plots)
+        self.measure_rv.setFixedWidth(170)
+
+        self.fit_grid = QPushButton('Fit grid', self)
+        self.fit_grid.clicked.connect(self.fit_model_grid_for_selected_plot)
+        self.fit_grid.setFixedWidth(170)
+
         self.vertical_layout.addWidget(self.unselect)
         self.vertical_layout.addWidget(self.listWidget)
         self.vertical_layout.addLayout(self.horizontal_first)
+        self.vertical_layout.addLayout(self.horizontal_seventh)
         self.vertical_layout.addLayout(self.horizontal_fifth)
         self.vertical_layout.addLayout(self.horizontal_second)
         self.vertical_layout.addLayout(self.horizontal_third)
+        self.vertical_layout.addWidget(self.scan_av)
+        self.vertical_layout.addLayout(self.horizontal_sixth)
         self.vertical_layout.addLayout(self.horizontal_fourth)
+        self.vertical_layout.addWidget(self.auto_continuum)
+        self.vertical_layout.addWidget(self.equivalent_widths)
         self.vertical_layout.addWidget(self.unselect_points)
         self.vertical_layout.addWidget(self.listPointWidget)
         self.vertical_layout.addWidget(self.remove_points)
         self.vertical_layout.addWidget(self.plot_black_body)
         self.vertical_layout.addWidget(self.remove_lines_button)
         self.vertical_layout.addWidget(self.calc_z)
-        self.vertical_layout.addWidget(self.sum_plots_button)
+        self.vertical_layout.addWidget(self.measure_rv)
+        self.vertical_layout.addWidget(self.coadd_button)
+        self.vertical_layout.addWidget(self.fit_grid)
         self.vertical_layout.addStretch()
         self.vertical_layout.addWidget(self.label)
 
         self.l.addLayout(self.vertical_layout)
 
+        self.job_label = QLabel()
+        self.job_progress = QProgressBar()
+        self.job_progress.setFixedWidth(170)
+        self.job_progress.setVisible(False)
+        self.cancel_jobs_button = QPushButton('Cancel', self)
+        self.cancel_jobs_button.clicked.connect(self.jobs.cancel_all)
+        self.cancel_jobs_button.setVisible(False)
+        self.statusBar().addWidget(self.job_label, 1)
+        self.statusBar().addPermanentWidget(self.job_progress)
+        self.statusBar().addPermanentWidget(self.cancel_jobs_button)
+
         open_file = QAction('Open from Table', self)
         open_file.setStatusTip('Open new File')
         open_file.triggered.connect(self.table_plot)
@@ -969,6 +1895,10 @@ class SpecObserver(QMainWindow):
         load_lines.setStatusTip('Load some Line')
         load_lines.triggered.connect(self.load_lines)
 
+        hover_lines = QAction('Identify', self)
+        hover_lines.setStatusTip('Lines near cursor and plot velocity')
+        hover_lines.triggered.connect(self.set_hover_lines)
+
         clear_plot = QAction('Clear', self)
         clear_plot.setStatusTip('Clear plot')
         clear_plot.triggered.connect(self.clear_plot)
@@ -989,12 +1919,39 @@ class SpecObserver(QMainWindow):
         cmf_plot_interp.setStatusTip('CMFGEN plot')
         cmf_plot_interp.triggered.connect(self.cmfgen_plot_interp)
 
+        cache_stats = QAction('Cache', self)
+        cache_stats.setStatusTip('CMFGEN model cache statistics')
+        cache_stats.triggered.connect(self.show_cache_stats)
+
+        save_session = QAction('Save session', self)
+        save_session.setStatusTip('Save plots, processing steps, points and lines')
+        save_session.triggered.connect(self.save_session)
+
+        open_session = QAction('Open session', self)
+        open_session.setStatusTip('Open saved session')
+        open_session.triggered.connect(self.load_session)
+
         fits_plot = QAction('Open from FITS', self)
         fits_plot.setStatusTip('CMFGEN plot')
         fits_plot.triggered.connect(self.fits_plot)
 
+        open_files = QAction('Open files', self)
+        open_files.setStatusTip('Open many FITS and table files in parallel')
+        open_files.triggered.connect(self.open_files)
+
+        open_directory = QAction('Open directory', self)
+        open_directory.setStatusTip('Open all FITS and table files of directory in parallel')
+        open_directory.triggered.connect(self.open_directory)
+
+        self.watch_action = QAction('Watch folder', self)
+        self.watch_action.setStatusTip('Open new files appearing in directory')
+        self.watch_action.triggered.connect(self.watch_folder)
+
         menu_bar = self.menuBar()
         menu_bar.addAction(fits_plot)
+        menu_bar.addAction(open_files)
+        menu_bar.addAction(open_directory)
+        menu_bar.addAction(self.watch_action)
         menu_bar.addAction(open_file)
         menu_bar.addAction(simple_open_file)
         menu_bar.addAction(cmf_plot)
@@ -1002,7 +1959,11 @@ class SpecObserver(QMainWindow):
         menu_bar.addAction(cmf_plot_rot)
         menu_bar.addAction(cmf_plot_interp)
         menu_bar.addAction(load_lines)
+        menu_bar.addAction(hover_lines)
         menu_bar.addAction(clear_plot)
+        menu_bar.addAction(cache_stats)
+        menu_bar.addAction(open_session)
+        menu_bar.addAction(save_session)
 
 
 app = QApplication(sys.argv)
@@ -0,0 +1,146 @@
+import os
+import hashlib
+import threading
+import numpy as np
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.spectrum_observer', 'cache')
+DEFAULT_MAX_SIZE = 1024 ** 3
+
+
+class SpectrumCache(object):
+    """On-disk cache of parsed spectra.
+    Every parsed array is stored as .npy file named by hash of source path, size and mtime,
+    so changed or moved files are parsed again. Cached arrays are returned memory-mapped.
+    When total size exceeds max_size, least recently used files are removed.
+     Attributes:
+         cache_dir (str): directory with .npy files.
+         max_size (int): size limit in bytes.
+         hits, misses, evictions (int): statistics for current session.
+    """
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        if cache_dir is None:
+            cache_dir = os.environ.get('SPECTRUM_OBSERVER_CACHE', DEFAULT_CACHE_DIR)
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, file_name, tag=''):
+        """
+        Cache key for file in current state
+        :param file_name: source file name
+        :param tag: parser name, different parsers of one file get different keys
+        :return: hex digest
+        """
+        stat = os.stat(file_name)
+        source = '%s|%d|%r|%s' % (os.path.abspath(file_name), stat.st_size, stat.st_mtime, tag)
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def cache_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, file_name, tag=''):
+        """
+        Return cached array or None, without parsing
+        :param file_name: source file name
+        :param tag: parser name for cache key
+        :return: read-only memmap or None
+        """
+        path = self.cache_path(self.key(file_name, tag))
+        try:
+            data = np.load(path, mmap_mode='r')
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        self.hits += 1
+        return data
+
+    def load(self, file_name, parser, tag=''):
+        """
+        Return parsed file from cache or parse and store it
+        :param file_name: source file name
+        :param parser: function file_name -> np.array
+        :param tag: parser name for cache key
+        :return: np.array, read-only memmap on hit
+        """
+        data = self.get(file_name, tag)
+        if data is not None:
+            return data
+
+        path = self.cache_path(self.key(file_name, tag))
+        self.misses += 1
+        data = parser(file_name)
+        try:
+            self.store(path, data)
+        except (IOError, OSError):
+            pass
+        return data
+
+    def store(self, path, data):
+        """
+        Write array to cache atomically and evict old files
+        :param path: .npy path in cache_dir
+        :param data: np.array
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'wb') as tmp_file:
+            np.save(tmp_file, np.ascontiguousarray(data))
+        os.rename(tmp_path, path)
+        self.evict()
+
+    def entries(self):
+        """
+        :return: list of (mtime, size, path) for cached files, oldest first
+        """
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used files until cache fits in max_size
+        """
+        entries = self.entries()
+        total_size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all cached files
+        """
+        for mtime, size, path in self.entries():
+            os.remove(path)
+
+    def stats(self):
+        """
+        :return: dict with hits, misses, evictions, files and size in bytes
+        """
+        entries = self.entries()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'files': len(entries),
+                'size': sum(size for mtime, size, path in entries)}
@@ -0,0 +1,77 @@
+import numpy as np
+from PyQt4.QtGui import QDialog, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QSlider
+from PyQt4 import QtCore
+from pyqtgraph import PlotDataItem, mkPen
+
+from Broadening import SPEED_OF_LIGHT
+
+
+class VsiniScanDialog(QDialog):
+    """Slider over precomputed rotationally broadened versions of one spectrum.
+    Current version is drawn as preview curve over the plot, plot data is not changed,
+    chosen vsini is applied by caller after accept.
+     Attributes:
+         vsini_values (np.array): scanned velocities, km/s.
+         vsini (float): velocity under slider.
+    """
+
+    def __init__(self, parent, plot_widget, wave, vsini_values, fluxes):
+        """
+        :param parent: main window
+        :param plot_widget: plot for preview curve
+        :param wave: wavelength array of preview
+        :param vsini_values: velocities, km/s
+        :param fluxes: np.array (vsini_values.size, wave.size), e.g. Broadening.broaden_rotation result
+        """
+        QDialog.__init__(self, parent)
+        self.setWindowTitle('vsini scan')
+        self.plot_widget = plot_widget
+        self.wave = wave
+        self.vsini_values = vsini_values
+        self.fluxes = fluxes
+        self.vsini = vsini_values[0]
+
+        self.preview = PlotDataItem(wave, fluxes[0], pen=mkPen('w', width=2))
+        self.plot_widget.addItem(self.preview)
+
+        self.vsini_label = QLabel()
+        self.slider = QSlider(QtCore.Qt.Horizontal, self)
+        self.slider.setRange(0, len(vsini_values) - 1)
+        self.slider.valueChanged.connect(self.show_vsini)
+
+        self.apply_button = QPushButton('Apply', self)
+        self.apply_button.clicked.connect(self.accept)
+        self.cancel_button = QPushButton('Cancel', self)
+        self.cancel_button.clicked.connect(self.reject)
+
+        buttons = QHBoxLayout()
+        buttons.addStretch()
+        buttons.addWidget(self.apply_button)
+        buttons.addWidget(self.cancel_button)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.vsini_label)
+        layout.addWidget(self.slider)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+        self.resize(400, 100)
+        self.finished.connect(self.remove_preview)
+        self.show_vsini(0)
+
+    def show_vsini(self, index):
+        self.vsini = float(self.vsini_values[index])
+        self.vsini_label.setText('vsini = %0.1f km/s' % self.vsini)
+        self.preview.setData(self.wave, self.fluxes[index])
+
+    def remove_preview(self):
+        self.plot_widget.removeItem(self.preview)
+
+
+def scan_window(wave, x_min, x_max, vsini_max):
+    """
+    Indices of preview part of spectrum: view range extended by kernel half width on both sides
+    :return: slice
+    """
+    pad = x_max * vsini_max / SPEED_OF_LIGHT
+    return slice(max(np.searchsorted(wave, x_min - pad, 'left') - 1, 0),
+                 np.searchsorted(wave, x_max + pad, 'right') + 1)
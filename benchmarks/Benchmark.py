@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of numeric hot paths on synthetic inputs.
+Fixtures are generated once per directory: CMFGEN obs_fin and cont files with '1-303' style tokens,
+1D FITS spectrum and line list. Every benchmark is timed several times, the best time is compared
+with baseline JSON of previous run, slowdown above tolerance fails the run.
+Nothing is drawn, the suite runs without display.
+
+Example:
+    python benchmarks/Benchmark.py --output new.json --baseline old.json --tolerance 0.3
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Broadening
+import CmfgenParse
+import Continuum
+import FitsLoader
+import LineCatalog
+import Rebin
+from SpectrumCache import SpectrumCache
+
+MODEL_POINTS = 400000
+CONT_POINTS = 40000
+FITS_POINTS = 2000000
+CATALOG_LINES = 200000
+WAVE_MIN = 900.0
+WAVE_MAX = 25000.0
+VALUES_PER_LINE = 8
+
+
+def _fortran_values(values):
+    """
+    CMFGEN-style text of numbers, tiny values lose their 'E' like fortran output does ('1.00000000-303')
+    """
+    text = np.char.mod('%16.8E', values)
+    tiny = np.flatnonzero(values < 1e-99)
+    if tiny.size:
+        text[tiny] = np.char.add(np.char.mod('  %1.8f', values[tiny] * 10.0 ** 303), '-303')
+    rows = [''.join(text[start:start + VALUES_PER_LINE]) for start in range(0, text.size, VALUES_PER_LINE)]
+    return '\n'.join(rows)
+
+
+def write_cmfgen(file_name, points, seed=0):
+    """
+    Synthetic CMFGEN observed spectrum: frequency and flux blocks with titles, lines and flux underflows
+    """
+    rng = np.random.RandomState(seed)
+    wave = np.exp(np.linspace(np.log(WAVE_MIN), np.log(WAVE_MAX), points))
+    frequency = (CmfgenParse._FREQ_TO_WAVE / wave)[::-1]
+    continuum = 1e-3 * (wave / 5000.0) ** -2
+    lines = rng.uniform(WAVE_MIN, WAVE_MAX, 2000)
+    depth = rng.uniform(-0.5, 0.9, lines.size)
+    flux = continuum.copy()
+    for center, line_depth in zip(lines, depth):
+        window = slice(np.searchsorted(wave, center - 5.0), np.searchsorted(wave, center + 5.0))
+        flux[window] *= 1.0 - line_depth * np.exp(-0.5 * ((wave[window] - center) / 0.8) ** 2)
+    intensity = (flux * wave ** 2 / 3e-5)[::-1]
+    intensity[:points // 50] = 1e-303
+    with open(file_name, 'w') as model_file:
+        model_file.write(' Continuum Frequencies ( 10^15 Hz)\n\n')
+        model_file.write(_fortran_values(frequency))
+        model_file.write('\n\n Observed intensity (Janskys)\n\n')
+        model_file.write(_fortran_values(intensity))
+        model_file.write('\n')
+
+
+def write_fits(file_name, points, seed=0):
+    """
+    Synthetic 1D FITS spectrum with linear WCS
+    """
+    from astropy.io import fits
+    rng = np.random.RandomState(seed)
+    step = (WAVE_MAX - WAVE_MIN) / (points - 1)
+    flux = (1.0 + 1e-5 * np.arange(points) * step + rng.normal(0, 0.01, points)).astype(np.float32)
+    hdu = fits.PrimaryHDU(flux)
+    hdu.header['CRVAL1'] = WAVE_MIN
+    hdu.header['CDELT1'] = step
+    hdu.header['CRPIX1'] = 1.0
+    hdu.header['CTYPE1'] = 'WAVE'
+    hdu.writeto(file_name, overwrite=True)
+
+
+def write_catalog(file_name, lines, seed=0):
+    """
+    Synthetic line list in nebular.dat format, every tenth line in Dib_all.dat numeric format
+    """
+    rng = np.random.RandomState(seed)
+    waves = np.sort(rng.uniform(WAVE_MIN, WAVE_MAX, lines))
+    ions = ['[O III]', 'He I', 'Fe II', '[N II]', 'H I', 'Si IV']
+    with open(file_name, 'w') as catalog_file:
+        for index, wave in enumerate(waves):
+            if index % 10:
+                catalog_file.write('%0.2f        %s\n' % (wave, ions[index % len(ions)]))
+            else:
+                catalog_file.write('%0.2f        %0.2f %0.1f\n' % (wave, rng.uniform(0, 5), rng.uniform(0, 100)))
+
+
+def make_fixtures(directory, scale=1.0):
+    """
+    Generate missing fixture files
+    :param scale: multiplier of fixture sizes
+    :return: dict of fixture paths
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fixtures = {'model': os.path.join(directory, 'obs_fin_%g' % scale),
+                'cont': os.path.join(directory, 'obs_cont_%g' % scale),
+                'fits': os.path.join(directory, 'spectrum_%g.fits' % scale),
+                'catalog': os.path.join(directory, 'lines_%g.dat' % scale)}
+    writers = {'model': lambda name: write_cmfgen(name, int(MODEL_POINTS * scale)),
+               'cont': lambda name: write_cmfgen(name, int(CONT_POINTS * scale), seed=1),
+               'fits': lambda name: write_fits(name, int(FITS_POINTS * scale)),
+               'catalog': lambda name: write_catalog(name, int(CATALOG_LINES * scale))}
+    for key, file_name in fixtures.items():
+        if not os.path.exists(file_name):
+            writers[key](file_name)
+    return fixtures
+
+
+def make_benchmarks(fixtures, cache_dir):
+    """
+    :param fixtures: make_fixtures result
+    :param cache_dir: directory for on-disk caches, user cache is not touched
+    :return: list of (name, function without arguments)
+    """
+    CmfgenParse.model_cache = SpectrumCache(os.path.join(cache_dir, 'models'))
+    LineCatalog.catalog_cache = SpectrumCache(os.path.join(cache_dir, 'catalogs'))
+    model = CmfgenParse.spectr_input(fixtures['model'])
+    wave, flux = model[:, 0].copy(), model[:, 1].copy()
+    order = np.argsort(wave)
+    wave, flux = wave[order], flux[order]
+    # warm caches so cached benchmarks time reopening only
+    CmfgenParse.load_model(fixtures['model'])
+    LineCatalog.load_catalog_file(fixtures['catalog'])
+    window = (wave > 4000) & (wave < 7000)
+    stack = np.vstack([flux[window]] * 8)
+
+    benchmarks = [
+        ('cmfgen_parse', lambda: CmfgenParse.spectr_input(fixtures['model'])),
+        ('cmfgen_parse_cont', lambda: CmfgenParse.spectr_input(fixtures['cont'])),
+        ('cmfgen_window', lambda: CmfgenParse.spectr_input(fixtures['model'], 4000.0, 5000.0)),
+        ('cmfgen_cached', lambda: CmfgenParse.load_model(fixtures['model'])),
+        ('fits_read', lambda: FitsLoader.read_spectrum(fixtures['fits'])),
+        ('fits_window', lambda: FitsLoader.read_spectrum(fixtures['fits'], wave_min=6000.0, wave_max=6600.0)),
+        ('rebin_log', lambda: Rebin.rebin_spectrum(wave, flux, 'log')),
+        ('broaden_resolution', lambda: Broadening.broaden(wave, flux, 5000.0)),
+        ('broaden_stack', lambda: Broadening.broaden(wave[window], stack, 5000.0)),
+        ('broaden_rotation', lambda: Broadening.broaden_rotation(wave[window], flux[window],
+                                                                 np.linspace(50.0, 300.0, 16))),
+        ('continuum_chebyshev', lambda: Continuum.fit_continuum(wave, flux, 'chebyshev', 7)),
+        ('continuum_spline', lambda: Continuum.fit_continuum(wave, flux, 'spline', 40)),
+        ('lines_parse', lambda: LineCatalog.read_catalog_file(fixtures['catalog'])),
+        ('lines_cached', lambda: LineCatalog.load_catalog_file(fixtures['catalog'])),
+    ]
+    try:
+        import LodPlot
+    except ImportError:
+        # pyqtgraph is missing, plot preparation is reported as skipped
+        benchmarks.append(('plot_prep', None))
+    else:
+        def plot_prep():
+            levels = LodPlot.minmax_pyramid(flux)
+            for x_min, x_max in ((wave[0], wave[-1]), (4000.0, 7000.0), (6500.0, 6600.0)):
+                LodPlot.decimate(wave, flux, levels, x_min, x_max, LodPlot.DEFAULT_PIXELS)
+        benchmarks.append(('plot_prep', plot_prep))
+    return benchmarks
+
+
+def run(benchmarks, repeat=5, only=None):
+    """
+    Time benchmarks
+    :param repeat: timed calls of every benchmark, after one warm-up call
+    :param only: names to run, all if None
+    :return: dict name -> {'best', 'mean', 'repeat'} in seconds, {'skipped': True} for unavailable ones
+    """
+    results = {}
+    for name, function in benchmarks:
+        if only and name not in only:
+            continue
+        if function is None:
+            results[name] = {'skipped': True}
+            continue
+        function()
+        times = timeit.repeat(function, number=1, repeat=repeat)
+        results[name] = {'best': min(times), 'mean': sum(times) / len(times), 'repeat': repeat}
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    :param results: run result
+    :param baseline: run result of earlier run
+    :param tolerance: allowed relative slowdown of best time
+    :return: list of (name, baseline best, best, ratio) slower than tolerance
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None or result.get('skipped') or previous.get('skipped'):
+            continue
+        ratio = result['best'] / max(previous['best'], 1e-9)
+        if ratio > 1.0 + tolerance:
+            regressions.append((name, previous['best'], result['best'], ratio))
+    return regressions
+
+
+def format_results(results, baseline=None):
+    """
+    :return: text table of results with ratio to baseline
+    """
+    lines = ['# benchmark best_s mean_s ratio']
+    for name, result in sorted(results.items()):
+        if result.get('skipped'):
+            lines.append('%s skipped' % name)
+            continue
+        ratio = ''
+        if baseline and name in baseline and not baseline[name].get('skipped'):
+            ratio = '%0.2f' % (result['best'] / max(baseline[name]['best'], 1e-9))
+        lines.append('%s %0.4f %0.4f %s' % (name, result['best'], result['mean'], ratio))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time numeric hot paths on synthetic fixtures')
+    parser.add_argument('--output', help='JSON file for results')
+    parser.add_argument('--baseline', help='JSON results of earlier run, slowdowns fail the run')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown')
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls of every benchmark')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier of fixture sizes')
+    parser.add_argument('--fixtures', help='directory to keep fixtures between runs, temporary if not given')
+    parser.add_argument('--only', nargs='+', help='benchmark names to run')
+    args = parser.parse_args(argv)
+
+    directory = args.fixtures or tempfile.mkdtemp(prefix='spectrum_observer_bench_')
+    try:
+        fixtures = make_fixtures(directory, args.scale)
+        results = run(make_benchmarks(fixtures, os.path.join(directory, 'cache')), args.repeat, args.only)
+    finally:
+        if args.fixtures is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    print(format_results(results, baseline))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'python': platform.python_version(), 'numpy': np.__version__,
+                       'machine': platform.machine(), 'scale': args.scale, 'repeat': args.repeat,
+                       'results': results}, output_file, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, previous, best, ratio in regressions:
+            print('SLOWER %s: %0.4f s -> %0.4f s (x%0.2f)' % (name, previous, best, ratio))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())